@@ -1,45 +1,112 @@
-import torch
-from torch import nn
-from torchvision import transforms
 import numpy as np
-from scipy.linalg import sqrtm
-
-
-
-def compute_FID():
+import os
+
+
+
+# Square root of a symmetric positive semi-definite matrix
+# through its eigendecomposition. Small negative eigenvalues
+# from rounding are clipped to 0.
+# Inputs:
+#   cov - Covariance matrix of shape (D, D)
+# Outputs:
+#   Symmetric matrix S of shape (D, D) where S @ S = cov
+def sqrt_psd(cov):
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    return (eigvecs * np.sqrt(np.clip(eigvals, 0, None))) @ eigvecs.T
+
+
+
+# Computes the FID of other distributions against a fixed reference
+# distribution. Since Σ1 and Σ2 are symmetric, sqrt(Σ1 Σ2) has the same
+# trace as sqrt(sqrt(Σ1) Σ2 sqrt(Σ1)), and the inner matrix is symmetric
+# PSD, so its trace comes from the eigenvalues of a symmetric matrix
+# instead of scipy's sqrtm of a non-symmetric one (which is slower and
+# can return complex values). sqrt(Σ1) is computed once and reused for
+# every distribution scored against the reference.
+class FID_Reference():
+    # mean - Mean of the reference features of shape (D)
+    # var - Covariance of the reference features of shape (D, D)
+    def __init__(self, mean, var):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.var = np.asarray(var, dtype=np.float64)
+        self.sqrt_var = sqrt_psd(self.var)
+        self.trace = np.trace(self.var)
+
+
+    # Compute the FID of a distribution against the reference
+    # Inputs:
+    #   mean - Mean of the features of shape (D)
+    #   var - Covariance of the features of shape (D, D)
+    def score(self, mean, var):
+        mean = np.asarray(mean, dtype=np.float64)
+        var = np.asarray(var, dtype=np.float64)
+
+        # calculate sum squared difference between means
+        ssdiff = np.sum((self.mean - mean)**2.0)
+
+        # calculate the trace of the sqrt of product between cov
+        prod = self.sqrt_var @ var @ self.sqrt_var
+        eigvals = np.linalg.eigvalsh((prod + prod.T)/2)
+        tr_covmean = np.sum(np.sqrt(np.clip(eigvals, 0, None)))
+
+        # calculate score
+        return float(ssdiff + self.trace + np.trace(var) - 2.0*tr_covmean)
+
+
+    # Compute the FID of distributions stored in files against the reference.
+    # The files are loaded one at a time.
+    # Inputs:
+    #   files - List of (mean_file, var_file) pairs
+    # Outputs:
+    #   List with the FID of each pair
+    def score_files(self, files):
+        return [self.score(np.load(mean_file), np.load(var_file)) for mean_file, var_file in files]
+
+
+
+# Loaded reference statistics, keyed by the file names and
+# their modification times so changed files are reloaded
+reference_cache = {}
+
+# Load the reference statistics from a mean and variance file
+# Inputs:
+#   mean_file - Filename of the reference mean
+#   var_file - Filename of the reference variance
+def load_reference(mean_file, var_file):
+    key = (os.path.abspath(mean_file), os.path.getmtime(mean_file), os.path.abspath(var_file), os.path.getmtime(var_file))
+    if key not in reference_cache:
+        reference_cache[key] = FID_Reference(np.load(mean_file), np.load(var_file))
+    return reference_cache[key]
+
+
+
+def compute_FID(
+        # Mean and variance files
+        mean_file1 = "eval/saved_stats/real_mean.npy",
+        mean_file2 = "eval/saved_stats/fake_mean_10K.npy",
+        var_file1 = "eval/saved_stats/real_var.npy",
+        var_file2 = "eval/saved_stats/fake_var_10K.npy",
+    ):
     # Given a two files of means and two files of
     # variances, compute the FID of these two distributions
 
+    return load_reference(mean_file1, var_file1).score_files([(mean_file2, var_file2)])[0]
 
-    # Mean and variance files
-    mean_file1 = "eval/saved_stats/real_mean.npy"
-    mean_file2 = "eval/saved_stats/fake_mean_10K.npy"
-    var_file1 = "eval/saved_stats/real_var.npy"
-    var_file2 = "eval/saved_stats/fake_var_10K.npy"
-
-
-    # Load in the mean and variances
-    mean1 = np.load(mean_file1)
-    mean2 = np.load(mean_file2)
-    var1 = np.load(var_file1)
-    var2 = np.load(var_file2)
-
-
-
-
-    # calculate sum squared difference between means
-    ssdiff = np.sum((mean1 - mean2)**2.0)
-
-	# calculate sqrt of product between cov
-    covmean = sqrtm(var1.dot(var2))
 
-	# check and correct imaginary numbers from sqrt
-    if np.iscomplexobj(covmean):
-        covmean = covmean.real
 
-	# calculate score
-    fid = ssdiff + np.trace(var1 + var2 - 2.0 * covmean)
-    return fid
+# Compute the FID of many distributions against the same reference
+# Inputs:
+#   files - List of (mean_file, var_file) pairs to score
+#   mean_file1 - Filename of the reference mean
+#   var_file1 - Filename of the reference variance
+# Outputs:
+#   List with the FID of each pair
+def compute_FID_multiple(
+        files,
+        mean_file1 = "eval/saved_stats/real_mean.npy",
+        var_file1 = "eval/saved_stats/real_var.npy",
+    ):
+    return load_reference(mean_file1, var_file1).score_files(files)
 
 
 
@@ -1,10 +1,14 @@
 import numpy as np
 import zipfile
+import os
 import pickle
+import hashlib
+import json
 import torch
-from torch import nn
-from torchvision import transforms
 import math
+from .compute_model_stats import normalize
+from .feature_stats import FeatureStats, FeatureCache
+from .feature_extractor import load_feature_extractor
 
 
 cpu = torch.device("cpu")
@@ -16,117 +20,186 @@ cpu = torch.device("cpu")
 
 
 
-def compute_imagenet_stats():
-    # Find the mean and variance of the imagenet dataset
+# Fingerprint of a data file from its size and first MB, so
+# the same data is found again even if it's moved or renamed
+def file_fingerprint(filename):
+    h = hashlib.sha256(str(os.path.getsize(filename)).encode())
+    with open(filename, "rb") as f:
+        h.update(f.read(2**20))
+    return h.hexdigest()[:16]
 
 
-    # Paths to the imagenet datasets
-    archive_file1 = "data/Imagenet64_train_part1.zip"
-    archive_file2 = "data/Imagenet64_train_part2.zip"
 
-    batchSize = 300
-    num_imgs = 100000
-    device = torch.device("cuda")
+# Get the shards of the data and the number of images in each one.
+# A data file is either a zip archive of pickle files with the images
+# in "data" or a .npy file of uint8 images of shape (N, 3, 64, 64).
+# Counting the images of an archive means reading all of it, so the
+# counts are cached in cache_dir.
+# Outputs:
+#   List of (data file, pickle filename or None, number of images)
+def get_shards(data_files, cache_dir):
+    index_file = os.path.join(cache_dir, "index.json")
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
 
+    shards = []
+    for data_file in data_files:
+        if data_file.endswith(".npy"):
+            shards.append((data_file, None, np.load(data_file, mmap_mode="r").shape[0]))
+            continue
 
+        key = file_fingerprint(data_file)
+        if key not in index:
+            with zipfile.ZipFile(data_file, 'r') as archive:
+                index[key] = [(filename.filename, len(pickle.load(archive.open(filename.filename, "r"))["data"]))
+                              for filename in archive.filelist]
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(index_file, "w") as f:
+                json.dump(index, f)
+        shards += [(data_file, name, count) for name, count in index[key]]
+    return shards
 
 
-    # Open the zip files
-    archive1 = zipfile.ZipFile(archive_file1, 'r')
-    archive2 = zipfile.ZipFile(archive_file2, 'r')
-    
-    # Read the pickle data
-    data = []
-    for filename in archive1.filelist:
-        file = pickle.load(archive1.open(filename.filename, "r"))
-        data.append(file["data"])
-        del file
-    for filename in archive2.filelist:
-        file = pickle.load(archive2.open(filename.filename, "r"))
-        data.append(file["data"])
-        del file
-    
-    # Load the data
-    archive1.close()
-    archive2.close()
-    img_data = np.concatenate((data), axis=0)
-    del data
 
-    # Shuffle the data
-    np.random.shuffle(img_data)
-
-    # Convert the data to a tensor
-    img_data = torch.tensor(img_data, dtype=torch.uint8, device=torch.device("cpu"))
-    img_data = img_data.reshape(img_data.shape[0], 3, 64, 64)
-
-    # Get a subset of the data
-    img_data = img_data[:num_imgs]
-
-    # Used to transforms the images to the correct distirbution
-    # as shown here: https://pytorch.org/hub/pytorch_vision_inception_v3/
-    def normalize(imgs):
-        # Convert image to 299x299
-        imgs = transforms.Compose([transforms.Resize((299,299))])(imgs)
-
-        # Standardize to [0, 1]
-        imgs = imgs/255.0
-
-        # Normalize by mean and std
-        return transforms.Compose([transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])(imgs)
-
-
-
-
-
-
-
-
-    # Load in the inception network
-    inceptionV3 = torch.hub.load('pytorch/vision:v0.10.0', 'inception_v3', weights="Inception_V3_Weights.DEFAULT")
-    inceptionV3.eval()
-    inceptionV3.to(device)
-
-    # Remove the fully connected output layer
-    inceptionV3.fc = nn.Identity()
-    inceptionV3.aux_logits = False
-
-
-
-
-
-
-
-    # Calculate the inception scores
-    scores = None
-    with torch.no_grad():
-        for i in range(math.ceil(num_imgs/batchSize)):
-            # Get the current batch size
-            cur_batch_size = min(num_imgs, batchSize*(i+1))-batchSize*i
-
-            # Get the current batch of images
-            imgs = img_data[batchSize*i:cur_batch_size+(batchSize*i)]
-
-            # Normalize the inputs
-            imgs = normalize(imgs.to(torch.uint8))
-
-            # Calculate the inception scores and store them
-            if type(scores) == type(None):
-                scores = inceptionV3(imgs.to(device)).to(cpu).numpy().astype(np.float16)
-            else:
-                scores = np.concatenate((scores, inceptionV3(imgs.to(device)).to(cpu).numpy().astype(np.float16)), axis=0)
-    
-
-    # Delete the model as its no longer needed
-    del inceptionV3
-
-    # Calculate the mean and covariance of the generated batch
-    mean = np.mean(scores, axis=0)
-    var = np.cov(scores, rowvar=False)
+# Load the images at the given (sorted) indices of a shard
+# Outputs:
+#   uint8 tensor of images of shape (N, 3, 64, 64)
+def load_shard_imgs(data_file, name, idxs):
+    if name is None:
+        imgs = np.load(data_file, mmap_mode="r")[idxs]
+    else:
+        with zipfile.ZipFile(data_file, 'r') as archive:
+            imgs = pickle.load(archive.open(name, "r"))["data"][idxs]
+    return torch.tensor(np.ascontiguousarray(imgs), dtype=torch.uint8).reshape(-1, 3, 64, 64)
+
+
+
+# Iterate over a random subset of the images one shard at
+# a time, so only one shard is ever loaded in memory
+# Inputs:
+#   shards - Shards from get_shards
+#   num_imgs - Number of images in the subset
+#   seed - Seed of the subset
+# Outputs:
+#   Generator of uint8 tensors of images of shape (N, 3, 64, 64)
+def iterate_subset(shards, num_imgs, seed):
+    counts = np.array([count for _, _, count in shards])
+    num_imgs = min(num_imgs, counts.sum())
+    idxs = np.sort(np.random.default_rng(seed).choice(counts.sum(), num_imgs, replace=False))
+
+    # Split the indices into the shards
+    starts = np.concatenate(([0], np.cumsum(counts)))
+    for (data_file, name, _), start, end in zip(shards, starts[:-1], starts[1:]):
+        shard_idxs = idxs[(idxs >= start) & (idxs < end)] - start
+        if len(shard_idxs) > 0:
+            yield load_shard_imgs(data_file, name, shard_idxs)
+
+
+
+
+
+
+
+def compute_imagenet_stats(
+        # Paths to the imagenet datasets (zip archives or .npy memmaps)
+        data_files = ["data/Imagenet64_train_part1.zip", "data/Imagenet64_train_part2.zip"],
+
+        # Batch size, number of images, and seed of the subset of images
+        batchSize = 300,
+        num_imgs = 100000,
+        seed = 0,
+        device = torch.device("cuda"),
+
+        # Preprocessing of the images and the feature extractor
+        resize_mode = "bilinear",
+        extractor = "inception",
+
+        # True to antialias the resized images. The fake
+        # statistics must be made with the same setting.
+        antialias = False,
+
+        # Directory of the cached statistics and the files to save them to
+        cache_dir = "eval/saved_stats/reference/",
+        mean_file = "eval/saved_stats/real_mean.npy",
+        var_file = "eval/saved_stats/real_var.npy",
+
+        # True to also save the raw features to cache_dir/<key>_features.npy
+        # for the metrics in compute_metrics.py
+        save_features = False,
+
+        # (Optional) Function which loads the feature extractor on a device
+        load_extractor = None,
+    ):
+    # Find the mean and variance of the imagenet dataset.
+    # The statistics are cached by the data and the way
+    # they're computed, so running this again is instant.
+
+
+    # Key of the statistics in the cache
+    shards = get_shards(data_files, cache_dir)
+    config = {
+        "data": [file_fingerprint(f) for f in data_files],
+        "num_imgs": int(min(num_imgs, sum(count for _, _, count in shards))),
+        "seed": seed,
+        "resize_mode": resize_mode,
+        "extractor": extractor,
+    }
+    # Only part of the key when enabled so the statistics
+    # cached before the option existed are still found
+    if antialias:
+        config["antialias"] = True
+    key = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    stats_file = os.path.join(cache_dir, f"{key}.npz")
+    features_file = os.path.join(cache_dir, f"{key}_features.npy")
+
+    if os.path.exists(stats_file) and (not save_features or os.path.exists(features_file)):
+        stats = FeatureStats.load(stats_file)
+        print(f"Loaded cached statistics {stats_file}")
+
+    else:
+        # Load in the inception network
+        if load_extractor is None:
+            inceptionV3 = load_feature_extractor(extractor, device)
+        else:
+            inceptionV3 = load_extractor(device)
+
+        # Calculate the inception features of the subset and
+        # add them to the running statistics
+        stats = features = None
+        with torch.no_grad():
+            for shard_imgs in iterate_subset(shards, num_imgs, seed):
+                for i in range(math.ceil(shard_imgs.shape[0]/batchSize)):
+                    # Get the current batch of images
+                    imgs = shard_imgs[batchSize*i:batchSize*(i+1)]
+
+                    # Normalize the inputs
+                    imgs = normalize(imgs.to(device), resize_mode, antialias)
+
+                    # Calculate the inception features and add them to the statistics
+                    feats = inceptionV3(imgs)
+                    if stats is None:
+                        stats = FeatureStats(feats.shape[-1])
+                        if save_features:
+                            features = FeatureCache(features_file, config["num_imgs"], feats.shape[-1])
+                    stats.update(feats)
+                    if features is not None:
+                        features.update(feats)
+
+
+        # Delete the model as its no longer needed
+        del inceptionV3
+
+        # Cache the statistics with the config they were made with
+        stats.save(stats_file)
+        with open(os.path.join(cache_dir, f"{key}.json"), "w") as f:
+            json.dump(config, f)
 
 
     # Save the mean and variance
-    np.save("eval/saved_stats/real_mean.npy", mean)
-    np.save("eval/saved_stats/real_var.npy", var)
+    stats.save_stats(mean_file, var_file)
+    return stats
 
 
 
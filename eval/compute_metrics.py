@@ -0,0 +1,168 @@
+import torch
+import numpy as np
+
+from .compute_FID import load_reference
+from .feature_stats import FeatureStats, FeatureCache
+from .feature_extractor import load_inception_head
+
+
+
+
+
+# Inception Score of a set of images from the logits of the
+# inception classifier
+# Inputs:
+#   logits - Array of logits of shape (N, num_classes)
+#   splits - Number of splits to average the score over
+# Outputs:
+#   Mean and std of the score over the splits
+def inception_score(logits, splits=10):
+    logits = torch.as_tensor(np.asarray(logits), dtype=torch.float64)
+    log_p = torch.log_softmax(logits, -1)
+    scores = []
+    for log_p_split in log_p.chunk(splits):
+        # KL divergence between p(y|x) and p(y)
+        log_py = torch.logsumexp(log_p_split, 0) - np.log(log_p_split.shape[0])
+        kl = (log_p_split.exp() * (log_p_split - log_py)).sum(-1).mean()
+        scores.append(kl.exp().item())
+    return float(np.mean(scores)), float(np.std(scores))
+
+
+
+# Kernel Inception Distance, the unbiased estimate of the squared MMD
+# with the kernel k(x, y) = (x.y/d + 1)^3, averaged over random subsets
+# Inputs:
+#   real_feats - Array of real features of shape (N, d)
+#   fake_feats - Array of fake features of shape (M, d)
+#   num_subsets - Number of subsets to average over
+#   subset_size - Number of features in each subset
+#   seed - Seed of the subsets
+# Outputs:
+#   Mean and std of the KID over the subsets
+def KID(real_feats, fake_feats, num_subsets=100, subset_size=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    d = real_feats.shape[1]
+    m = min(subset_size, real_feats.shape[0], fake_feats.shape[0])
+    kids = []
+    for _ in range(num_subsets):
+        X = torch.as_tensor(np.asarray(real_feats[np.sort(rng.choice(real_feats.shape[0], m, replace=False))]), dtype=torch.float64)
+        Y = torch.as_tensor(np.asarray(fake_feats[np.sort(rng.choice(fake_feats.shape[0], m, replace=False))]), dtype=torch.float64)
+        Kxx = (X @ X.T / d + 1)**3
+        Kyy = (Y @ Y.T / d + 1)**3
+        Kxy = (X @ Y.T / d + 1)**3
+        mmd = (Kxx.sum() - Kxx.diagonal().sum())/(m*(m-1)) \
+            + (Kyy.sum() - Kyy.diagonal().sum())/(m*(m-1)) \
+            - 2*Kxy.mean()
+        kids.append(mmd.item())
+    return float(np.mean(kids)), float(np.std(kids))
+
+
+
+# Distance of each feature to its k-th nearest neighbor in the
+# same set (not counting itself), computed in chunks
+def knn_radii(feats, k, chunk_size):
+    radii = []
+    for i in range(0, feats.shape[0], chunk_size):
+        dists = torch.cdist(feats[i:i+chunk_size], feats)
+        radii.append(dists.kthvalue(k+1, -1).values)
+    return torch.cat(radii)
+
+
+
+# Fraction of the features which are inside the k-NN ball
+# of at least one feature of the manifold
+def in_manifold(feats, manifold, radii, chunk_size):
+    inside = []
+    for i in range(0, feats.shape[0], chunk_size):
+        dists = torch.cdist(feats[i:i+chunk_size], manifold)
+        inside.append((dists <= radii).any(-1))
+    return torch.cat(inside).float().mean().item()
+
+
+
+# Improved precision and recall (Kynkäänniemi et al. 2019). The manifold
+# of a set of features is the union of the balls around each feature
+# reaching its k-th nearest neighbor. Precision is the fraction of fake
+# features in the real manifold and recall is the fraction of real
+# features in the fake manifold.
+# Inputs:
+#   real_feats - Array of real features of shape (N, d)
+#   fake_feats - Array of fake features of shape (M, d)
+#   k - Number of neighbors of the balls
+#   num_samples - Max number of features of each set to use
+#   seed - Seed of the features used
+#   chunk_size - Number of features to compute the distances of at once
+# Outputs:
+#   Precision and recall
+def precision_recall(real_feats, fake_feats, k=3, num_samples=10000, seed=0, chunk_size=1000):
+    rng = np.random.default_rng(seed)
+    def sample(feats):
+        idxs = np.sort(rng.choice(feats.shape[0], min(num_samples, feats.shape[0]), replace=False))
+        return torch.as_tensor(np.asarray(feats[idxs]), dtype=torch.float32)
+    real, fake = sample(real_feats), sample(fake_feats)
+
+    precision = in_manifold(fake, real, knn_radii(real, k, chunk_size), chunk_size)
+    recall = in_manifold(real, fake, knn_radii(fake, k, chunk_size), chunk_size)
+    return precision, recall
+
+
+
+
+
+# Computes the FID, Inception Score, KID, and precision and recall of
+# generated images from their cached features (see the features_filename
+# of compute_model_stats and save_features of compute_imagenet_stats),
+# so adding a metric never needs the images to be generated again.
+# Outputs:
+#   Dictionary of the metrics
+def compute_metrics(
+        # Features of the generated images and the real images
+        fake_features_file = "eval/saved_stats/fake_features_190K.npy",
+        real_features_file = "eval/saved_stats/real_features.npy",
+
+        # Reference statistics for the FID
+        real_mean_file = "eval/saved_stats/real_mean.npy",
+        real_var_file = "eval/saved_stats/real_var.npy",
+
+        # KID and precision and recall parameters
+        kid_subsets = 100,
+        kid_subset_size = 1000,
+        pr_k = 3,
+        pr_samples = 10000,
+        seed = 0,
+
+        # (Optional) Layer mapping the features to the class logits
+        # for the Inception Score. Defaults to the inception classifier.
+        classifier = None,
+
+        # Number of features to process at once
+        chunk_size = 1000,
+    ):
+    fake_feats = FeatureCache.load(fake_features_file)
+    real_feats = FeatureCache.load(real_features_file)
+    if classifier is None:
+        classifier = load_inception_head()
+    metrics = {}
+
+    # FID and the logits for the Inception Score, going over
+    # the features one chunk at a time
+    stats = FeatureStats(fake_feats.shape[1])
+    logits = []
+    with torch.no_grad():
+        for i in range(0, fake_feats.shape[0], chunk_size):
+            chunk = np.asarray(fake_feats[i:i+chunk_size])
+            stats.update(chunk)
+            logits.append(classifier(torch.tensor(chunk)).numpy())
+    metrics["FID"] = load_reference(real_mean_file, real_var_file).score(stats.mean, stats.cov())
+    metrics["IS"], metrics["IS_std"] = inception_score(np.concatenate(logits))
+
+    metrics["KID"], metrics["KID_std"] = KID(real_feats, fake_feats, kid_subsets, kid_subset_size, seed)
+    metrics["precision"], metrics["recall"] = precision_recall(real_feats, fake_feats, pr_k, pr_samples, seed, chunk_size)
+    return metrics
+
+
+
+
+
+if __name__ == "__main__":
+    print(compute_metrics())
@@ -5,11 +5,17 @@ sys.path.insert(0, os.path.abspath('src/'))
 
 import torch
 from torch import nn
-from torchvision import transforms
 import math
 import numpy as np
+import threading
+import queue
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 
 from src.models.diff_model import diff_model
+from .feature_stats import FeatureStats, FeatureCache
+from .feature_extractor import load_feature_extractor
 
 cpu = torch.device("cpu")
 
@@ -19,6 +25,220 @@ cpu = torch.device("cpu")
 
 
 
+# Mean and std of the ImageNet images the inception network expects
+# as shown here: https://pytorch.org/hub/pytorch_vision_inception_v3/
+imagenet_mean = [0.485, 0.456, 0.406]
+imagenet_std = [0.229, 0.224, 0.225]
+
+
+
+# Used to transforms the images to the correct distirbution. This is
+# the same as a transforms.Resize of the uint8 images to 299x299 (which
+# rounds the resized images), dividing by 255, and transforms.Normalize,
+# but the scaling and normalization are folded into one multiply-add.
+# Inputs:
+#   imgs - uint8 images of shape (N, 3, L, W)
+#   resize_mode - Interpolation used to resize the images
+#   antialias - True to antialias bilinear and bicubic resizes. The pinned
+#               torchvision doesn't antialias tensors, so the saved reference
+#               statistics are made without it. The real and fake features
+#               must use the same setting for their statistics to be compared.
+def normalize(imgs, resize_mode="bilinear", antialias=False):
+    # Convert image to 299x299
+    smooth = resize_mode in ["bilinear", "bicubic"]
+    imgs = nn.functional.interpolate(imgs.float(), (299,299), mode=resize_mode,
+        align_corners=False if smooth else None, antialias=antialias and smooth)
+    imgs = imgs.round_().clamp_(0, 255)
+
+    # Standardize to [0, 1] and normalize by mean and std
+    scale = torch.tensor([1/(255.0*s) for s in imagenet_std], device=imgs.device).reshape(1, 3, 1, 1)
+    shift = torch.tensor([-m/s for m, s in zip(imagenet_mean, imagenet_std)], device=imgs.device).reshape(1, 3, 1, 1)
+    return torch.addcmul(shift, imgs, scale)
+
+
+
+# Load in a diffusion model to generate images with
+# Inputs:
+#   model_dirname, model_filename, model_params_filename - Files to load the model from
+#   device - Torch device to load the model on
+#   step_size, DDIM_scale - Generation step size and DDIM scale
+def load_model(model_dirname, model_filename, model_params_filename, device, step_size, DDIM_scale):
+    model = diff_model(3, 3, 1, 1, ["res", "res"], 100000, "cosine", 100, device, 100, 1000, 16, 0.0, step_size, DDIM_scale)
+    model.loadModel(model_dirname, model_filename, model_params_filename)
+    model.eval()
+    return model
+
+
+
+# Load in the inception network without its fully connected output
+# layer from the cached weights (see feature_extractor.py)
+# Inputs:
+#   device - Torch device to load the network on
+def load_inception(device):
+    return load_feature_extractor("inception", device)
+
+
+
+# Generate images and add their inception features to the running
+# statistics. With pipeline=True, the images are generated in a
+# background thread while the features of the last batches are
+# computed, with at most queue_size generated batches waiting. On a
+# GPU, generation runs on its own CUDA stream so the two stages run
+# concurrently on the device, and images/sec is close to the rate of
+# the slower stage instead of the rate of the two stages in sequence.
+# Inputs:
+#   model - Diffusion model to generate images with
+#   inceptionV3 - Network to get the features of the images with
+#   stats - FeatureStats to add the features to
+#   num_imgs - Number of images to generate
+#   batchSize - Number of images to generate at once
+#   corrected - True to put a limit on generation
+#   verbose - True to show the progress
+#   pipeline - True to generate and compute features concurrently
+#   queue_size - Max number of generated batches waiting for the features
+#   features - (Optional) FeatureCache to also save the raw features to
+#   seed - (Optional) Seed of the images. Each image is seeded by its index,
+#          so the images don't depend on the batch size.
+#   start_idx - Index of the first image when a seed is given
+#   antialias - True to antialias the resized images (see normalize)
+@torch.no_grad()
+def add_model_stats(model, inceptionV3, stats, num_imgs, batchSize, corrected, verbose=True, pipeline=True, queue_size=2, features=None, seed=None, start_idx=0, antialias=False):
+    # Sizes of the batches to generate
+    batch_sizes = [min(num_imgs, batchSize*(i+1))-batchSize*i for i in range(math.ceil(num_imgs/batchSize))]
+
+    # Generate the i-th batch of images
+    def generate(i, cur_batch_size):
+        sample_idxs = range(start_idx+batchSize*i, start_idx+batchSize*i+cur_batch_size)
+        imgs = model.sample_imgs(cur_batch_size, use_tqdm=verbose, unreduce=True, corrected=corrected, seed=seed, sample_idxs=sample_idxs)
+        return imgs.to(torch.uint8)
+
+    # Normalize the inputs and add their inception features to the statistics
+    def add_features(imgs):
+        feats = inceptionV3(normalize(imgs, antialias=antialias))
+        stats.update(feats)
+        if features is not None:
+            features.update(feats)
+
+    if not pipeline:
+        for i, cur_batch_size in enumerate(batch_sizes):
+            add_features(generate(i, cur_batch_size))
+            if verbose:
+                print(f"Num loaded: {min(num_imgs, batchSize*(i+1))}")
+        return stats
+
+
+    # Generated batches waiting for their features. An exception
+    # in the generation thread is passed on through the queue.
+    batches = queue.Queue(queue_size)
+    device = torch.device(model.device)
+    stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+    stop = threading.Event()
+
+    # Wait for space in the queue unless the feature stage stopped
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def producer():
+        try:
+            with torch.no_grad(), torch.cuda.stream(stream) if stream is not None else nullcontext():
+                for i, cur_batch_size in enumerate(batch_sizes):
+                    imgs = generate(i, cur_batch_size)
+
+                    # The feature stage waits for the generation to finish on the GPU
+                    event = None
+                    if stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    put((imgs, event))
+        except BaseException as e:
+            put((e, None))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        for i in range(len(batch_sizes)):
+            imgs, event = batches.get()
+            if isinstance(imgs, BaseException):
+                raise imgs
+            if event is not None:
+                torch.cuda.current_stream(device).wait_event(event)
+                imgs.record_stream(torch.cuda.current_stream(device))
+            add_features(imgs)
+            if verbose:
+                print(f"Num loaded: {min(num_imgs, batchSize*(i+1))}")
+    finally:
+        stop.set()
+        thread.join()
+    return stats
+
+
+
+
+
+
+
+# Device, feature extractor, and (optionally) model of a worker process
+# of worker_pool. They are loaded once when the worker starts.
+worker = {}
+
+
+
+# Start a worker process on the next free device
+def init_worker(device_queue, threads, load_extractor, model_args):
+    worker["device"] = torch.device(device_queue.get())
+    if threads is not None:
+        torch.set_num_threads(threads)
+    worker["extractor"] = load_extractor(worker["device"])
+    if model_args is not None:
+        model_files, step_size, DDIM_scale = model_args
+        worker["model"] = load_model(*model_files, worker["device"], step_size, DDIM_scale)
+
+
+
+# Make a pool of worker processes which each load the feature extractor
+# (and optionally a model) on their own device into worker. With "gpu",
+# there is one worker for each GPU number. With "cpu", there are
+# num_cpu_workers workers which split the CPU threads. Workers are
+# spawned so CUDA can be used in them.
+# Inputs:
+#   device - "gpu" or "cpu"
+#   gpu_nums - GPU numbers to run a worker on
+#   num_cpu_workers - Number of workers on the CPU
+#   num_jobs - Number of jobs to run. There are never more workers than jobs.
+#   load_extractor - Function which loads the feature extractor on a device
+#   model_args - (Optional) ((model_dirname, model_filename, model_params_filename),
+#                step_size, DDIM_scale) of a model each worker loads
+# Outputs:
+#   ProcessPoolExecutor of the workers
+def worker_pool(device, gpu_nums, num_cpu_workers, num_jobs, load_extractor, model_args=None):
+    # Devices of the workers
+    if device == "gpu":
+        devices = [f"cuda:{gpu_num}" for gpu_num in gpu_nums]
+        threads = None
+    else:
+        devices = ["cpu"]*num_cpu_workers
+        threads = max(1, torch.get_num_threads()//num_cpu_workers)
+    devices = devices[:num_jobs]
+
+    # Each worker takes a device from the queue when it starts
+    ctx = mp.get_context("spawn")
+    device_queue = ctx.Queue()
+    for d in devices:
+        device_queue.put(d)
+    return ProcessPoolExecutor(len(devices), mp_context=ctx, initializer=init_worker,
+        initargs=(device_queue, threads, load_extractor, model_args))
+
+
+
+
+
+
+
 # Computes the mean and variance of the given model
 # for its FID scores and saves it to a tensor
 def compute_model_stats(
@@ -31,37 +251,30 @@ def compute_model_stats(
         device = "gpu",
         gpu_num = 0,
 
-        # Batch size and number of images to generate
+        # Batch size and number of images to generate, and (optionally)
+        # the seed of the images
         num_fake_imgs = 10000,
         batchSize = 200,
+        seed = None,
 
         # Generation step size, DDIM scale, correct output?
         step_size = 1,
         DDIM_scale = 1,
         corrected = True,
 
+        # True to antialias the resized images. Must match
+        # the setting the real statistics were made with.
+        antialias = False,
+
         # Filenames for outputs
         file_path = "eval/saved_stats/",
         mean_filename = "fake_mean_190K.npy",
         var_filename = "fake_var_190K.npy",
-    ):
-
-
-    # Used to transforms the images to the correct distirbution
-    # as shown here: https://pytorch.org/hub/pytorch_vision_inception_v3/
-    def normalize(imgs):
-        # Convert image to 299x299
-        imgs = transforms.Compose([transforms.Resize((299,299))])(imgs)
-
-        # Standardize to [0, 1]
-        imgs = imgs/255.0
-
-        # Normalize by mean and std
-        return transforms.Compose([transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])(imgs)
-
-
-
 
+        # (Optional) Filename to save the raw features to
+        # for the metrics in compute_metrics.py
+        features_filename = None,
+    ):
 
 
     # Get the device
@@ -71,56 +284,25 @@ def compute_model_stats(
         device = torch.device(f"cpu")
 
     # Load in the model
-    model = diff_model(3, 3, 1, 1, ["res", "res"], 100000, "cosine", 100, device, 100, 1000, 16, 0.0, step_size, DDIM_scale)
-    model.loadModel(model_dirname, model_filename, model_params_filename)
-    model.eval()
+    model = load_model(model_dirname, model_filename, model_params_filename, device, step_size, DDIM_scale)
 
     # Load in the inception network
-    inceptionV3 = torch.hub.load('pytorch/vision:v0.10.0', 'inception_v3', weights="Inception_V3_Weights.DEFAULT")
-    inceptionV3.eval()
-    inceptionV3.to(model.device)
-
-    # Remove the fully connected output layer
-    inceptionV3.fc = nn.Identity()
-    inceptionV3.aux_logits = False
+    inceptionV3 = load_inception(model.device)
     
 
 
     ### Model Generation ###
 
-    # Generate images and calculate the inceptions scores
-    scores = None
-    with torch.no_grad():
-        for i in range(math.ceil(num_fake_imgs/batchSize)):
-            # Get the current batch size
-            cur_batch_size = min(num_fake_imgs, batchSize*(i+1))-batchSize*i
-
-            # Generate some images
-            imgs = model.sample_imgs(cur_batch_size, use_tqdm=True, unreduce=True, corrected=corrected)
-
-            # Normalize the inputs
-            imgs = normalize(imgs.to(torch.uint8))
-
-            # Calculate the inception scores and store them
-            if type(scores) == type(None):
-                scores = inceptionV3(imgs).to(cpu).numpy().astype(np.float16)
-            else:
-                scores = np.concatenate((scores, inceptionV3(imgs).to(cpu).numpy().astype(np.float16)), axis=0)
-
-            print(f"Num loaded: {min(num_fake_imgs, batchSize*(i+1))}")
+    # Generate images and add their inception features
+    # to the running statistics
+    features = FeatureCache(f"{file_path}{os.sep}{features_filename}", num_fake_imgs, 2048) if features_filename else None
+    stats = add_model_stats(model, inceptionV3, FeatureStats(2048), num_fake_imgs, batchSize, corrected, features=features, seed=seed, antialias=antialias)
     
     # Delete the model as its no longer needed
-    device = model.device
     del model, inceptionV3
 
-    # Calculate the mean and covariance of the generated batch
-    mean = np.mean(scores, axis=0)
-    var = np.cov(scores, rowvar=False)
-
-
-    # Save the mean and variance
-    np.save(f"{file_path}{os.sep}{mean_filename}", mean)
-    np.save(f"{file_path}{os.sep}{var_filename}", var)
+    # Save the mean and variance of the generated images
+    stats.save_stats(f"{file_path}{os.sep}{mean_filename}", f"{file_path}{os.sep}{var_filename}")
 
 
 
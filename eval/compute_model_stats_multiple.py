@@ -1,124 +1,125 @@
-import threading
-from .compute_model_stats import compute_model_stats
-
-
-
-
-def compute_model_stats_multiple():
-    # Directory name to load in models
-    dir_name = "models_res"
-    
-    # Model filenames and parameter names
-    model_filenames = [
-        "model_40e_50000s.pkl",
-        "model_80e_100000s.pkl",
-        "model_120e_150000s.pkl",
-        "model_160e_200000s.pkl",
-        "model_200e_250000s.pkl",
-        "model_240e_300000s.pkl",
-        "model_280e_350000s.pkl",
-        "model_320e_400000s.pkl",
-        "model_360e_450000s.pkl",
-        "model_400e_500000s.pkl"
-    ]
-    model_params_filenames = [
-        "model_params_40e_50000s.json",
-        "model_params_80e_100000s.json",
-        "model_params_120e_150000s.json",
-        "model_params_160e_200000s.json",
-        "model_params_200e_250000s.json",
-        "model_params_240e_300000s.json",
-        "model_params_280e_350000s.json",
-        "model_params_320e_400000s.json",
-        "model_params_360e_450000s.json",
-        "model_params_400e_500000s.json"
-    ]
-
-    # GPU numbers for each model to calculate statistics for
-    gpu_nums = [
-        0,
-        1,
-        2,
-        3,
-        4,
-        5,
-        6,
-        7,
-        8,
-        9
-    ]
-
-    # Diffusion parameters
-    step_size = 1
-    DDIM_scale = 1
-    corrected = True
-
-    # Batch size and number of images to generate
-    num_fake_imgs = 10000
-    batchSize = 200
-
-    # Path to filename to save the mean and variance to
-    file_path = "eval/saved_stats/res/scale_1_step_1/"
-
-    # Output filenames
-    mean_filenames = [
-        "fake_mean_50000s.npy",
-        "fake_mean_100000s.npy",
-        "fake_mean_150000s.npy",
-        "fake_mean_200000s.npy",
-        "fake_mean_250000s.npy",
-        "fake_mean_300000s.npy",
-        "fake_mean_350000s.npy",
-        "fake_mean_400000s.npy",
-        "fake_mean_450000s.npy",
-        "fake_mean_500000s.npy"
-    ]
-    var_filenames = [
-        "fake_var_50000s.npy",
-        "fake_var_100000s.npy",
-        "fake_var_150000s.npy",
-        "fake_var_200000s.npy",
-        "fake_var_250000s.npy",
-        "fake_var_300000s.npy",
-        "fake_var_350000s.npy",
-        "fake_var_400000s.npy",
-        "fake_var_450000s.npy",
-        "fake_var_500000s.npy"
-    ]
-
-    assert len(model_filenames) == len(model_params_filenames) ==\
-        len(gpu_nums) == len(mean_filenames) == len(var_filenames),\
-        "List lengths must be equal"
-
-
-    # Iterate over all data and start a thread
-    # for each of the statistical computations
-    for i in range(0, len(model_filenames)):
-        model_filename = model_filenames[i]
-        model_params_filename = model_params_filenames[i]
-        gpu_num = gpu_nums[i]
-        mean_filename = mean_filenames[i]
-        var_filename = var_filenames[i]
-
-        th = threading.Thread(
-            target=compute_model_stats,
-            args = (dir_name,
-                        model_filename,
-                        model_params_filename,
-                        "gpu",
-                        gpu_num,
-                        num_fake_imgs,
-                        batchSize,
-                        step_size,
-                        DDIM_scale,
-                        corrected,
-                        file_path,
-                        mean_filename,
-                        var_filename)
-        )
-        th.start()
+from concurrent.futures import as_completed
+import glob
+import time
+import csv
+import re
+import os
+
+from .compute_model_stats import load_model, load_inception, add_model_stats, worker, worker_pool
+from .compute_FID import load_reference
+from .feature_stats import FeatureStats
+
+
+
+# Get the filename of the metadata and the step of a checkpoint.
+# The metadata of a model (or EMA) file "model[_ema]_{epoch}e_{step}s.pkl"
+# is in "model_params_{epoch}e_{step}s.json".
+def checkpoint_info(model_filename):
+    suffix = re.search(r"((?:_\d+e)?(?:_\d+s)?)\.pkl$", model_filename).group(1)
+    step = re.search(r"_(\d+)s$", suffix)
+    return f"model_params{suffix}.json", int(step.group(1)) if step else None
+
+
+
+# Compute the statistics and FID of a checkpoint
+def run_checkpoint(dir_name, model_filename, step_size, DDIM_scale, corrected, num_fake_imgs, batchSize,
+                   seed, feature_dim, file_path, real_mean_file, real_var_file):
+    start = time.perf_counter()
+    model_params_filename, step = checkpoint_info(model_filename)
+
+    # Every checkpoint generates from the same noise for each image
+    model = load_model(dir_name, model_filename, model_params_filename, worker["device"], step_size, DDIM_scale)
+    stats = add_model_stats(model, worker["extractor"], FeatureStats(feature_dim), num_fake_imgs, batchSize, corrected, verbose=False, seed=seed)
+    del model
+
+    # Save the mean and variance of the checkpoint
+    # ("model_ema_40e_50000s.pkl" -> "fake_mean_ema_40e_50000s.npy")
+    name = os.path.splitext(model_filename)[0][len("model"):]
+    mean_file = f"{file_path}{os.sep}fake_mean{name}.npy"
+    var_file = f"{file_path}{os.sep}fake_var{name}.npy"
+    stats.save_stats(mean_file, var_file)
+
+    # Compute the FID against the reference statistics
+    fid = load_reference(real_mean_file, real_var_file).score(stats.mean, stats.cov())
+    return model_filename, step, fid, time.perf_counter() - start
+
+
+
+
+
+# Computes the statistics and FID of every checkpoint in a directory
+# matching a glob. Each worker process is bound to a device (or is one
+# of N CPU workers) and takes the next checkpoint from the queue when it
+# is done with its last one. The results are written to a CSV table
+# with the checkpoint, step, FID, and wall time of each checkpoint.
+# Outputs:
+#   List of (checkpoint, step, FID, wall time) rows sorted by step
+def compute_model_stats_multiple(
+        # Directory name to load in models and glob of the model
+        # files in it. The default doesn't match the EMA weights
+        # (model_ema_*.pkl), which are saved in the same directory.
+        dir_name = "models_res",
+        model_glob = "model_[0-9]*e_*s.pkl",
+
+        # Devices to run the workers on. With "gpu", there is one
+        # worker for each GPU number. With "cpu", there are
+        # num_cpu_workers workers which split the CPU threads.
+        device = "gpu",
+        gpu_nums = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
+        num_cpu_workers = 1,
+
+        # Diffusion parameters
+        step_size = 1,
+        DDIM_scale = 1,
+        corrected = True,
+
+        # Batch size, number of images to generate, and sampling seed
+        num_fake_imgs = 10000,
+        batchSize = 200,
+        seed = 0,
+
+        # Path to save the mean and variance of each model to
+        file_path = "eval/saved_stats/res/scale_1_step_1/",
+
+        # Reference statistics to compute the FID with
+        real_mean_file = "eval/saved_stats/real_mean.npy",
+        real_var_file = "eval/saved_stats/real_var.npy",
+
+        # File to write the results table to
+        results_file = "eval/saved_stats/res/scale_1_step_1/results.csv",
+
+        # Function which loads the feature extractor on a
+        # device and the number of features it outputs
+        load_extractor = load_inception,
+        feature_dim = 2048,
+    ):
+
+    # Checkpoints to evaluate
+    model_filenames = sorted(os.path.basename(f) for f in glob.glob(os.path.join(dir_name, model_glob)))
+    assert len(model_filenames) > 0, f"No checkpoints match {os.path.join(dir_name, model_glob)}"
+
+    # The feature extractor of a worker is loaded once and is
+    # shared by all the checkpoints the worker evaluates
+    results = []
+    with worker_pool(device, gpu_nums, num_cpu_workers, len(model_filenames), load_extractor) as pool:
+        jobs = [pool.submit(run_checkpoint, dir_name, model_filename, step_size, DDIM_scale, corrected, num_fake_imgs,
+                            batchSize, seed, feature_dim, file_path, real_mean_file, real_var_file)
+                for model_filename in model_filenames]
+        for job in as_completed(jobs):
+            results.append(job.result())
+            print(f"{results[-1][0]}: FID {results[-1][2]:.3f} ({results[-1][3]:.1f}s)")
+
+    # Write the results table
+    results.sort(key=lambda r: (r[1] is None, r[1], r[0]))
+    if os.path.dirname(results_file) != "":
+        os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["checkpoint", "step", "FID", "wall_time"])
+        writer.writerows(results)
+    return results
 
 
 
 if __name__ == "__main__":
-    compute_model_stats_multiple()
\ No newline at end of file
+    compute_model_stats_multiple()
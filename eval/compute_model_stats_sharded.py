@@ -0,0 +1,132 @@
+from concurrent.futures import as_completed
+import json
+import os
+
+from .compute_model_stats import load_inception, add_model_stats, worker, worker_pool
+from .feature_stats import FeatureStats
+
+
+
+# Generate the images of a shard and save their statistics
+# Inputs:
+#   shard - Index of the shard
+#   num_imgs - Number of images in the shard
+#   seed - Seed of the sampling job
+#   start_idx - Index of the first image of the shard
+#   batchSize, corrected - Generation parameters
+#   feature_dim - Number of features the extractor outputs
+#   shard_file - File to save the statistics of the shard to
+def run_shard(shard, num_imgs, seed, start_idx, batchSize, corrected, feature_dim, shard_file):
+    # Every image is seeded by its index in the job, so the images of a
+    # shard don't depend on which worker made them, when, or the batch size
+    stats = add_model_stats(worker["model"], worker["extractor"], FeatureStats(feature_dim), num_imgs, batchSize, corrected, verbose=False, seed=seed, start_idx=start_idx)
+    stats.save(shard_file)
+    return shard
+
+
+
+
+
+# Computes the mean and variance of the given model for its
+# FID scores like compute_model_stats, but splits the images
+# into seeded shards which are generated by a pool of worker
+# processes. The statistics of each shard are saved as soon as
+# the shard is done, so a job that dies can be run again and
+# only the missing shards are generated.
+# Outputs:
+#   List of the shards that were generated by this run
+def compute_model_stats_sharded(
+        # Load name parameters
+        model_dirname="models_res",
+        model_filename = "model_152e_190000s.pkl",
+        model_params_filename = "model_params_152e_190000s.json",
+
+        # Devices to run the workers on. With "gpu", there is one
+        # worker for each GPU number. With "cpu", there are
+        # num_cpu_workers workers which split the CPU threads.
+        device = "gpu",
+        gpu_nums = [0],
+        num_cpu_workers = 1,
+
+        # Number of images to generate, images in each shard,
+        # batch size, and seed of the shards
+        num_fake_imgs = 10000,
+        shard_size = 1000,
+        batchSize = 200,
+        seed = 0,
+
+        # Generation step size, DDIM scale, correct output?
+        step_size = 1,
+        DDIM_scale = 1,
+        corrected = True,
+
+        # Filenames for outputs. The statistics of each
+        # shard are saved in shard_dir.
+        file_path = "eval/saved_stats/",
+        mean_filename = "fake_mean_190K.npy",
+        var_filename = "fake_var_190K.npy",
+        shard_dir = "eval/saved_stats/shards_190K/",
+
+        # Function which loads the feature extractor on a
+        # device and the number of features it outputs
+        load_extractor = load_inception,
+        feature_dim = 2048,
+    ):
+
+
+    # Split the images into shards
+    num_shards = (num_fake_imgs + shard_size - 1)//shard_size
+    shard_sizes = [min(shard_size, num_fake_imgs - i*shard_size) for i in range(num_shards)]
+    shard_files = [os.path.join(shard_dir, f"shard_{i:05d}.npz") for i in range(num_shards)]
+
+    # The shards of a directory must all come from the same job
+    config = {
+        "model_dirname": model_dirname,
+        "model_filename": model_filename,
+        "model_params_filename": model_params_filename,
+        "num_fake_imgs": num_fake_imgs,
+        "shard_size": shard_size,
+        "seed": seed,
+        "step_size": step_size,
+        "DDIM_scale": DDIM_scale,
+        "corrected": corrected,
+        "feature_dim": feature_dim,
+    }
+    os.makedirs(shard_dir, exist_ok=True)
+    config_file = os.path.join(shard_dir, "config.json")
+    if os.path.exists(config_file):
+        with open(config_file, "r") as f:
+            assert json.load(f) == config, f"{shard_dir} has shards of a different job. Use a new shard_dir."
+    else:
+        with open(config_file, "w") as f:
+            json.dump(config, f)
+
+    # Shards which weren't finished by a previous run
+    missing = [i for i in range(num_shards) if not os.path.exists(shard_files[i])]
+    print(f"{num_shards-len(missing)}/{num_shards} shards done, generating {len(missing)}")
+
+    if len(missing) > 0:
+        # Each worker loads the model and the feature extractor once
+        model_files = (model_dirname, model_filename, model_params_filename)
+        with worker_pool(device, gpu_nums, num_cpu_workers, len(missing), load_extractor,
+                (model_files, step_size, DDIM_scale)) as pool:
+            jobs = [pool.submit(run_shard, i, shard_sizes[i], seed, i*shard_size, batchSize, corrected, feature_dim, shard_files[i]) for i in missing]
+            for job in as_completed(jobs):
+                print(f"Shard {job.result()} done")
+
+    # Merge the statistics of all shards
+    stats = FeatureStats(feature_dim)
+    for shard_file in shard_files:
+        stats.merge(FeatureStats.load(shard_file))
+
+    # Save the mean and variance of the generated images
+    stats.save_stats(f"{file_path}{os.sep}{mean_filename}", f"{file_path}{os.sep}{var_filename}")
+    return missing
+
+
+
+
+
+
+if __name__ == "__main__":
+    compute_model_stats_sharded()
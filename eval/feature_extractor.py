@@ -0,0 +1,109 @@
+import torch
+from torch import nn
+import torchvision
+import os
+
+
+
+
+
+# Directory the weights and exported extractors are cached in
+cache_dir = "eval/saved_models/"
+
+
+
+# Feature extractors by name. Each builder takes the cache
+# directory and returns the network with its weights loaded.
+extractors = {}
+
+# Add a feature extractor to the registry, like a small
+# local stand-in network for testing
+# Inputs:
+#   name - Name of the extractor
+#   builder - Function which takes the cache directory
+#             and returns the extractor network
+def register_extractor(name, builder):
+    extractors[name] = builder
+
+
+
+
+
+# Load the pretrained InceptionV3 weights from inception_v3.pth in the
+# cache directory. If that file doesn't exist, the weights are downloaded
+# once and saved there, so later runs don't need the network.
+def inception_weights(cache_dir):
+    weights_file = os.path.join(cache_dir, "inception_v3.pth")
+    if not os.path.exists(weights_file):
+        state_dict = torchvision.models.Inception_V3_Weights.DEFAULT.get_state_dict(progress=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(state_dict, weights_file)
+    return torch.load(weights_file, map_location="cpu")
+
+
+
+# Build InceptionV3 up to its pool3 features. The network is made without
+# the auxiliary classifier and without the random initialization of the
+# weights, which are overwritten anyways.
+def build_inception(cache_dir):
+    state_dict = inception_weights(cache_dir)
+
+    # The pretrained weights expect the inputs to be transformed
+    # from the ImageNet normalization to the one they were trained with
+    inceptionV3 = torchvision.models.Inception3(aux_logits=False, transform_input=True, init_weights=False)
+    inceptionV3.load_state_dict({k: v for k, v in state_dict.items() if not k.startswith("AuxLogits")})
+
+    # Remove the fully connected output layer
+    inceptionV3.fc = nn.Identity()
+    return inceptionV3
+
+register_extractor("inception", build_inception)
+
+
+
+# Load the fully connected output layer of InceptionV3, which maps the
+# pool3 features to the class logits (used for the Inception Score)
+# Inputs:
+#   device - Device to load the layer on
+#   cache_dir - Directory of the cached weights
+def load_inception_head(device="cpu", cache_dir=cache_dir):
+    state_dict = inception_weights(cache_dir)
+    fc = nn.Linear(state_dict["fc.weight"].shape[1], state_dict["fc.weight"].shape[0])
+    fc.load_state_dict({"weight": state_dict["fc.weight"], "bias": state_dict["fc.bias"]})
+    fc.requires_grad_(False)
+    return fc.to(device)
+
+
+
+
+
+# Load a frozen feature extractor. With script=True, the extractor is
+# exported with TorchScript to {name}_features.pt in the cache directory
+# the first time it's loaded, and later loads only read that file, which
+# is much faster than building the network.
+# Inputs:
+#   name - Name of the extractor in the registry
+#   device - Device to load the extractor on
+#   script - True to use the exported TorchScript extractor
+#   cache_dir - Directory of the cached weights and exported extractors
+#   input_size - Size of the images the extractor is exported with
+def load_feature_extractor(name="inception", device="cpu", script=True, cache_dir=cache_dir, input_size=299):
+    script_file = os.path.join(cache_dir, f"{name}_features.pt")
+    if script and os.path.exists(script_file):
+        return torch.jit.load(script_file, map_location=device)
+
+    # Build the extractor and freeze it
+    net = extractors[name](cache_dir)
+    net.eval()
+    for p in net.parameters():
+        p.requires_grad_(False)
+
+    # Export it for the next loads
+    if script:
+        net = torch.jit.freeze(torch.jit.trace(net, torch.zeros(1, 3, input_size, input_size)))
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = script_file + ".tmp"
+        torch.jit.save(net, tmp)
+        os.replace(tmp, script_file)
+        return torch.jit.load(script_file, map_location=device)
+    return net.to(device)
@@ -0,0 +1,154 @@
+import numpy as np
+import os
+
+
+
+
+
+# Streaming mean and covariance of feature vectors. Batches are merged
+# into a running float64 mean and sum of squared deviations from the
+# mean (Chan et al.'s parallel form of Welford's algorithm), so the raw
+# features are never stored and memory is constant in the number of
+# samples. Accumulators from different batches, workers, or processes
+# can be merged, giving the same statistics as one pass over all the
+# features.
+class FeatureStats():
+    # dim - Number of features in each vector
+    def __init__(self, dim=2048):
+        self.dim = dim
+        self.count = 0
+        self.mean = np.zeros(dim, dtype=np.float64)
+        self.M2 = np.zeros((dim, dim), dtype=np.float64)
+
+
+    # Add a batch of features to the statistics
+    # Inputs:
+    #   feats - Array or tensor of features of shape (N, dim)
+    def update(self, feats):
+        if hasattr(feats, "detach"):
+            feats = feats.detach().cpu().numpy()
+        feats = np.asarray(feats, dtype=np.float64).reshape(-1, self.dim)
+        n = feats.shape[0]
+        if n == 0:
+            return self
+
+        # Mean and squared deviations of the batch
+        mean = feats.mean(0)
+        centered = feats - mean
+        self.combine(n, mean, centered.T @ centered)
+        return self
+
+
+    # Merge another accumulator into this one
+    # Inputs:
+    #   other - FeatureStats to merge
+    def merge(self, other):
+        assert other.dim == self.dim, "Feature dimensions must match"
+        if other.count > 0:
+            self.combine(other.count, other.mean, other.M2)
+        return self
+
+
+    # Combine the statistics of a group of n features
+    # with mean and squared deviations M2
+    def combine(self, n, mean, M2):
+        total = self.count + n
+        delta = mean - self.mean
+        self.M2 += M2 + np.outer(delta, delta)*(self.count*n/total)
+        self.mean += delta*(n/total)
+        self.count = total
+
+
+    # Get the covariance of the features
+    # Inputs:
+    #   ddof - Delta degrees of freedom. 1 matches np.cov.
+    def cov(self, ddof=1):
+        assert self.count > ddof, "Not enough features to compute the covariance"
+        return self.M2/(self.count - ddof)
+
+
+    # Save the mean and covariance to the .npy files used by compute_FID
+    # Inputs:
+    #   mean_file - File to save the mean to
+    #   var_file - File to save the covariance to
+    def save_stats(self, mean_file, var_file):
+        for f in [mean_file, var_file]:
+            if os.path.dirname(f) != "":
+                os.makedirs(os.path.dirname(f), exist_ok=True)
+        np.save(mean_file, self.mean)
+        np.save(var_file, self.cov())
+
+
+    # Save the full state of the accumulator so it can be merged later
+    # Inputs:
+    #   filename - .npz file to save the state to
+    def save(self, filename):
+        if os.path.dirname(filename) != "":
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        # Write to a temporary file first so a crash never
+        # leaves a partially written state behind
+        tmp = filename + ".tmp.npz"
+        np.savez(tmp, count=self.count, mean=self.mean, M2=self.M2)
+        os.replace(tmp, filename)
+
+
+    # Load the state of an accumulator saved with save
+    # Inputs:
+    #   filename - .npz file to load the state from
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        stats = FeatureStats(data["mean"].shape[0])
+        stats.count = int(data["count"])
+        stats.mean = data["mean"].astype(np.float64)
+        stats.M2 = data["M2"].astype(np.float64)
+        return stats
+
+
+
+
+
+# On-disk cache of the raw features as a .npy memmap, so metrics which
+# need the features themselves (and not only their statistics) can be
+# computed later without generating the images again. The features are
+# written to a temporary file which is only renamed to the filename
+# when all num rows are written, so an incomplete file is never read.
+class FeatureCache():
+    # filename - .npy file to save the features to
+    # num - Number of feature vectors that will be added
+    # dim - Number of features in each vector
+    def __init__(self, filename, num, dim=2048):
+        if os.path.dirname(filename) != "":
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.filename = filename
+        self.tmp = filename + ".tmp.npy"
+        self.num = num
+        self.dim = dim
+        self.feats = np.lib.format.open_memmap(self.tmp, mode="w+", dtype=np.float32, shape=(num, dim))
+        self.count = 0
+
+
+    # Add a batch of features to the cache
+    # Inputs:
+    #   feats - Array or tensor of features of shape (N, dim)
+    def update(self, feats):
+        if hasattr(feats, "detach"):
+            feats = feats.detach().cpu().numpy()
+        feats = np.asarray(feats).reshape(-1, self.dim)
+        assert self.count + feats.shape[0] <= self.num, "More features than the cache was made for"
+        self.feats[self.count:self.count+feats.shape[0]] = feats
+        self.count += feats.shape[0]
+        if self.count == self.num:
+            self.feats.flush()
+            del self.feats
+            os.replace(self.tmp, self.filename)
+        return self
+
+
+    # Load the features of a cache as a read only memmap
+    # Inputs:
+    #   filename - .npy file of the features
+    @staticmethod
+    def load(filename):
+        return np.load(filename, mmap_mode="r")
@@ -0,0 +1,197 @@
+import torch
+import numpy as np
+import itertools
+import time
+import csv
+import os
+
+from src.models.Variance_Scheduler import DDIM_Scheduler
+from .compute_model_stats import load_model, load_inception, normalize
+from .compute_FID import load_reference
+from .compute_metrics import KID
+from .feature_stats import FeatureStats, FeatureCache
+
+
+
+
+
+# Use a different sampler in a loaded model
+def set_sampler(model, step_size, DDIM_scale):
+    model.step_size = step_size
+    model.DDIM_scale = DDIM_scale
+    model.scheduler = DDIM_Scheduler(model.beta_sched, model.T, step_size, model.device)
+
+
+
+# Generate images with the current sampler of the model and get their features
+# Inputs:
+#   model - Diffusion model to generate images with
+#   extractor - Network to get the features of the images with
+#   num_imgs - Number of images to generate
+#   batchSize - Number of images to generate at once
+#   corrected - True to put a limit on generation
+#   w - Classifier-free guidance scale. With w > 0, each batch
+#       is generated with a random class.
+# Outputs:
+#   Features of shape (num_imgs, D), seconds spent generating,
+#   and number of network evaluations of each image
+@torch.no_grad()
+def generate_features(model, extractor, num_imgs, batchSize, corrected, w):
+    # Count the calls of the U-net for the number of network evaluations
+    num_calls = [0]
+    hook = model.unet.register_forward_hook(lambda *args: num_calls.__setitem__(0, num_calls[0]+1))
+
+    feats = []
+    gen_time = 0
+    num_batches = 0
+    try:
+        for i in range(0, num_imgs, batchSize):
+            class_label = -1 if w == 0 else int(torch.randint(model.num_classes, ()))
+
+            # Only the generation is timed
+            if model.device.type == "cuda":
+                torch.cuda.synchronize(model.device)
+            start = time.perf_counter()
+            imgs = model.sample_imgs(min(batchSize, num_imgs-i), class_label, w, unreduce=True, corrected=corrected)
+            if model.device.type == "cuda":
+                torch.cuda.synchronize(model.device)
+            gen_time += time.perf_counter() - start
+            num_batches += 1
+
+            feats.append(extractor(normalize(imgs.to(torch.uint8))).cpu().numpy())
+    finally:
+        hook.remove()
+    return np.concatenate(feats), gen_time, num_calls[0]/max(num_batches, 1)
+
+
+
+# Whether a result is dominated by another one, which has a lower FID
+# (by more than the relative margin) and takes at most as long per image
+def dominated(r, results, margin=0.0):
+    return any(o is not r and o["FID"]*(1+margin) < r["FID"] and o["sec_per_img"] <= r["sec_per_img"] for o in results)
+
+
+
+
+
+# Evaluates a grid of sampler settings for one checkpoint and records the
+# wall time per image, network evaluations per image, FID, and KID of each
+# one. All settings are first evaluated on the first (small) budget of
+# images. After each budget, settings which are dominated by another one
+# by more than prune_margin (worse FID while not faster) are stopped, and
+# the rest get more images up to the next budget. The FIDs of settings are
+# only compared at the same budget, as the FID depends on the number of
+# images. The results are written to a CSV file along with whether each
+# setting is on the Pareto frontier of time per image and FID.
+# Outputs:
+#   List of the results of each setting
+def sweep_sampler(
+        # Load name parameters
+        model_dirname = "models_res",
+        model_filename = "model_152e_190000s.pkl",
+        model_params_filename = "model_params_152e_190000s.json",
+
+        # Device to load in
+        device = "gpu",
+        gpu_num = 0,
+
+        # Grid of sampler settings
+        step_sizes = [1, 2, 4, 10, 20],
+        DDIM_scales = [0, 1],
+        correcteds = [True],
+        ws = [0.0],
+
+        # Increasing numbers of images to evaluate the settings with
+        # and the relative FID margin to stop a setting with
+        budgets = [1000, 2500, 5000, 10000],
+        prune_margin = 0.1,
+        batchSize = 200,
+        seed = 0,
+
+        # Cached reference statistics (see compute_imagenet_stats) and
+        # (optionally) reference features for the KID
+        real_mean_file = "eval/saved_stats/real_mean.npy",
+        real_var_file = "eval/saved_stats/real_var.npy",
+        real_features_file = None,
+
+        # File to write the results table to
+        results_file = "eval/saved_stats/sweep.csv",
+
+        # Function which loads the feature extractor on a device
+        load_extractor = load_inception,
+    ):
+
+    # Get the device
+    if device == "gpu":
+        device = torch.device(f"cuda:{gpu_num}")
+    else:
+        device = torch.device(f"cpu")
+
+    model = load_model(model_dirname, model_filename, model_params_filename, device, 1, 1)
+    extractor = load_extractor(device)
+    reference = load_reference(real_mean_file, real_var_file)
+    real_feats = FeatureCache.load(real_features_file) if real_features_file else None
+
+    # Results of each setting
+    results = [dict(step_size=s, DDIM_scale=d, corrected=c, w=w, num_imgs=0, nfe_per_img=0.0, gen_time=0.0)
+               for s, d, c, w in itertools.product(step_sizes, DDIM_scales, correcteds, ws)]
+    stats = [None for _ in results]
+    feats = [[] for _ in results]
+    alive = list(range(len(results)))
+
+    for level, budget in enumerate(budgets):
+        for i in alive:
+            r = results[i]
+            set_sampler(model, r["step_size"], r["DDIM_scale"])
+
+            # Each setting and budget has its own seed
+            torch.manual_seed(int(np.random.SeedSequence([seed, i, level]).generate_state(1)[0]))
+            f, gen_time, nfe = generate_features(model, extractor, budget - r["num_imgs"], batchSize, r["corrected"], r["w"])
+            stats[i] = (stats[i] or FeatureStats(f.shape[1])).update(f)
+            if real_feats is not None:
+                feats[i].append(f)
+            r["gen_time"] += gen_time
+            r["num_imgs"] = budget
+            r["nfe_per_img"] = nfe
+            r["sec_per_img"] = r["gen_time"]/budget
+
+            r["FID"] = reference.score(stats[i].mean, stats[i].cov())
+            print(f"step_size={r['step_size']} DDIM_scale={r['DDIM_scale']} corrected={r['corrected']} w={r['w']} "
+                  f"imgs={budget}: FID {r['FID']:.3f}, {r['sec_per_img']:.3f}s/img, {nfe:.0f} NFE/img")
+
+        # Stop the dominated settings, except after the last budget
+        if level < len(budgets)-1:
+            alive = [i for i in alive if not dominated(results[i], [results[j] for j in alive], prune_margin)]
+
+    # KID of each setting on all its images. The features of the
+    # settings are only kept in memory when this is computed.
+    for r, f in zip(results, feats):
+        r["KID"] = KID(real_feats, np.concatenate(f), seed=seed)[0] if real_feats is not None else float("nan")
+
+    # Pareto frontier of the settings which got the full budget
+    final = [results[i] for i in alive]
+    for r in results:
+        r["pareto"] = any(r is o for o in final) and not dominated(r, final)
+
+    # Write the results table
+    columns = ["step_size", "DDIM_scale", "corrected", "w", "num_imgs", "nfe_per_img", "sec_per_img", "FID", "KID", "pareto"]
+    if os.path.dirname(results_file) != "":
+        os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows([[r[c] for c in columns] for r in results])
+
+    # Report the Pareto frontier from fastest to slowest
+    print("Pareto frontier:")
+    for r in sorted((r for r in results if r["pareto"]), key=lambda r: r["sec_per_img"]):
+        print(f"  step_size={r['step_size']} DDIM_scale={r['DDIM_scale']} corrected={r['corrected']} w={r['w']}: "
+              f"FID {r['FID']:.3f}, KID {r['KID']:.4f}, {r['sec_per_img']:.3f}s/img, {r['nfe_per_img']:.0f} NFE/img")
+    return results
+
+
+
+
+
+if __name__ == "__main__":
+    sweep_sampler()
@@ -1,4 +1,5 @@
 from torch import nn
+import torch.nn.functional as F
 import math
 
 
@@ -26,12 +27,10 @@ class Efficient_Channel_Attention(nn.Module):
         # not using Conv1d as it causes a warning message
         # "Grad strides do not match bucket view strides"
         # which I couldn't fix, but changing it to a conv2d
-        # is the same operation, but doesn't cause the warning
+        # is the same operation, but doesn't cause the warning.
+        # The forward pass uses the weight as a 1-D kernel.
         self.conv = nn.Conv2d(1, 1, [1, k], padding=[0, k//2], bias=False)
-
-        # Pooling and sigmoid functions
-        self.avgPool = nn.AdaptiveAvgPool2d(1)
-        self.sigmoid = nn.Sigmoid()
+        self.k = k
 
 
 
@@ -41,20 +40,18 @@ class Efficient_Channel_Attention(nn.Module):
     # Outputs:
     #   Image tensor of shape (N, C, L, W)
     def forward(self, X):
-        # Pool the input tensor to a (N, C, 1, 1) tensor
-        att = self.avgPool(X)
-
-        # Reshape the input tensor to be of shape (N, 1, 1, C)
-        att = att.permute(0, 2, 3, 1)
-
-        # Compute the channel attention
-        att = self.conv(att)
+        N, C = X.shape[:2]
 
-        # Apply the sigmoid function to the channel attention
-        att = self.sigmoid(att)
+        # Pool the input tensor to a (N, 1, C) tensor. The mean
+        # works on both the channels first and last formats.
+        att = X.mean((2, 3)).unsqueeze(1)
 
-        # Reshape the input tensor to be of shape (N, C, 1, 1)
-        att = att.permute(0, 3, 1, 2)
+        # Compute the channel attention with the conv weight as
+        # a 1-D kernel over the channels and apply the sigmoid
+        # function in place (its output is all it needs for the
+        # backward pass)
+        att = F.conv1d(att, self.conv.weight.view(1, 1, self.k), padding=self.k//2).sigmoid_()
 
-        # Scale the input by the attention
-        return X * att.expand_as(X)
\ No newline at end of file
+        # Scale the input by the attention of shape (N, C, 1, 1).
+        # The input isn't changed as it may still be needed.
+        return X * att.view(N, C, 1, 1)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+import math
 
 
 
@@ -9,17 +10,49 @@ from torch import nn
 class Multihead_Attn(nn.Module):
     # Inputs:
     #   inCh - Number of input channels
-    #   num_heads - Number of heads in the attention mechanism
+    #   num_heads - Number of heads in the attention mechanism. The channels
+    #               are split evenly between the heads. Heads are used along
+    #               with the patches, so each head attends within each patch.
+    #   head_dim - (optional) Number of channels in each head. If given,
+    #              num_heads is inCh//head_dim instead.
     #   resolution - Downsampled resolution of the input image
     #               in the spatial dimension
     #   spatial - Should spatial or channel attion be used. Spatial attention
     #             finds relationships between spatial tokens in the QK matrix,
     #             channel attention find relatipships between the channels
-    def __init__(self, inCh, num_heads=2, resolution=16, spatial=False):
+    #   use_sdpa - True to use the fused attention kernels (flash/memory-efficient)
+    #              in torch.nn.functional.scaled_dot_product_attention for spatial
+    #              attention when available. These don't store the (LW, LW) attention
+    #              matrix. False to always use the einsum implementation.
+    #   window - True to split the image into non-overlapping windows of size
+    #            resolution x resolution (Swin-style) instead of the patches. The
+    #            memory used by the attention scales linearly with the image size.
+    #            Only used for spatial attention.
+    #   shift - True to shift the windows by half a window before attending so
+    #           that information is mixed between the windows of the previous
+    #           block. Tokens which are wrapped around the image by the shift are
+    #           masked so they only attend to tokens they are next to.
+    #           Only used if window is True.
+    #   num_global - Size of the grid of global tokens. The image is pooled into
+    #                num_global x num_global tokens which are added to the keys and
+    #                values of every window so each window can see the whole image.
+    #                Use 0 for no global tokens. Only used if window is True.
+    def __init__(self, inCh, num_heads=1, resolution=16, spatial=False, use_sdpa=True, head_dim=None, window=False, shift=False, num_global=0):
         super(Multihead_Attn, self).__init__()
+        if head_dim is not None:
+            num_heads = max(inCh//head_dim, 1)
+        assert inCh % num_heads == 0, f"Number of channels ({inCh}) must be divisible by the number of heads ({num_heads})"
+        assert spatial or not window, "Windowed attention can only be used with spatial attention"
         self.inCh = inCh
         self.num_heads = num_heads
         self.resolution = resolution
+        self.use_sdpa = use_sdpa and hasattr(nn.functional, "scaled_dot_product_attention")
+        self.window = window
+        self.shift = shift and window
+        self.num_global = num_global if window else 0
+
+        # Attention masks for the shifted windows for each image size
+        self.masks = {}
         
         # Used to get all the queries, keys, and values
         self.KQV_weight = nn.Conv2d(inCh, inCh*3, 1)
@@ -41,24 +74,25 @@ class Multihead_Attn(nn.Module):
 
         self.softmax = nn.Softmax(-1)
         
-    # Given a tensor, the tensor is extended to multiple heads
+    # Given a tensor of patches, the channels are split into multiple
+    # heads which are stacked with the patches
     # Inputs:
-    #   X - tensor of shape (N, inCh, LW)
+    #   X - tensor of shape (N, P, inCh, LW)
     # Outputs:
-    #   Tensor of shape (N, H, inCh/H, LW)
+    #   Tensor of shape (N, P*H, inCh/H, LW)
     def add_heads(self, X):
         X_shape = X.shape
-        return X.reshape(X_shape[0], self.num_heads, X_shape[1]//self.num_heads, *X_shape[2:])
+        return X.reshape(X_shape[0], X_shape[1]*self.num_heads, X_shape[2]//self.num_heads, X_shape[3])
     
     
     # Given a tensor, the tensor is contracted to remove the heads
     # Inputs:
-    #   X - tensor of shape (N, H, inCh/H, LW)
+    #   X - tensor of shape (N, P*H, inCh/H, LW)
     # Outputs:
-    #   Tensor of shape (N, inCh, LW)
+    #   Tensor of shape (N, P, inCh, LW)
     def remove_heads(self, X):
         X_shape = X.shape
-        return X.reshape(X_shape[0], X_shape[1]*X_shape[2], *X_shape[3:])
+        return X.reshape(X_shape[0], X_shape[1]//self.num_heads, X_shape[2]*self.num_heads, X_shape[3])
     
 
 
@@ -90,74 +124,205 @@ class Multihead_Attn(nn.Module):
 
         return X.reshape(X.shape[0], X.shape[2], L, W)
 
+
+    # Given a tensor, split it into windows
+    # Inputs:
+    #   X - Tensor of shape (N, inCh, L, W)
+    #   r_L, r_W - Size of the windows
+    # Outputs:
+    #   Tensor of shape (N, (LW/(r_L*r_W)), inCh, r_L*r_W)
+    def create_windows(self, X, r_L, r_W):
+        N, C, L, W = X.shape
+        return X.reshape(N, C, L//r_L, r_L, W//r_W, r_W).\
+            permute(0, 2, 4, 1, 3, 5).reshape(N, -1, C, r_L*r_W)
+
+
+    # Given a tensor with windows, merge the windows
+    # Inputs:
+    #   X - Tensor of shape (N, (LW/(r_L*r_W)), inCh, r_L*r_W)
+    #   L, W - Size of the image
+    #   r_L, r_W - Size of the windows
+    #   channels_last - True to return a channels last tensor
+    # Outputs:
+    #   Tensor of shape (N, inCh, L, W)
+    def remove_windows(self, X, L, W, r_L, r_W, channels_last=False):
+        N, _, C, _ = X.shape
+        X = X.reshape(N, L//r_L, W//r_W, C, r_L, r_W)
+        if channels_last:
+            # Merge straight into a (N, L, W, inCh) tensor
+            return X.permute(0, 1, 4, 2, 5, 3).reshape(N, L, W, C).permute(0, 3, 1, 2)
+        return X.permute(0, 3, 1, 4, 2, 5).reshape(N, C, L, W)
+
+
+    # Get the attention mask for the shifted windows. After the cyclic
+    # shift, a window can have tokens from up to four regions of the
+    # image which are not next to each other. Tokens can only attend
+    # to tokens in the same region and to the global tokens.
+    # Inputs:
+    #   L, W - Size of the image
+    #   r_L, r_W - Size of the windows
+    #   shift - Number of pixels the image is shifted by
+    #   dtype, device - Type and device of the mask
+    # Outputs:
+    #   Additive mask of shape (P*H, r_L*r_W, r_L*r_W + num_global**2)
+    #   with -inf where a query cannot attend to a key
+    def get_mask(self, L, W, r_L, r_W, shift, dtype, device):
+        key = (L, W, dtype, device)
+        if key not in self.masks:
+            # Label each region of the shifted image
+            regions = torch.zeros(1, 1, L, W, device=device)
+            cnt = 0
+            for l in (slice(0, -r_L), slice(-r_L, -shift), slice(-shift, None)):
+                for w in (slice(0, -r_W), slice(-r_W, -shift), slice(-shift, None)):
+                    regions[:, :, l, w] = cnt
+                    cnt += 1
+            regions = self.create_windows(regions, r_L, r_W)[0, :, 0]
+
+            # Mask the tokens in different regions
+            mask = regions.unsqueeze(-1) != regions.unsqueeze(-2)
+            mask = nn.functional.pad(mask, (0, self.num_global**2), value=False)
+            self.masks[key] = torch.zeros(mask.shape, dtype=dtype, device=device)\
+                .masked_fill(mask, float("-inf"))\
+                .repeat_interleave(self.num_heads, 0)
+        return self.masks[key]
+
         
     # Inputs:
     #   X - tensor of shape (N, inCh, L, W)
     # Outputs:
     #   Tensor of shape (N, inCh, L, W)
     def forward(self, X):
-        # Saved input dims
+        # Saved input dims and memory format
         L = X.shape[-2]
         W = X.shape[-1]
+        channels_last = not X.is_contiguous() and X.is_contiguous(memory_format=torch.channels_last)
 
-        # Get the residual
-        res = X.clone()
+        # Get the residual. X is not changed in place,
+        # so it doesn't have to be cloned
+        res = X
 
         # Normalize the input
         X = self.LN(X)
 
+        mask = None
+        if self.window:
+            # The window is the whole image if the image is smaller than the window
+            r_L = min(self.resolution, L)
+            r_W = min(self.resolution, W)
+            assert L % r_L == 0 and W % r_W == 0, f"Image size ({L}, {W}) must be divisible by the window size ({r_L}, {r_W})"
+
+            # Global tokens. The image is pooled before the 1x1 convolution
+            # which is the same as pooling the keys and values
+            # (N, inCh, L, W) -> (N, inCh, g, g) -> (N, 1, inCh, g**2)
+            if self.num_global > 0:
+                G_K, _, G_V = self.KQV_weight(
+                    nn.functional.adaptive_avg_pool2d(X, self.num_global)
+                ).flatten(start_dim=-2).unsqueeze(1).chunk(3, dim=2)
+
+            # Shift the image so the windows cover the edges of the
+            # windows in the previous block
+            shift = self.resolution//2 if self.shift and r_L < L and r_W < W else 0
+            if shift > 0:
+                X = torch.roll(X, (-shift, -shift), (2, 3))
+                mask = self.get_mask(L, W, r_L, r_W, shift, X.dtype, X.device)
+
         # Get the keys, queries and values
-        KQV = self.KQV_weight(X)
-        K, Q, V = KQV[:, :self.inCh],\
-            KQV[:, self.inCh:self.inCh*2], KQV[:, self.inCh*2:]
-        
-        # Add heads by splitting the image into patches
-        # (N, inCh, L, W) -> (N, (LW/res**2), inCh, L/res, W/res)
-        K = self.create_patches(K)
-        Q = self.create_patches(Q)
-        V = self.create_patches(V)
-
-        # Flatten the keys, queries, and values
-        # (N, H, inCh, L/res, W/res) -> (N, H, inCh, LW)
-        K = K.flatten(start_dim=-2)
-        Q = Q.flatten(start_dim=-2)
-        V = V.flatten(start_dim=-2)
+        K, Q, V = self.KQV_weight(X).chunk(3, dim=1)
         
+        if self.window:
+            # Split the image into windows
+            # (N, inCh, L, W) -> (N, P, inCh, r_L*r_W)
+            K = self.create_windows(K, r_L, r_W)
+            Q = self.create_windows(Q, r_L, r_W)
+            V = self.create_windows(V, r_L, r_W)
 
-
-        # Multiply the queries and keys
-        # if spatial:
-        #   (N, H, inCh, LW) * (N, H, inCh, LW) -> (N, H, LW, LW)
-        # if channel:
-        #   (N, H, inCh, LW) * (N, H, inCh, LW) -> (N, H, inCh, inCh)
-        if self.spatial == True:
-            Out = torch.einsum("nhcd, nhce -> nhde", Q, K)
+            # Add the global tokens to the keys and values of each window
+            # (N, P, inCh, r_L*r_W) -> (N, P, inCh, r_L*r_W + g**2)
+            if self.num_global > 0:
+                K = torch.cat((K, G_K.expand(-1, K.shape[1], -1, -1)), dim=-1)
+                V = torch.cat((V, G_V.expand(-1, V.shape[1], -1, -1)), dim=-1)
         else:
-            Out = torch.einsum("nhcd, nhed -> nhce", Q, K)
+            # Add heads by splitting the image into patches
+            # (N, inCh, L, W) -> (N, (LW/res**2), inCh, L/res, W/res)
+            K = self.create_patches(K)
+            Q = self.create_patches(Q)
+            V = self.create_patches(V)
 
-        # Normalize
-        Out = self.softmax(Out*self.norm_factor)
+            # Flatten the keys, queries, and values
+            # (N, H, inCh, L/res, W/res) -> (N, H, inCh, LW)
+            K = K.flatten(start_dim=-2)
+            Q = Q.flatten(start_dim=-2)
+            V = V.flatten(start_dim=-2)
+
+        # Split the channels into heads
+        # (N, P, inCh, LW) -> (N, P*H, inCh/H, LW)
+        K = self.add_heads(K)
+        Q = self.add_heads(Q)
+        V = self.add_heads(V)
         
-        # Multiply the output matrix by the values matrix
-        # if spatial:
-        #   (N, H, LW, LW) * (N, H, inCh, LW) -> (N, H, inCh, LW)
-        # if channel:
-        #   (N, H, inCh, LW) * (N, H, inCh, LW) -> (N, H, inCh, LW)
-        if self.spatial == True:
-            Out = torch.einsum("nhde, nhce -> nhcd", Out, V)
+
+
+        # Spatial attention with the fused kernels. The tokens
+        # are the spatial positions and the features are the channels
+        #   (N, H, inCh/H, LW) -> (N, H, LW, inCh/H) -> (N, H, inCh/H, LW)
+        if self.spatial == True and self.use_sdpa:
+            # The kernel scales by 1/sqrt(inCh/H), so the queries are
+            # rescaled to use the norm factor of this block instead
+            scale = float(self.norm_factor)*math.sqrt(Q.shape[2])
+            Out = nn.functional.scaled_dot_product_attention(
+                Q.transpose(-1, -2)*scale, K.transpose(-1, -2), V.transpose(-1, -2),
+                attn_mask=mask
+            ).transpose(-1, -2)
         else:
-            Out = torch.einsum("nhce, nhfd -> nhcd", Out, V)
+            # Multiply the queries and keys
+            # if spatial:
+            #   (N, H, inCh, LW) * (N, H, inCh, LW) -> (N, H, LW, LW)
+            # if channel:
+            #   (N, H, inCh, LW) * (N, H, inCh, LW) -> (N, H, inCh, inCh)
+            if self.spatial == True:
+                Out = torch.einsum("nhcd, nhce -> nhde", Q, K)
+            else:
+                Out = torch.einsum("nhcd, nhed -> nhce", Q, K)
+
+            # Normalize
+            Out = Out*self.norm_factor
+            if mask is not None:
+                Out = Out + mask
+            Out = self.softmax(Out)
+            
+            # Multiply the output matrix by the values matrix
+            # if spatial:
+            #   (N, H, LW, LW) * (N, H, inCh, LW) -> (N, H, inCh, LW)
+            # if channel:
+            #   (N, H, inCh, LW) * (N, H, inCh, LW) -> (N, H, inCh, LW)
+            if self.spatial == True:
+                Out = torch.einsum("nhde, nhce -> nhcd", Out, V)
+            else:
+                Out = torch.einsum("nhce, nhfd -> nhcd", Out, V)
         
-        # Unflatten the resulting tensor
-        # (N, H, inCh/H, LW) -> (N, H, inCh/H, L, W)
-        if Out.shape[1] > 1:
-            Out = Out.unflatten(-1, (self.resolution, self.resolution))
+        # Merge the heads back into the channels
+        # (N, P*H, inCh/H, LW) -> (N, P, inCh, LW)
+        Out = self.remove_heads(Out)
+
+        if self.window:
+            # Merge the windows and undo the shift
+            # (N, P, inCh, r_L*r_W) -> (N, inCh, L, W)
+            Out = self.remove_windows(Out, L, W, r_L, r_W, channels_last)
+            if shift > 0:
+                Out = torch.roll(Out, (shift, shift), (2, 3))
         else:
-            Out = Out.unflatten(-1, (L, W))
-        
-        # Reshape the tensor back to its original shape without heads
-        # (N, (LW/res**2), inCh, L/res, W/res) -> (N, inCh, L, W)
-        Out = self.remove_patches(Out, L, W)
+            # Unflatten the resulting tensor
+            # (N, P, inCh, LW) -> (N, P, inCh, L, W)
+            if Out.shape[1] > 1:
+                Out = Out.unflatten(-1, (self.resolution, self.resolution))
+            else:
+                Out = Out.unflatten(-1, (L, W))
+            
+            # Reshape the tensor back to its original shape without heads
+            # (N, (LW/res**2), inCh, L/res, W/res) -> (N, inCh, L, W)
+            Out = self.remove_patches(Out, L, W)
+            if channels_last:
+                Out = Out.contiguous(memory_format=torch.channels_last)
         
         # Send the resulting tensor through the
         # final convolution to get the initial channels
@@ -5,30 +5,51 @@ from colorama import Fore
 
 
 
+# The warning is only printed for the first encoding that is made
+printed_warning = False
+
+
+
+
 class PositionalEncoding(nn.Module):
-    def __init__(self, dim):
+    # Inputs:
+    #   dim - Dimension of the embeddings
+    #   max_t - (optional) Max time value. If given, the embeddings of
+    #           every time value in [0, max_t] are computed once and
+    #           stored in a table so encoding integer times is a lookup.
+    def __init__(self, dim, max_t=None):
         super().__init__()
         self.dim = dim
 
         # Calculate the denominator of the position encodings
-        # as this value is constant
-        self.denom = torch.tensor(10000)**\
-            ((2*torch.arange(self.dim))/self.dim)
+        # as this value is constant. The buffers are not saved in
+        # the state dict so old models can still be loaded.
+        self.register_buffer("denom", torch.tensor(10000)**\
+            ((2*torch.arange(self.dim))/self.dim), persistent=False)
 
+        # Table of the embeddings of shape (max_t+1, dim)
+        if max_t is not None:
+            self.register_buffer("table", self.make_embeddings(torch.arange(int(max_t)+1)), persistent=False)
+        else:
+            self.table = None
 
-        print(Fore.RED + '******************************************************************************************************************')
-        print(Fore.RED + '*If loading a pretrained model, uncomment lines 38/39 and comment lines 34/35 in src/blocks/PositionalEncoding.py*')
-        print(Fore.RED + '*Error with indices in the initial implementaion, applying PEs on the batch.                                     *')
-        print(Fore.RED + '******************************************************************************************************************')
 
-    # Convert time steps to embedding tensors
+        global printed_warning
+        if not printed_warning:
+            printed_warning = True
+            print(Fore.RED + '******************************************************************************************************************')
+            print(Fore.RED + '*If loading a pretrained model, swap the commented lines in make_embeddings in src/blocks/PositionalEncoding.py  *')
+            print(Fore.RED + '*Error with indices in the initial implementaion, applying PEs on the batch.                                     *')
+            print(Fore.RED + '******************************************************************************************************************')
+
+    # Compute the embeddings of the time steps
     # Inputs:
     #   time - Time values of shape (N)
     # Outputs:
     #   embedded time values of shape (N, dim)
-    def forward(self, time):
+    def make_embeddings(self, time):
         # Compute the current timestep embeddings
-        embeddings = time[:, None]*self.denom[None, :].to(time.device)
+        embeddings = time[:, None]*self.denom[None, :]
 
         # Sin/Cos transformation for even, odd indices
         embeddings[:, ::2] = embeddings[:, ::2].sin()
@@ -40,3 +61,15 @@ class PositionalEncoding(nn.Module):
         # Uncomment these ^ if loading a pretrained model
 
         return embeddings
+
+    # Convert time steps to embedding tensors
+    # Inputs:
+    #   time - Time values of shape (N). Integer time values
+    #          must be in the range [0, max_t] if max_t is given.
+    # Outputs:
+    #   embedded time values of shape (N, dim)
+    def forward(self, time):
+        # Integer time steps are looked up in the table
+        if self.table is not None and not time.is_floating_point():
+            return self.table[time]
+        return self.make_embeddings(time)
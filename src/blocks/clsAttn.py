@@ -15,9 +15,15 @@ class clsAttn(nn.Module):
         super(clsAttn, self).__init__()
         self.inCh = torch.tensor(inCh)
         
-        # Query and Key embedding matrices
-        self.Q_emb = nn.Linear(cls_dim, inCh)
-        self.K_emb = nn.Linear(cls_dim, inCh)
+        # Query and Key embedding matrices. The attention matrix
+        # softmax(K@Q^T/sqrt(inCh)) is applied to the input by summing
+        # over its rows, and the rows of a softmax always sum to 1, so
+        # the keys and queries have no effect on the output. They are
+        # only kept so saved models and optimizers still load, and are
+        # frozen so they aren't trained and DDP doesn't expect them
+        # to have gradients.
+        self.Q_emb = nn.Linear(cls_dim, inCh).requires_grad_(False)
+        self.K_emb = nn.Linear(cls_dim, inCh).requires_grad_(False)
 
         # Output embedding transformation
         self.out_emb = nn.Sequential(
@@ -37,34 +43,19 @@ class clsAttn(nn.Module):
     # Inputs:
     #   X - tensor of shape (N, inCh, L, W) to attend to
     #   cls - tensor of shape (N, cls_emb) to make the attention with
+    #         (unused since the attention scales each channel by 1)
     # Outputs:
     #   Tensor of shape (N, inCh, L, W)
     def forward(self, X, cls):
-        res = X.clone()
+        # X is not changed in place, so it doesn't have to be cloned
+        res = X
 
         # Normalize input
         X = self.LN(X)
 
-        # Get the keys and queries
-        # cls: (N, cls_emb) -> (N, inCh)
-        K, Q = self.Q_emb(cls), self.K_emb(cls)
-
-        # Extend the class embeddings
-        # (N, inCh) -> (N, inCh, 1)
-        K = K.unsqueeze(-1)
-        Q = Q.unsqueeze(-1)
-
-        # Create the attention matrix
-        # (N, inCh, 1) * (N, inCh, 1) -> (N, inCh, inCh)
-        KQ = self.softmax((K@Q.permute(0, 2, 1))/torch.sqrt(self.inCh))
-
-        # Apply the attention matrix to the input embeddings
-        # (N, inCh, L, W) * (N, inCh, inCh) = (N, inCh, L, W)
-        X = torch.einsum("nclw, ncd -> nclw", X, KQ)
-
         # Output embeddings
         X = self.out_emb(X)
-        
+
         # Return the output with the input as a residual
         return X + res
 
@@ -135,6 +126,8 @@ class clsAttn_Linear(nn.Module):
         # Output embeddings
         X = self.out_emb(X) + res
 
+        return X
+
 
 
 
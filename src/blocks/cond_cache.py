@@ -0,0 +1,93 @@
+import torch
+from contextlib import contextmanager
+
+
+
+
+
+# Cache of the time and class conditioning of the blocks. While
+# sampling, the class embeddings are the same for every step and the
+# time embeddings are the same for every image in a step, so the
+# projections of the embeddings in each block only have to be computed
+# once. The projections are stored by the block, name, and the input
+# tensors, so the model has to pass the same tensor objects for the
+# same conditioning (the cache holds on to the inputs so their ids
+# aren't reused). Projections named "t" depend on the timestep and are
+# dropped at every new step. The cache only works without gradients and
+# while enabled, so it never changes training.
+class ConditioningCache():
+    def __init__(self):
+        self.enabled = False
+        self.store = {}
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    # Enable the cache for a sampling run. The cache is
+    # cleared when the run is done.
+    @contextmanager
+    def enable(self):
+        self.enabled = True
+        self.store = {}
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            yield self
+        finally:
+            self.enabled = False
+            self.store = {}
+            self.values = {}
+
+
+    # Drop the time projections of the last step
+    def new_step(self):
+        self.store = {k:v for k,v in self.store.items() if k[1] != "t"}
+
+
+    # Get a value from the cache, making it if it isn't there
+    # Inputs:
+    #   key - Key of the value
+    #   fn - Function which makes the value
+    def get(self, key, fn):
+        if not self.enabled or torch.is_grad_enabled():
+            return fn()
+        if key not in self.values:
+            self.values[key] = fn()
+        return self.values[key]
+
+
+    # Get the output of a projection, computing it if the
+    # inputs haven't been projected by this module yet
+    # Inputs:
+    #   module - Module the projection belongs to
+    #   name - Name of the projection in the module
+    #   fn - Projection function
+    #   inputs - Input tensors of the projection
+    def __call__(self, module, name, fn, *inputs):
+        if not self.enabled or torch.is_grad_enabled():
+            return fn(*inputs)
+        key = (id(module), name, tuple(id(X) for X in inputs))
+        if key not in self.store:
+            self.misses += 1
+            self.store[key] = (inputs, fn(*inputs))
+        else:
+            self.hits += 1
+        return self.store[key][1]
+
+
+
+
+
+# Project the inputs with the conditioning cache of the
+# module if it has one
+# Inputs:
+#   module - Module the projection belongs to
+#   name - Name of the projection in the module
+#   fn - Projection function
+#   inputs - Input tensors of the projection
+def cached(module, name, fn, *inputs):
+    if module.cond_cache is None:
+        return fn(*inputs)
+    return module.cond_cache(module, name, fn, *inputs)
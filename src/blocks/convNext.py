@@ -1,4 +1,5 @@
 from torch import nn
+from .cond_cache import cached
 
 
 
@@ -14,6 +15,9 @@ from torch import nn
 
 
 class convNext(nn.Sequential):
+    # Cache of the time and class projections while sampling (set by the model)
+    cond_cache = None
+
     # Inputs:
     #   inCh - Number of channels the input batch has
     #   outCh - Number of chanels the ouput batch should have
@@ -80,8 +84,8 @@ class convNext(nn.Sequential):
             X = self.block[1](X)
 
             # Time and class embeddings
-            t = self.timeProj(t).unsqueeze(-1).unsqueeze(-1)
-            c = self.clsProj(c).unsqueeze(-1).unsqueeze(-1)
+            t = cached(self, "t", lambda t: self.timeProj(t).unsqueeze(-1).unsqueeze(-1), t)
+            c = cached(self, "c", lambda c: self.clsProj(c).unsqueeze(-1).unsqueeze(-1), c)
 
             # Combine the class, time, and embedding information
             X = X*t + c
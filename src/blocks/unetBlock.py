@@ -32,7 +32,18 @@ class unetBlock(nn.Module):
     #   c_dim - (optional) Number of dimensions in the class embedding input
     #   atn_resolution - (optional) Resolution for the attention ("atn") blocks if used
     #   dropoutRate - (optional) Rate to apply dropout in the convnext blocks
-    def __init__(self, inCh, outCh, blk_types, t_dim=None, c_dim=None, atn_resolution=None, dropoutRate=0.0):
+    #   num_heads - (optional) Number of heads in the attention ("atn") blocks if used
+    #   head_dim - (optional) Number of channels in each head of the attention
+    #              ("atn") blocks. Overrides num_heads if given.
+    #   atn_window - (optional) True to use windowed attention in the attention ("atn")
+    #                blocks. The attention blocks alternate between regular and
+    #                shifted windows, counting from atn_offset.
+    #   atn_global - (optional) Size of the grid of global tokens in the
+    #                windowed attention blocks. Use 0 for no global tokens.
+    #   atn_offset - (optional) Number of attention blocks before this block
+    #                in the network, so the shifted windows keep alternating
+    #                across blocks
+    def __init__(self, inCh, outCh, blk_types, t_dim=None, c_dim=None, atn_resolution=None, dropoutRate=0.0, num_heads=1, head_dim=None, atn_window=False, atn_global=0, atn_offset=0):
         super(unetBlock, self).__init__()
 
         self.useCls = False if c_dim == None else True
@@ -42,6 +53,7 @@ class unetBlock(nn.Module):
         blocks = []
         curCh = inCh
         curCh1 = outCh
+        num_atn = 0
         for blk in blk_types:
             if blk == "res":
                 blocks.append(ResnetBlock(curCh, curCh1, t_dim, c_dim, dropoutRate))
@@ -53,11 +65,14 @@ class unetBlock(nn.Module):
                 blocks.append(Efficient_Channel_Attention(curCh))
             elif blk == "atn":
                 assert atn_resolution != None, "Resolution cannot be none when using attention"
-                blocks.append(Multihead_Attn(curCh, resolution=atn_resolution, spatial=True))
+                blocks.append(Multihead_Attn(curCh, num_heads=num_heads, resolution=atn_resolution, spatial=True, head_dim=head_dim,
+                                             window=atn_window, shift=(atn_offset+num_atn) % 2 == 1, num_global=atn_global))
+                num_atn += 1
 
             curCh = curCh1
 
         self.block = nn.Sequential(*blocks)
+        self.num_atn = num_atn
 
 
     # Input:
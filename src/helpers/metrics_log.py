@@ -0,0 +1,175 @@
+import numpy as np
+import os
+
+
+
+
+
+# Append-only log of training metrics. Rows are written to a preallocated
+# chunk which is appended to a binary file of float64 rows when full, so
+# logging a step never copies the full history. Only a window of the
+# latest rows and a downsampled copy of all rows (for graphing) are kept
+# in memory. The downsampled copy has at most max_points points and is
+# updated incrementally as rows are added.
+class MetricsLog():
+    # filename - File to append the rows to. Use None to keep nothing on disk.
+    # columns - Names of the columns of each row. The first column
+    #           should be the step the row was logged at.
+    # chunk_size - Number of rows to buffer before appending to the file
+    # window - Number of latest rows to keep in memory
+    # max_points - Max number of points in the downsampled copy of the rows
+    def __init__(self, filename, columns, chunk_size=1024, window=1000, max_points=2048):
+        assert max_points % 2 == 0, "max_points must be even"
+
+        self.filename = filename
+        self.columns = list(columns)
+        self.col_idx = {c: i for i, c in enumerate(self.columns)}
+        num_cols = len(self.columns)
+
+        # Rows waiting to be written to the file
+        self.chunk = np.empty((chunk_size, num_cols), dtype=np.float64)
+        self.chunk_len = 0
+
+        # Ring buffer of the latest rows
+        self.window = np.empty((window, num_cols), dtype=np.float64)
+        self.window_pos = 0
+        self.window_len = 0
+
+        # Downsampled rows. Each point is the mean of stride rows.
+        self.max_points = max_points
+        self.points = np.empty((max_points, num_cols), dtype=np.float64)
+        self.num_points = 0
+        self.stride = 1
+        self.bin_sum = np.zeros(num_cols, dtype=np.float64)
+        self.bin_len = 0
+
+        # Total number of rows logged
+        self.num_rows = 0
+
+
+    # Add a row to the log
+    # Inputs:
+    #   values - One value for each column
+    def append(self, *values):
+        row = np.asarray(values, dtype=np.float64)
+
+        self.chunk[self.chunk_len] = row
+        self.chunk_len += 1
+        self.add_to_memory(row)
+
+        if self.chunk_len == self.chunk.shape[0]:
+            self.flush()
+
+
+    # Add a row to the window and the downsampled rows
+    def add_to_memory(self, row):
+        self.window[self.window_pos] = row
+        self.window_pos = (self.window_pos + 1) % self.window.shape[0]
+        self.window_len = min(self.window_len + 1, self.window.shape[0])
+        self.num_rows += 1
+
+        self.bin_sum += row
+        self.bin_len += 1
+        if self.bin_len == self.stride:
+            self.points[self.num_points] = self.bin_sum/self.stride
+            self.num_points += 1
+            self.bin_sum[:] = 0
+            self.bin_len = 0
+
+            # When full, halve the resolution by averaging neighboring points
+            if self.num_points == self.max_points:
+                half = self.max_points//2
+                self.points[:half] = (self.points[0::2] + self.points[1::2])/2
+                self.num_points = half
+                self.stride *= 2
+
+
+    # Append all buffered rows to the file
+    def flush(self):
+        if self.filename is not None and self.chunk_len > 0:
+            dirname = os.path.dirname(self.filename)
+            if dirname != "" and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.filename, "ab") as f:
+                f.write(self.chunk[:self.chunk_len].tobytes())
+        self.chunk_len = 0
+
+
+    # Read all rows in the file as a memory-mapped array
+    # of shape (num_rows, num_columns). Note that rows which
+    # have not been flushed are not in the file.
+    def read(self):
+        if self.filename is None or not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0:
+            return np.empty((0, len(self.columns)), dtype=np.float64)
+        return np.memmap(self.filename, dtype=np.float64, mode="r").reshape(-1, len(self.columns))
+
+
+    # Remove all rows in the file after the given step and load
+    # the remaining rows into memory. Used when training is
+    # restarted from a checkpoint.
+    # Inputs:
+    #   step - Last step to keep
+    def truncate(self, step):
+        rows = self.read()
+        keep = int(np.searchsorted(rows[:, 0], step, side="right"))
+        rows_mem = np.array(rows[:keep])
+        del rows
+        if self.filename is not None and os.path.exists(self.filename):
+            os.truncate(self.filename, keep*len(self.columns)*8)
+
+        for row in rows_mem:
+            self.add_to_memory(row)
+
+
+    # Move the file to the next free name of the form {name}_{i}{ext}
+    # so a new file can be started without losing the old rows
+    # Outputs:
+    #   Name the file was moved to, or None if there was nothing to move
+    def rotate(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return None
+        name, ext = os.path.splitext(self.filename)
+        i = 1
+        while os.path.exists(f"{name}_{i}{ext}"):
+            i += 1
+        os.rename(self.filename, f"{name}_{i}{ext}")
+        return f"{name}_{i}{ext}"
+
+
+    # Continue the log of a run from the given step. When restarting
+    # from a checkpoint (step > 0), the rows after the step are removed
+    # and the rest are loaded into memory. A new run (step 0) moves the
+    # rows another run left in the file to a new name and starts an
+    # empty file.
+    # Inputs:
+    #   step - Step the run starts from
+    # Outputs:
+    #   Name the rows of another run were moved to, or None
+    def resume(self, step):
+        if step > 0:
+            self.truncate(step)
+            return None
+        if self.read().shape[0] == 0:
+            return None
+        return self.rotate()
+
+
+    # Get the latest values of a column
+    # Inputs:
+    #   column - Name of the column
+    #   n - Max number of values to get
+    # Outputs:
+    #   Array of at most n values, oldest first
+    def recent(self, column, n):
+        n = min(n, self.window_len)
+        idx = (self.window_pos - n + np.arange(n)) % self.window.shape[0]
+        return self.window[idx, self.col_idx[column]]
+
+
+    # Get the downsampled values of a column, including the
+    # mean of the rows that have not filled a full point yet
+    def downsampled(self, column):
+        values = self.points[:self.num_points, self.col_idx[column]]
+        if self.bin_len > 0:
+            values = np.append(values, self.bin_sum[self.col_idx[column]]/self.bin_len)
+        return values
@@ -1,4 +1,5 @@
 import torch.distributed as dist
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import torch 
 
 def is_dist_avail_and_initialized():
@@ -24,4 +25,33 @@ def get_rank():
 
 def is_main_process():
 
-    return get_rank() == 0
\ No newline at end of file
+    return get_rank() == 0
+
+
+
+
+
+# Create the AdamW optimizer used to train the model
+# Inputs:
+#   params - Parameters of the model to optimize
+#   lr - Learning rate of the optimizer
+#   shard_optim - True to shard the optimizer state across all processes
+#                 (ZeRO stage 1) instead of keeping a full copy on each process.
+#                 Only used when the distributed backend is initialized.
+def create_optimizer(params, lr, shard_optim=False):
+    if shard_optim and is_dist_avail_and_initialized():
+        return ZeroRedundancyOptimizer(params, optimizer_class=torch.optim.AdamW, lr=lr, eps=1e-4)
+    return torch.optim.AdamW(params, lr=lr, eps=1e-4)
+
+
+# A sharded optimizer only holds the state for the parameters
+# its process owns. Before saving, the state of every process is
+# gathered onto a single process so the saved optimizer file has the
+# same layout as the optimizer file of an unsharded AdamW optimizer.
+# Note: This must be called by all processes.
+# Inputs:
+#   optim - Optimizer to gather the state of
+#   to - Rank of the process to gather the state onto
+def gather_optim_state(optim, to=0):
+    if isinstance(optim, ZeroRedundancyOptimizer):
+        optim.consolidate_state_dict(to=to)
@@ -0,0 +1,54 @@
+import torch
+
+
+
+
+
+# Mix a 64 bit integer (splitmix64 finalizer)
+def mix64(x):
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+
+# Seed of the draw with the given counter of a sample
+def draw_seed(seed, idx, counter):
+    return mix64(mix64(mix64(seed) ^ idx) ^ counter) & 0x7FFFFFFFFFFFFFFF
+
+
+
+
+
+# Per-sample random noise for sampling. Every sample has its own stream of
+# random numbers which only depends on (seed, sample index), and each draw
+# from the stream is seeded from (seed, sample index, draw counter). So the
+# noise a sample gets doesn't depend on the other samples in its batch, the
+# batch size, or which process generates it, and any sample can be made
+# again on its own. Note that the random numbers of the CPU and GPU
+# generators are different, so samples only match on the same device type.
+class SampleNoise():
+    # seed - Seed of the samples
+    # idxs - Index of each sample in the batch
+    # device - Device to make the noise on
+    def __init__(self, seed, idxs, device):
+        self.seed = int(seed)
+        self.idxs = [int(i) for i in idxs]
+        self.device = torch.device(device)
+        self.generator = torch.Generator(self.device)
+        self.counter = 0
+
+
+    # Draw standard normal noise for every sample
+    # Inputs:
+    #   shape - Shape of the noise of a single sample
+    # Outputs:
+    #   Noise of shape (N, *shape)
+    def randn(self, shape):
+        out = torch.empty((len(self.idxs), *shape), device=self.device)
+        for i, idx in enumerate(self.idxs):
+            self.generator.manual_seed(draw_seed(self.seed, idx, self.counter))
+            torch.randn(shape, generator=self.generator, device=self.device, out=out[i])
+        self.counter += 1
+        return out
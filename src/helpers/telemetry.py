@@ -0,0 +1,239 @@
+import torch
+import time
+import json
+import math
+import os
+
+
+
+
+
+# Phases of a training step in the order they happen. Note that the
+# allreduce phase runs in the background while the backward pass
+# is computed, so it overlaps with the backward phase.
+PHASES = ["data_wait", "h2d", "noise", "forward", "loss", "backward", "allreduce", "optimizer"]
+
+
+
+
+
+# Records timing, throughput, memory, and loss information for each
+# training step and writes it to a JSONL or CSV file. On a GPU, the
+# phases are timed with CUDA events that are only read when the records
+# are written, so timing does not synchronize the GPU on every step.
+# On a CPU, the phases are timed with perf_counter.
+class StepTelemetry():
+    # enabled - False to turn off all recording. All methods do nothing.
+    # saveDir - Directory to save the telemetry file to
+    # device - Device the model is trained on
+    # T - Max number of diffusion steps
+    # file_format - Format of the telemetry file ("jsonl" or "csv")
+    # log_every - Number of steps between writes to the telemetry file
+    # num_t_buckets - Number of buckets to split the values of t into
+    #                 when recording the loss for each value of t
+    # profile_steps - (optional) (start, end) steps to run the torch
+    #                 profiler over. The trace is saved to saveDir.
+    def __init__(self, enabled, saveDir, device, T, file_format="jsonl", log_every=100, num_t_buckets=10, profile_steps=None):
+        self.enabled = enabled
+        if not enabled:
+            return
+
+        assert file_format in ["jsonl", "csv"], "Telemetry file format must be either \"jsonl\" or \"csv\""
+
+        self.saveDir = saveDir
+        self.device = device
+        self.T = int(T)
+        self.file_format = file_format
+        self.log_every = log_every
+        self.num_t_buckets = num_t_buckets
+        self.profile_steps = profile_steps
+        self.use_events = device.type == "cuda"
+        self.filename = saveDir + os.sep + f"telemetry.{file_format}"
+        self.columns = ["step"] + PHASES + ["step_time", "imgs_per_sec", "peak_mem_MB"] + \
+            [f"loss_t{i}" for i in range(num_t_buckets)]
+
+        # Records for the current step and records waiting to be written
+        self.cur_phases = []
+        self.cur_host = {"data_wait": 0.0, "allreduce": 0.0}
+        self.cur_t_loss = torch.zeros(num_t_buckets, device=device)
+        self.cur_t_count = torch.zeros(num_t_buckets, device=device)
+        self.pending = []
+
+        # Last time and mark, used as the start of the next phase
+        self.last_host = time.perf_counter()
+        self.last_step_time = self.last_host
+        self.last_mark = self.now()
+
+        self.profiler = None
+
+
+    # Get the current time as either a CUDA event or a float
+    def now(self):
+        if self.use_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+
+    # Time in ms between two marks
+    def elapsed(self, start, end):
+        if self.use_events:
+            return start.elapsed_time(end)
+        return (end - start)*1000
+
+
+    # Called when a new batch of data is received from the data loader
+    def data_ready(self):
+        if not self.enabled:
+            return
+        cur = time.perf_counter()
+        self.cur_host["data_wait"] += (cur - self.last_host)*1000
+        self.last_host = cur
+        self.last_mark = self.now()
+
+
+    # Called at the end of a phase of the training step
+    # Inputs:
+    #   phase - Name of the phase that ended
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        cur = self.now()
+        self.cur_phases.append((phase, self.last_mark, cur))
+        self.last_mark = cur
+        self.last_host = time.perf_counter()
+
+
+    # Add time spent in a phase measured outside of the step
+    # (like the allreduce communication hook)
+    def add_host_time(self, phase, ms):
+        if not self.enabled:
+            return
+        self.cur_host[phase] += ms
+
+
+    # Store the loss for each value of t in the batch
+    # Inputs:
+    #   t - Values of t of shape (N)
+    #   loss - Loss for each item in the batch of shape (N)
+    def add_t_losses(self, t, loss):
+        if not self.enabled:
+            return
+        buckets = ((t.to(self.device) - 1)*self.num_t_buckets//self.T).clamp(0, self.num_t_buckets-1)
+        self.cur_t_loss.index_add_(0, buckets, loss.detach().to(self.device, torch.float))
+        self.cur_t_count.index_add_(0, buckets, torch.ones_like(buckets, dtype=torch.float))
+
+
+    # Called at the start of a step to start the profiler if needed
+    # Inputs:
+    #   step - Step that is about to be taken
+    def begin_step(self, step):
+        if not self.enabled or self.profile_steps is None:
+            return
+        if step == self.profile_steps[0] and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_events:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.__enter__()
+
+
+    # Called after the model is updated and saved
+    # Inputs:
+    #   step - Number of steps taken
+    #   num_imgs - Number of images used in the step over all processes
+    def end_step(self, step, num_imgs):
+        if not self.enabled:
+            return
+
+        # Peak GPU memory since the last step. On a CPU, the only peak
+        # available is the peak over the life of the process, which
+        # isn't a per step value, so nothing is recorded.
+        if self.use_events:
+            peak_mem = torch.cuda.max_memory_allocated(self.device)/2**20
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            peak_mem = None
+
+        cur = time.perf_counter()
+        self.last_host = cur
+        self.pending.append(dict(
+            step=step,
+            phases=self.cur_phases,
+            host=self.cur_host,
+            step_time=(cur - self.last_step_time)*1000,
+            num_imgs=num_imgs,
+            peak_mem=peak_mem,
+            t_loss=self.cur_t_loss,
+            t_count=self.cur_t_count,
+        ))
+        self.last_step_time = cur
+
+        self.cur_phases = []
+        self.cur_host = {"data_wait": 0.0, "allreduce": 0.0}
+        self.cur_t_loss = torch.zeros(self.num_t_buckets, device=self.device)
+        self.cur_t_count = torch.zeros(self.num_t_buckets, device=self.device)
+
+        # Stop the profiler and save the trace
+        if self.profiler is not None and step == self.profile_steps[1]:
+            self.profiler.__exit__(None, None, None)
+            if not os.path.isdir(self.saveDir):
+                os.makedirs(self.saveDir)
+            self.profiler.export_chrome_trace(self.saveDir + os.sep + f"trace_{self.profile_steps[0]}s_{self.profile_steps[1]}s.json")
+            self.profiler = None
+
+        if len(self.pending) >= self.log_every:
+            self.flush()
+
+
+    # Write all pending records to the telemetry file
+    def flush(self):
+        if not self.enabled or len(self.pending) == 0:
+            return
+
+        # The events of the last step have to finish before they are read
+        if self.use_events:
+            torch.cuda.synchronize(self.device)
+
+        rows = []
+        for record in self.pending:
+            row = {"step": record["step"]}
+            for phase in PHASES:
+                row[phase] = record["host"].get(phase, 0.0)
+            for phase, start, end in record["phases"]:
+                row[phase] += self.elapsed(start, end)
+            row["step_time"] = record["step_time"]
+            row["imgs_per_sec"] = record["num_imgs"]/(record["step_time"]/1000)
+            row["peak_mem_MB"] = record["peak_mem"]
+            t_loss = (record["t_loss"]/record["t_count"]).cpu().tolist()
+            for i, loss in enumerate(t_loss):
+                row[f"loss_t{i}"] = None if math.isnan(loss) else loss
+            rows.append(row)
+        self.pending = []
+
+        if not os.path.isdir(self.saveDir):
+            os.makedirs(self.saveDir)
+        new_file = not os.path.exists(self.filename)
+        with open(self.filename, "a") as f:
+            if self.file_format == "jsonl":
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+            else:
+                if new_file:
+                    f.write(",".join(self.columns) + "\n")
+                for row in rows:
+                    f.write(",".join("" if row[c] is None else str(row[c]) for c in self.columns) + "\n")
+
+
+    # DDP communication hook that all-reduces the gradients like
+    # the default DDP hook while timing the communication
+    def allreduce_hook(self, process_group, bucket):
+        from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+        start = time.perf_counter()
+        fut = allreduce_hook(process_group, bucket)
+
+        def record_time(fut):
+            self.add_host_time("allreduce", (time.perf_counter() - start)*1000)
+            return fut.value()
+        return fut.then(record_time)
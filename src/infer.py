@@ -13,7 +13,7 @@ import click
 
 # Required
 @click.option("--loadDir", "loadDir", type=str, help="Location of the models to load in.", required=True)
-@click.option("--loadFile", "loadFile", type=str, help="Name of the .pkl model file to load in. Ex: model_358e_450000s.pkl", required=True)
+@click.option("--loadFile", "loadFile", type=str, help="Name of the .pkl model file to load in. Ex: model_358e_450000s.pkl. The EMA weights of a model can be loaded by giving the model_ema .pkl file instead. Ex: model_ema_358e_450000s.pkl", required=True)
 @click.option("--loadDefFile", "loadDefFile", type=str, help="Name of the .json model file to load in. Ex: model_params_358e_450000s.pkl", required=True)
 
 # Generation parameters
@@ -23,6 +23,7 @@ import click
 @click.option("--guidance", "w", type=int, default=4, help="Classifier guidance scale which must be >= 0. The higher the value, the better the image quality, but the lower the image diversity.", required=False)
 @click.option("--class_label", "class_label", type=int, default=0, help="0-indexed class value. Use -1 for a random class and any other class value >= 0 for the other classes. FOr imagenet, the class value range from 0 to 999 and can be found in data/class_information.txt", required=False)
 @click.option("--corrected", "corrected", type=bool, default=False, help="True to put a limit on generation, False to not put a litmit on generation. If the model is generating images of a single color, then you may need to set this flag to True. Note: This restriction is usually needed when generating long sequences (low step size) Note: With a higher guidance w, the correction usually messes up generation.", required=False)
+@click.option("--channels_last", "channels_last", type=bool, default=False, help="True to generate in the channels last memory format, which is usually faster for the convolutions on modern GPUs and CPUs.", required=False)
 
 # Output parameters
 @click.option("--out_imgname", "out_imgname", type=str, default="fig.png", help="Name of the file to save the output image to.", required=False)
@@ -40,6 +41,7 @@ def infer(
     w: int,
     class_label: int,
     corrected: bool,
+    channels_last: bool,
 
     out_imgname: str,
     out_gifname: str,
@@ -58,6 +60,11 @@ def infer(
     
     # Load in the model weights
     model.loadModel(loadDir, loadFile, loadDefFile)
+
+    # Precompute everything that doesn't change between steps
+    model.freeze()
+    if channels_last:
+        model.use_channels_last()
     
     # Sample the model
     noise, imgs = model.sample_imgs(1, class_label, w, True, True, True, corrected)
@@ -3,6 +3,7 @@ from torch import nn
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+from contextlib import nullcontext
 
 import torch.multiprocessing as mp
 from torch.utils.data.distributed import DistributedSampler
@@ -14,9 +15,13 @@ from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.dataloader import DataLoader
 
 try:
-    from helpers.multi_gpu_helpers import is_main_process
+    from helpers.multi_gpu_helpers import is_main_process, create_optimizer, gather_optim_state
+    from helpers.telemetry import StepTelemetry
+    from helpers.metrics_log import MetricsLog
 except ModuleNotFoundError:
-    from .helpers.multi_gpu_helpers import is_main_process
+    from .helpers.multi_gpu_helpers import is_main_process, create_optimizer, gather_optim_state
+    from .helpers.telemetry import StepTelemetry
+    from .helpers.metrics_log import MetricsLog
 
 
 cpu = torch.device('cpu')
@@ -58,6 +63,109 @@ def init_distributed():
 
 
 
+# Convert the step of a model saved before steps counted model updates.
+# These models count a step for each batch sent through the model, so
+# with gradient accumulation the step is numSteps times the number of
+# updates. The model is assumed to have been trained with numSteps.
+# Inputs:
+#   defaults - Defaults of the model, updated in place
+#   numSteps - Number of batches in each model update
+# Outputs:
+#   Number of model updates taken
+def update_steps(defaults, numSteps):
+    if defaults.get("step_unit", "update") == "batch":
+        defaults["step"] = defaults["step"]//numSteps
+        if is_main_process() and numSteps > 1:
+            print(f"Converted the step of the loaded model to {defaults['step']} model updates")
+    defaults["step_unit"] = "update"
+    return defaults["step"]
+
+
+
+
+# Exponential moving average (EMA) of the model weights. The averaged
+# weights usually generate better images than the raw weights.
+class EMA():
+    # model - Model to keep the moving average of (not wrapped in DDP)
+    # decay - Decay of the moving average for each model update
+    # update_every - Number of model updates between updates of the
+    #                moving average. The decay is scaled so the average
+    #                covers the same number of model updates.
+    # warmup - Number of model updates before the moving average starts.
+    #          Until then, the average is a copy of the model weights.
+    def __init__(self, model, decay=0.9999, update_every=1, warmup=0):
+        self.decay = decay
+        self.update_every = update_every
+        self.warmup = warmup
+        self.model = model
+
+        # Parameters to average and their names in the model state dict
+        self.names, self.params = zip(*[(n, p) for n, p in model.named_parameters()])
+        self.params = list(self.params)
+
+        # The moving average is kept in its own copy of the weights
+        self.shadow = [p.detach().clone() for p in self.params]
+
+        # On a GPU, the update is run on a side stream so it
+        # overlaps with the next forward pass of the model
+        self.stream = torch.cuda.Stream(device=self.params[0].device) \
+            if self.params[0].is_cuda else None
+
+
+    # Update the moving average after a model update
+    # Inputs:
+    #   step - Number of model updates taken so far
+    @torch.no_grad()
+    def update(self, step):
+        if step % self.update_every != 0:
+            return
+
+        # The update must wait for the model update to finish. The
+        # main stream is captured before switching to the side stream
+        # since the side stream is the current stream inside the context.
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream(self.stream.device))
+
+        with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            # All weights are updated at once with multi-tensor ops
+            # rather than one kernel per parameter
+            if step <= self.warmup:
+                torch._foreach_mul_(self.shadow, 0.0)
+                torch._foreach_add_(self.shadow, self.params)
+            else:
+                decay = self.decay**self.update_every
+                torch._foreach_mul_(self.shadow, decay)
+                torch._foreach_add_(self.shadow, self.params, alpha=1-decay)
+
+
+    # The model weights cannot change until the moving average
+    # is done reading them. Call before the next model update.
+    def wait(self):
+        if self.stream is not None:
+            torch.cuda.current_stream(self.stream.device).wait_stream(self.stream)
+
+
+    # State dict of the moving average. This has the same
+    # layout as the model state dict, so it can be loaded
+    # into the model like a normal model file.
+    def state_dict(self):
+        self.wait()
+        state = self.model.state_dict()
+        for name, shadow in zip(self.names, self.shadow):
+            state[name] = shadow.clone()
+        return state
+
+
+    # Load the moving average from a saved state dict
+    def load_state_dict(self, state):
+        self.wait()
+        with torch.no_grad():
+            for name, shadow in zip(self.names, self.shadow):
+                shadow.copy_(state[name])
+
+
+
+
 # Trains a diffusion model
 class model_trainer():
     # diff_model - A diffusion model to train
@@ -78,7 +186,22 @@ class model_trainer():
     # p_uncond - Probability of training on a null class (only used if class info is used)
     # load_into_mem - True to load all data into memory first, False to load from disk as needed
     # optimFile - Optional name of optimizer to load in
-    def __init__(self, diff_model, batchSize, numSteps, epochs, lr, device, Lambda, saveDir, numSaveSteps, use_importance, p_uncond=None, max_world_size=None, load_into_mem=False, optimFile=None):
+    # shard_optim - True to shard the optimizer state across all GPUs
+    #               (ZeRO) instead of keeping a full copy on each GPU.
+    #               The saved optimizer file is the same in both cases.
+    # use_ema - True to keep an exponential moving average of the model
+    #           weights which is saved along with the model
+    # ema_decay - Decay of the moving average
+    # ema_update_every - Number of steps between moving average updates
+    # ema_warmup - Number of steps before the moving average starts
+    # emaFile - Optional name of the moving average weights to load in
+    # telemetry - True to record the time of each phase of a training step,
+    #             the throughput, peak GPU memory, and loss for values of t
+    # telemetry_format - Format of the telemetry file ("jsonl" or "csv")
+    # telemetry_every - Number of steps between writes to the telemetry file
+    # profile_steps - Optional (start, end) steps to run the torch profiler over
+    # channels_last - True to train the model in the channels last memory format
+    def __init__(self, diff_model, batchSize, numSteps, epochs, lr, device, Lambda, saveDir, numSaveSteps, use_importance, p_uncond=None, max_world_size=None, load_into_mem=False, optimFile=None, shard_optim=False, use_ema=False, ema_decay=0.9999, ema_update_every=10, ema_warmup=5000, emaFile=None, telemetry=False, telemetry_format="jsonl", telemetry_every=100, profile_steps=None, channels_last=False):
         # Saved info
         self.T = diff_model.T
         self.batchSize = batchSize//numSteps
@@ -106,6 +229,12 @@ class model_trainer():
             device = torch.device('cpu')
         self.device = device
         self.dev = dev
+
+        # Convert the weights once so the optimizer and DDP buckets
+        # use the same memory format as the gradients
+        if channels_last:
+            diff_model.use_channels_last()
+        self.memory_format = diff_model.memory_format
         
         # Put the model on the desired device
         if dev != "cpu":
@@ -121,12 +250,34 @@ class model_trainer():
         self.t_vals = np.arange(1, self.T.detach().cpu().numpy()+1)
         self.T_dist = torch.distributions.uniform.Uniform(float(1)-float(0.499), float(self.T)+float(0.499))
         
-        # Optimizer
-        self.optim = torch.optim.AdamW(self.model.parameters(), lr=lr, eps=1e-4)
+        # Optimizer. When sharded, each GPU only keeps the
+        # optimizer state for its partition of the parameters
+        self.optim = create_optimizer(self.model.parameters(), lr, shard_optim and dev != "cpu")
 
-        # Load in optimizer paramters if they exist
+        # Load in optimizer paramters if they exist. A sharded
+        # optimizer only keeps the part of the state it owns.
         if optimFile:
             self.optim.load_state_dict(torch.load(optimFile, map_location=self.device))
+
+        # Moving average of the weights. Since the weights are the same
+        # on all GPUs, only the main process keeps the average.
+        if use_ema and is_main_process():
+            self.ema = EMA(diff_model, ema_decay, ema_update_every, ema_warmup)
+            if emaFile:
+                self.ema.load_state_dict(torch.load(emaFile, map_location=self.device))
+        else:
+            self.ema = None
+
+        # Step telemetry which is only written by the main process
+        self.telemetry = StepTelemetry(telemetry and is_main_process(), saveDir, self.device, self.T,
+                                       telemetry_format, telemetry_every, profile_steps=profile_steps)
+
+        # Time the gradient communication between GPUs
+        if telemetry and dev != "cpu":
+            self.model.register_comm_hook(None, self.telemetry.allreduce_hook)
+
+        # Number of processes training the model
+        self.world_size = dist.get_world_size() if dev != "cpu" else 1
         
         # Loss function
         self.MSE = nn.MSELoss(reduction="none").to(self.device)
@@ -258,6 +409,8 @@ class model_trainer():
         # Get the combined loss
         loss_comb = loss_simple + loss_vlb
 
+        # Record the loss for each value of t
+        self.telemetry.add_t_losses(t, loss_comb)
 
 
 
@@ -327,14 +480,25 @@ class model_trainer():
                 DistributedSampler(dataset, shuffle=True)
             )
 
-        # Losses over epochs
-        self.losses_comb = np.array([])
-        self.losses_mean = np.array([])
-        self.losses_var = np.array([])
-        self.steps_list = np.array([])
-
-        # Number of steps taken
-        num_steps = self.model.module.defaults["step"]
+        # Number of steps taken. Note that a step is a single
+        # update to the model, not a single batch through the model
+        defaults = self.model.defaults if self.dev == "cpu" else self.model.module.defaults
+        num_steps = update_steps(defaults, self.numSteps)
+        start_epoch = defaults["epoch"]
+
+        # Losses over steps. The losses are appended to a file in
+        # saveDir by the main process. When restarting from a checkpoint,
+        # the losses logged after the checkpoint are removed. A new run
+        # moves the losses of an old run in saveDir to a new file.
+        self.loss_log = MetricsLog(self.saveDir + os.sep + "losses.bin" if is_main_process() else None,
+                                 ["step", "combined", "mean", "variance"])
+        old_losses = self.loss_log.resume(num_steps)
+        if old_losses is not None:
+            print(f"Moved the losses of a previous run to {old_losses}")
+
+        # Number of batches (micro-steps) sent through the model
+        # since the last model update
+        micro_step = 0
 
         # Cumulative loss over the batch over each set of steps
         losses_comb_s = torch.tensor(0.0, requires_grad=False)
@@ -342,7 +506,7 @@ class model_trainer():
         losses_var_s = torch.tensor(0.0, requires_grad=False)
         
         # Iterate over the desiered number of epochs
-        for epoch in range(self.model.module.defaults["epoch"], self.epochs+1):
+        for epoch in range(start_epoch, self.epochs+1):
             # Set the epoch number for the dataloader to seed the
             # randomization of the sampler
             if self.dev != "cpu":
@@ -351,9 +515,19 @@ class model_trainer():
             # Iterate over all data
             for step, data in enumerate(data_loader):
                 batch_x_0, batch_class = data
+                self.telemetry.data_ready()
                 
-                # Increate the number of steps taken
-                num_steps += 1
+                # Increase the number of micro-steps taken. The model is
+                # only updated on the last micro-step of each set of steps
+                micro_step += 1
+                update_step = micro_step == self.numSteps
+                if micro_step == 1:
+                    self.telemetry.begin_step(num_steps+1)
+
+                # Put the data on the correct device
+                batch_x_0 = batch_x_0.to(self.device, non_blocking=True, memory_format=self.memory_format)
+                batch_class = batch_class.to(self.device, non_blocking=True)
+                self.telemetry.mark("h2d")
                 
                 # Get values of t to noise the data
                 # Sample using weighted values if each t has 10 loss values
@@ -385,85 +559,127 @@ class model_trainer():
                         batch_x_t, epsilon_t = self.model.noise_batch(batch_x_0, t_vals)
                     else:
                         batch_x_t, epsilon_t = self.model.module.noise_batch(batch_x_0, t_vals)
-                
-                # Send the noised data through the model to get the
-                # predicted noise and variance for batch at t-1
-                epsilon_t1_pred, v_t1_pred = self.model(batch_x_t, t_vals, 
-                    batch_class if useCls else None, nullCls)
-
-                # Get the loss
-                loss, loss_mean, loss_var = self.lossFunct(epsilon_t, epsilon_t1_pred, v_t1_pred, 
-                                    batch_x_0, batch_x_t, t_vals)
-
-                # Scale the loss to be consistent with the batch size. If the loss
-                # isn't scaled, then the loss will be treated as an independent
-                # batch for each step. If it is scaled by the step size, then the loss will
-                # be treated as a part of a larger batchsize which is what we want
-                # to acheive when using steps.
-                loss = loss/self.numSteps
-                loss_mean /= self.numSteps
-                loss_var /= self.numSteps
-
-                # Backprop the loss, but save the intermediate gradients
-                loss.backward()
+                self.telemetry.mark("noise")
+
+                # DDP all-reduces the gradients on every backward pass. Since
+                # the model is only updated on the last micro-step, the gradients
+                # are only synchronized on that step and accumulated locally
+                # on all other steps.
+                if self.dev != "cpu" and not update_step:
+                    sync_context = self.model.no_sync()
+                else:
+                    sync_context = nullcontext()
+
+                with sync_context:
+                    # Send the noised data through the model to get the
+                    # predicted noise and variance for batch at t-1
+                    epsilon_t1_pred, v_t1_pred = self.model(batch_x_t, t_vals, 
+                        batch_class if useCls else None, nullCls)
+                    self.telemetry.mark("forward")
+
+                    # Get the loss
+                    loss, loss_mean, loss_var = self.lossFunct(epsilon_t, epsilon_t1_pred, v_t1_pred, 
+                                        batch_x_0, batch_x_t, t_vals)
+                    self.telemetry.mark("loss")
+
+                    # Scale the loss to be consistent with the batch size. If the loss
+                    # isn't scaled, then the loss will be treated as an independent
+                    # batch for each step. If it is scaled by the step size, then the loss will
+                    # be treated as a part of a larger batchsize which is what we want
+                    # to acheive when using steps.
+                    loss = loss/self.numSteps
+                    loss_mean /= self.numSteps
+                    loss_var /= self.numSteps
+
+                    # Backprop the loss, but save the intermediate gradients
+                    loss.backward()
+                    self.telemetry.mark("backward")
 
                 # Save the loss values
                 losses_comb_s += loss.cpu().detach()
                 losses_mean_s += loss_mean.cpu().detach()
                 losses_var_s += loss_var.cpu().detach()
 
-                # If the number of steps taken is a multiple of the number
-                # of desired steps, update the models
-                if num_steps%self.numSteps == 0:
+                # If this is the last micro-step in the set of steps,
+                # update the models
+                if update_step:
                     # Update the model using all losses over the steps
+                    if self.ema is not None:
+                        self.ema.wait()
                     self.optim.step()
                     self.optim.zero_grad()
 
+                    # A full step has been taken
+                    micro_step = 0
+                    num_steps += 1
+
+                    # Update the moving average of the weights
+                    if self.ema is not None:
+                        self.ema.update(num_steps)
+                    self.telemetry.mark("optimizer")
+
                     if is_main_process():
                         print(f"step #{num_steps}   Latest loss estimate: {round(losses_comb_s.cpu().detach().item(), 6)}")
 
                     # Save the loss values
-                    self.losses_comb = np.append(self.losses_comb, losses_comb_s.item())
-                    self.losses_mean = np.append(self.losses_mean, losses_mean_s.item())
-                    self.losses_var = np.append(self.losses_var, losses_var_s.item())
-                    self.steps_list = np.append(self.steps_list, num_steps)
+                    self.loss_log.append(num_steps, losses_comb_s.item(), losses_mean_s.item(), losses_var_s.item())
 
                     # Reset the cumulative step loss
                     losses_comb_s *= 0
                     losses_mean_s *= 0
                     losses_var_s *= 0
 
+                    # Save the model and graph every number of desired steps
+                    if num_steps%self.numSaveSteps == 0:
+                        # A sharded optimizer has to be gathered onto the
+                        # main process by all processes before saving
+                        gather_optim_state(self.optim)
 
-                # Save the model and graph every number of desired steps
-                if num_steps%self.numSaveSteps == 0 and is_main_process():
-                    if self.dev == "cpu":
-                        self.model.saveModel(self.saveDir, self.optim, epoch, num_steps)
-                    else:
-                        self.model.module.saveModel(self.saveDir, self.optim, epoch, num_steps)
-                    self.graph_losses()
+                        if is_main_process():
+                            self.loss_log.flush()
+                            if self.dev == "cpu":
+                                self.model.saveModel(self.saveDir, self.optim, epoch, num_steps, self.ema)
+                            else:
+                                self.model.module.saveModel(self.saveDir, self.optim, epoch, num_steps, self.ema)
+                            self.graph_losses()
+
+                            print("Saving model")
 
-                    print("Saving model")
+                    # Record the step telemetry
+                    self.telemetry.end_step(num_steps, self.batchSize*self.numSteps*self.world_size)
             
             if is_main_process():
-                print(f"Loss at epoch #{epoch}, step #{num_steps}, update #{num_steps/self.numSteps}\n"+\
-                        f"Combined: {round(self.losses_comb[-10:].mean(), 4)}    "\
-                        f"Mean: {round(self.losses_mean[-10:].mean(), 4)}    "\
-                        f"Variance: {round(self.losses_var[-10:].mean(), 6)}\n\n")
+                print(f"Loss at epoch #{epoch}, step #{num_steps}\n"+\
+                        f"Combined: {round(self.loss_log.recent('combined', 10).mean(), 4)}    "\
+                        f"Mean: {round(self.loss_log.recent('mean', 10).mean(), 4)}    "\
+                        f"Variance: {round(self.loss_log.recent('variance', 10).mean(), 6)}\n\n")
+
+        # Write the remaining losses and telemetry
+        self.loss_log.flush()
+        self.telemetry.flush()
     
 
 
 
     # Graph the losses through training
+    # The graph is created once and only its data is updated
+    # with the downsampled losses on each call, so the cost of
+    # graphing does not grow with the number of steps.
     def graph_losses(self):
-        plt.clf()
-        fig, ax = plt.subplots()
-
-        ax.set_title("Losses over epochs")
-        ax.set_ylabel("Loss")
-        ax.set_xlabel("Step")
-        # ax.plot(self.epochs_list, self.losses_comb, label="Combined loss")
-        ax.plot(self.steps_list, self.losses_mean, label="Mean loss")
-        # ax.plot(self.epochs_list, self.losses_var, label="Variance loss")
-        ax.legend()
+        if not hasattr(self, "loss_graph"):
+            fig, ax = plt.subplots()
+
+            ax.set_title("Losses over epochs")
+            ax.set_ylabel("Loss")
+            ax.set_xlabel("Step")
+            # line_comb, = ax.plot([], [], label="Combined loss")
+            line_mean, = ax.plot([], [], label="Mean loss")
+            # line_var, = ax.plot([], [], label="Variance loss")
+            ax.legend()
+            self.loss_graph = (fig, ax, line_mean)
+
+        fig, ax, line_mean = self.loss_graph
+        line_mean.set_data(self.loss_log.downsampled("step"), self.loss_log.downsampled("mean"))
+        ax.relim()
+        ax.autoscale_view()
         fig.savefig(self.saveDir + os.sep + "lossGraph.png", format="png")
-        plt.close(fig)
@@ -34,11 +34,27 @@ class U_Net(nn.Module):
     # c_dim - (optional) Vector size for the supplied c vectors
     # dropoutRate - Rate to apply dropout in the model
     # atn_resolution - Resolution of the attention blocks
-    def __init__(self, inCh, outCh, embCh, chMult, t_dim, num_blocks, blk_types, c_dim=None, dropoutRate=0.0, atn_resolution=16):
+    # num_heads - Number of heads in the attention blocks
+    # head_dim - (optional) Number of channels in each head of the
+    #            attention blocks. Overrides num_heads if given.
+    # atn_window - True to use windowed attention in the attention blocks
+    # atn_global - Size of the grid of global tokens in the windowed attention blocks
+    def __init__(self, inCh, outCh, embCh, chMult, t_dim, num_blocks, blk_types, c_dim=None, dropoutRate=0.0, atn_resolution=16, num_heads=1, head_dim=None, atn_window=False, atn_global=0):
         super(U_Net, self).__init__()
 
         self.c_dim = c_dim
 
+        # Make a unetBlock. The windowed attention blocks alternate between
+        # regular and shifted windows over the whole network, in the order
+        # the blocks are applied, so windows exchange information across
+        # their borders even with one attention block in each unetBlock.
+        num_atn = [0]
+        def make_blk(inCh, outCh):
+            blk = unetBlock(inCh, outCh, blk_types, t_dim, c_dim, dropoutRate=dropoutRate, atn_resolution=atn_resolution, num_heads=num_heads,
+                            head_dim=head_dim, atn_window=atn_window, atn_global=atn_global, atn_offset=num_atn[0])
+            num_atn[0] += blk.num_atn
+            return blk
+
         # Input convolution
         self.inConv = nn.Conv2d(inCh, embCh, 7, padding=3)
         
@@ -47,7 +63,7 @@ class U_Net(nn.Module):
         blocks = []
         curCh = embCh
         for i in range(1, num_blocks+1):
-            blocks.append(unetBlock(curCh, embCh*(2**(chMult*i)), blk_types, t_dim, c_dim, dropoutRate=dropoutRate, atn_resolution=atn_resolution))
+            blocks.append(make_blk(curCh, embCh*(2**(chMult*i))))
             if i != num_blocks+1:
                 blocks.append(nn.Conv2d(embCh*(2**(chMult*i)), embCh*(2**(chMult*i)), kernel_size=3, stride=2, padding=1))
             curCh = embCh*(2**(chMult*i))
@@ -62,10 +78,10 @@ class U_Net(nn.Module):
         intermediateCh = curCh
         self.intermediate = nn.Sequential(
             # convNext(intermediateCh, intermediateCh, t_dim, dropoutRate=dropoutRate),
-            unetBlock(intermediateCh, intermediateCh, blk_types, t_dim, c_dim, dropoutRate=dropoutRate, atn_resolution=atn_resolution),
+            make_blk(intermediateCh, intermediateCh),
             Efficient_Channel_Attention(intermediateCh),
             # convNext(intermediateCh, intermediateCh, t_dim, dropoutRate=dropoutRate)
-            unetBlock(intermediateCh, intermediateCh, blk_types, t_dim, c_dim, dropoutRate=dropoutRate, atn_resolution=atn_resolution),
+            make_blk(intermediateCh, intermediateCh),
         )
         
         
@@ -74,11 +90,11 @@ class U_Net(nn.Module):
         blocks = []
         for i in range(num_blocks, -1, -1):
             if i == 0:
-                blocks.append(unetBlock(embCh*(2**(chMult*i)), embCh*(2**(chMult*i)), blk_types, t_dim, c_dim, dropoutRate=dropoutRate, atn_resolution=atn_resolution))
-                blocks.append(unetBlock(embCh*(2**(chMult*i)), outCh, blk_types, t_dim, c_dim, dropoutRate=dropoutRate, atn_resolution=atn_resolution))
+                blocks.append(make_blk(embCh*(2**(chMult*i)), embCh*(2**(chMult*i))))
+                blocks.append(make_blk(embCh*(2**(chMult*i)), outCh))
             else:
                 blocks.append(nn.ConvTranspose2d(embCh*(2**(chMult*(i))), embCh*(2**(chMult*(i))), kernel_size=4, stride=2, padding=1))
-                blocks.append(unetBlock(2*embCh*(2**(chMult*i)), embCh*(2**(chMult*(i-1))), blk_types, t_dim, c_dim, dropoutRate=dropoutRate, atn_resolution=atn_resolution))
+                blocks.append(make_blk(2*embCh*(2**(chMult*i)), embCh*(2**(chMult*(i-1)))))
         self.upBlocks = nn.Sequential(
             *blocks
         )
@@ -104,13 +120,16 @@ class U_Net(nn.Module):
     #       X value of shape (N, t_dim)
     #   c - (optional) Batch of encoded c values
     #       of shape (N, c_dim)
-    def forward(self, X, t, c=None):
+    #   t_projected - True if t was already sent through
+    #                 the time embedding MLP (t_emb)
+    def forward(self, X, t, c=None, t_projected=False):
         # Class embedding assertion
         if type(c) != type(None):
             assert type(self.c_dim) != type(None), "c_dim must be specified when using class information."
 
         # Encode the time embeddings
-        t = self.t_emb(t)
+        if not t_projected:
+            t = self.t_emb(t)
 
         # Saved residuals to add to the upsampling
         residuals = []
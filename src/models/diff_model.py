@@ -10,12 +10,17 @@ try:
     from helpers.image_rescale import reduce_image, unreduce_image
     from blocks.PositionalEncoding import PositionalEncoding
     from blocks.convNext import convNext
+    from blocks.cond_cache import ConditioningCache
+    from helpers.seeded_noise import SampleNoise
 except ModuleNotFoundError:
     from ..helpers.image_rescale import reduce_image, unreduce_image
     from ..blocks.PositionalEncoding import PositionalEncoding
     from ..blocks.convNext import convNext
+    from ..blocks.cond_cache import ConditioningCache
+    from ..helpers.seeded_noise import SampleNoise
 import os
 import json
+from contextlib import nullcontext
 from .Variance_Scheduler import DDIM_Scheduler
 from tqdm import tqdm
 
@@ -53,12 +58,22 @@ class diff_model(nn.Module):
     #               change the name of the saved output file
     # start_epoch - Step to start on. Doesn't do much besides 
     #               change the name of the saved output file
+    # num_heads - Number of heads in the attention blocks ("atn") if used
+    # head_dim - (optional) Number of channels in each head of the attention
+    #            blocks ("atn"). Overrides num_heads if given.
+    # atn_window - True to use windowed attention in the attention blocks ("atn").
+    #              The attention blocks of the whole U-net alternate between
+    #              regular and shifted windows.
+    # atn_global - Size of the grid of global tokens in the windowed attention
+    #              blocks ("atn"). Use 0 for no global tokens.
     def __init__(self, inCh, embCh, chMult, num_blocks,
                  blk_types, T, beta_sched, t_dim, device, 
                  c_dim=None, num_classes=None, 
                  atn_resolution=16, dropoutRate=0.0, 
                  step_size=1, DDIM_scale=0.5,
-                 start_epoch=1, start_step=0):
+                 start_epoch=1, start_step=0,
+                 num_heads=1, head_dim=None,
+                 atn_window=False, atn_global=0):
         super(diff_model, self).__init__()
         
         self.beta_sched = beta_sched
@@ -86,8 +101,14 @@ class diff_model(nn.Module):
             "c_dim": c_dim,
             "num_classes": num_classes,
             "atn_resolution": atn_resolution,
+            "num_heads": num_heads,
+            "head_dim": head_dim,
+            "atn_window": atn_window,
+            "atn_global": atn_global,
             "epoch": start_epoch,
-            "step": start_step
+            "step": start_step,
+            # A step is a model update, not a batch through the model
+            "step_unit": "update"
         }
         
         # Convert the device to a torch device
@@ -115,15 +136,23 @@ class diff_model(nn.Module):
         
         # Convert T to a tensor
         self.T = torch.tensor(T, device=device)
+
+        # Memory format of the weights and inputs
+        self.memory_format = torch.contiguous_format
         
         # U_net model
-        self.unet = U_Net(inCh, inCh*2, embCh, chMult, t_dim, num_blocks, blk_types, c_dim, dropoutRate, atn_resolution).to(device)
+        self.unet = U_Net(inCh, inCh*2, embCh, chMult, t_dim, num_blocks, blk_types, c_dim, dropoutRate, atn_resolution, num_heads, head_dim, atn_window, atn_global).to(device)
         
         # DDIM Variance scheduler for values of beta and alpha
         self.scheduler = DDIM_Scheduler(beta_sched, T, self.step_size, self.device)
             
-        # Used to embed the values of t so the model can use it
-        self.t_emb = PositionalEncoding(t_dim).to(device)
+        # Used to embed the values of t so the model can use it.
+        # The embeddings of all values of t are precomputed.
+        self.t_emb = PositionalEncoding(t_dim, T).to(device)
+
+        # Cached time embeddings after the U-net time MLP
+        self.t_proj = None
+        self.t_proj_key = None
 
         # Used to embed the values of c so the model can use it
         if c_dim != None:
@@ -136,6 +165,13 @@ class diff_model(nn.Module):
         # self.out_var = nn.Conv2d(inCh, inCh, 3, padding=1, groups=inCh)
         self.out_mean = convNext(inCh, inCh).to(device)
         self.out_var = convNext(inCh, inCh).to(device)
+
+        # Cache of the time and class projections of every block
+        # while sampling, shared by all blocks of the model
+        self.cond_cache = ConditioningCache()
+        for m in self.modules():
+            if hasattr(m, "cond_cache"):
+                m.cond_cache = self.cond_cache
             
             
             
@@ -245,8 +281,8 @@ class diff_model(nn.Module):
     #   noise - Batch of noise predictions of shape (B, C, L, W)
     #   v - Batch of v predictions of shape (B, C, L, W)
     def forward(self, x_t, t, c=None, nullCls=None):
-        # Ensure the data is on the correct device
-        x_t = x_t.to(self.device)
+        # Ensure the data is on the correct device and in the memory format of the model
+        x_t = x_t.to(self.device, memory_format=self.memory_format)
         t = t.to(self.device)
         if c != None:
             c = c.to(self.device)
@@ -267,24 +303,18 @@ class diff_model(nn.Module):
                 return
             
             # Encode the timesteps
+            t_projected = False
             if len(t.shape) == 1:
-                t = self.t_emb(t)
+                t, t_projected = self.cond_cache(self, "t", self.embed_t, t)
 
 
         # Embed the class info
         if type(c) != type(None):
-            # One hot encode the class embeddings
-            c = torch.nn.functional.one_hot(c.to(torch.int64), self.num_classes).to(self.device).to(torch.float)
-
-            c = self.c_emb(c)
-
-            # Apply the null embeddings (zeros)
-            if type(nullCls) != type(None):
-                c[nullCls == 1] *= 0
+            c = self.cond_cache(self, "c", self.embed_c, c, nullCls)
         
         # Send the input through the U-net to get
         # the model output
-        out = self.unet(x_t, t, c)
+        out = self.unet(x_t, t, c, t_projected)
 
         # Get the noise and v predictions
         # for the image x_t-1
@@ -298,6 +328,51 @@ class diff_model(nn.Module):
     
     
     
+    # Embed the timesteps. In eval mode, when the weights don't need
+    # gradients, the embeddings of every timestep after the U-net time
+    # MLP are computed once and cached, so embedding t is a lookup.
+    # The cache is remade when the MLP weights change.
+    # Inputs:
+    #   t - Batch of timesteps of shape (N)
+    # Outputs:
+    #   t - Embeddings of shape (N, t_dim)
+    #   t_projected - True if the embeddings were sent through the MLP
+    def embed_t(self, t):
+        mlp_params = list(self.unet.t_emb.parameters())
+        if self.training or t.is_floating_point() or \
+            (torch.is_grad_enabled() and any(p.requires_grad for p in mlp_params)):
+            return self.t_emb(t), False
+
+        # The version changes when a weight is changed in place
+        # and the pointer changes when a weight is moved
+        key = tuple((p._version, p.data_ptr()) for p in mlp_params)
+        if self.t_proj_key != key:
+            with torch.no_grad():
+                self.t_proj = self.unet.t_emb(self.t_emb.table)
+            self.t_proj_key = key
+        return self.t_proj[t], True
+
+
+
+    # Embed the classes
+    # Inputs:
+    #   c - Batch of c values of shape (N)
+    #   nullCls - (Optional) Binary tensor of shape (N) where a 1 represents a null class
+    # Outputs:
+    #   c - Embeddings of shape (N, c_dim)
+    def embed_c(self, c, nullCls=None):
+        # One hot encode the class embeddings
+        c = torch.nn.functional.one_hot(c.to(torch.int64), self.num_classes).to(self.device).to(torch.float)
+
+        c = self.c_emb(c)
+
+        # Apply the null embeddings (zeros)
+        if type(nullCls) != type(None):
+            c[nullCls == 1] *= 0
+        return c
+    
+    
+    
     # Given the mean, variance, and input for a normal distribution,
     # return the output value of the input in the distribution
     # Inputs:
@@ -331,9 +406,11 @@ class diff_model(nn.Module):
     #   w - (optional and only used if the model uses class info) 
     #       Classifier guidance scale factor. Use 0 for no classifier guidance.
     #   corrected - True to put a limit on generation. False to not restrain generation
+    #   noise - (optional) SampleNoise to draw the random noise of each image from.
+    #           By default, the noise is drawn from the global random generator.
     # Outputs:
     #   Image of shape (N, C, L, W) at timestep t-1, unnoised by one timestep
-    def unnoise_batch(self, x_t, t_DDIM, t_DDPM, class_label=-1, w=0.0, corrected=False):
+    def unnoise_batch(self, x_t, t_DDIM, t_DDPM, class_label=-1, w=0.0, corrected=False, noise=None):
         # The model is trained on the DDPM scale while the scheduler
         # uses the DDIM scale as indices. Note that we want the model
         # to think it is at a single timestep before the timestep it generates
@@ -356,6 +433,9 @@ class diff_model(nn.Module):
 
         # Put the model in eval mode
         self.eval()
+
+        # The time projections of the last step are no longer needed
+        self.cond_cache.new_step()
         
         # Make sure t is in the correct form
         if type(t_DDPM) == int or type(t_DDPM) == float:
@@ -387,6 +467,12 @@ class diff_model(nn.Module):
 
         ### Get the model predictions for the noise and v values
 
+        # The class tensors are made once per sampling run so the
+        # conditioning cache reuses the class projections every step
+        def cls(label, null):
+            return self.cond_cache.get(("cls", label, null), lambda: \
+                (torch.tensor([label], device=self.device), torch.tensor([null], device=self.device)))
+
         # If the number of classes is not defined, the model
         # is not a conditioned model.
         if self.num_classes == None:
@@ -398,7 +484,7 @@ class diff_model(nn.Module):
             # If the class label is -1, we only want the
             # unconditioned data
             if class_label == -1:
-                noise_t, v_t = self.forward(x_t, t_DDPM, torch.tensor([0]), torch.tensor([1]))
+                noise_t, v_t = self.forward(x_t, t_DDPM, *cls(0, 1))
 
             # If the class label is not -1, we want both
             # the conditioned and unconditioned data
@@ -407,10 +493,10 @@ class diff_model(nn.Module):
                 if w == 0:
                     noise_t_un = v_t_un = 0
                 else:
-                    noise_t_un, v_t_un = self.forward(x_t, t_DDPM, torch.tensor([0]), torch.tensor([1]))
+                    noise_t_un, v_t_un = self.forward(x_t, t_DDPM, *cls(0, 1))
                 
                 # Conditional sample
-                noise_t_cond, v_t_cond = self.forward(x_t, t_DDPM, torch.tensor([class_label]), torch.tensor([0]))
+                noise_t_cond, v_t_cond = self.forward(x_t, t_DDPM, *cls(class_label, 0))
 
                 # Mixed sample between unconditioned and conditioned
                 noise_t = (1+w)*noise_t_cond - w*noise_t_un
@@ -456,7 +542,10 @@ class diff_model(nn.Module):
         if corrected:
             x_0_pred = x_0_pred.clamp(-1, 1)
         x_t_dir_pred = torch.sqrt(torch.clamp(1-a_bar_t1-beta_tilde_t, 0, torch.inf))*noise_t
-        random_noise = torch.randn((noise_t.shape), device=self.device)*torch.sqrt(var_t)
+        if noise is None:
+            random_noise = torch.randn((noise_t.shape), device=self.device)*torch.sqrt(var_t)
+        else:
+            random_noise = noise.randn(noise_t.shape[1:])*torch.sqrt(var_t)
 
         # Get the output image for this step
         out = sqrt_a_bar_t1*x_0_pred \
@@ -492,17 +581,44 @@ class diff_model(nn.Module):
     #   unreduce - True to unreduce the image to the range [0, 255],
     #              False to keep the image in the range [-1, 1]
     #   corrected - True to put a limit on generation. False to not restrain generation
+    #   cache_cond - True to compute the class projections of the blocks once for all
+    #                steps and the time projections once per step
+    #   seed - (optional) Seed of the images. Each image gets its own random noise
+    #          from (seed, index of the image), so an image is the same no matter
+    #          which batch it's generated in. By default, the global random
+    #          generator is used.
+    #   sample_idxs - (optional) Indices of the images when a seed is given.
+    #                 Defaults to [0, batchSize).
     # Outputs:
     #   output - Output images of shape (N, C, L, W)
     #   imgs - (only if save_intermediate=True) list of iternediate
     #          outputs for the first image i the batch of shape (steps, C, L, W)
     @torch.no_grad()
-    def sample_imgs(self, batchSize, class_label=-1, w=0.0, save_intermediate=False, use_tqdm=False, unreduce=False, corrected=False):
+    def sample_imgs(self, batchSize, class_label=-1, w=0.0, save_intermediate=False, use_tqdm=False, unreduce=False, corrected=False, cache_cond=True, seed=None, sample_idxs=None):
         # Make sure the model is in eval mode
         self.eval()
 
+        # Random noise of each image
+        noise = None
+        if seed is not None:
+            if sample_idxs is None:
+                sample_idxs = range(batchSize)
+            assert len(sample_idxs) == batchSize, "There must be an index for each image"
+            noise = SampleNoise(seed, sample_idxs, self.device)
+
+        # Cache the conditioning projections for the sampling run
+        with self.cond_cache.enable() if cache_cond else nullcontext():
+            return self._sample_imgs(batchSize, class_label, w, save_intermediate, use_tqdm, unreduce, corrected, noise)
+
+
+
+    # Sampling loop of sample_imgs
+    def _sample_imgs(self, batchSize, class_label, w, save_intermediate, use_tqdm, unreduce, corrected, noise=None):
         # The initial image is pure noise
-        output = torch.randn((batchSize, 3, 64, 64)).to(self.device)
+        if noise is None:
+            output = torch.randn((batchSize, 3, 64, 64)).to(self.device, memory_format=self.memory_format)
+        else:
+            output = noise.randn((3, 64, 64)).to(memory_format=self.memory_format)
 
         # Iterate T//step_size times to denoise the images (sampling from [T:1])
         imgs = []
@@ -511,7 +627,7 @@ class diff_model(nn.Module):
             if use_tqdm else zip(reversed(range(1, num_steps+1)), reversed(range(1, self.T+1, self.step_size))):
 
             # Unoise by 1 step according to the DDIM and DDPM scheduler
-            output = self.unnoise_batch(output, t_DDIM, t_DDPM, class_label, w, corrected)
+            output = self.unnoise_batch(output, t_DDIM, t_DDPM, class_label, w, corrected, noise)
             if save_intermediate:
                 imgs.append(unreduce_image(output[0]).cpu().detach().int().clamp(0, 255).permute(1, 2, 0))
         
@@ -524,27 +640,65 @@ class diff_model(nn.Module):
 
 
     
+    # Freeze the model for inference. The model is put in eval mode
+    # and every block that can precompute something that doesn't
+    # change between diffusion steps (like the standardized weights
+    # of the convolutions) does so once. Calling train() unfreezes
+    # the model.
+    # Outputs:
+    #   The model itself
+    def freeze(self):
+        self.eval()
+        for m in self.modules():
+            if m is not self and hasattr(m, "freeze"):
+                m.freeze()
+        return self
+
+
+    
+    # Use the channels last memory format ((N, L, W, C) in memory) in the
+    # whole model, which is usually faster for convolutions on modern
+    # CPUs and GPUs. The weights are converted once and the inputs are
+    # converted when they enter the model. Every block keeps the format
+    # of its input, so the model runs in channels last end to end.
+    # Inputs:
+    #   enabled - True to use channels last, False to use channels first
+    # Outputs:
+    #   The model itself
+    def use_channels_last(self, enabled=True):
+        self.memory_format = torch.channels_last if enabled else torch.contiguous_format
+        return self.to(memory_format=self.memory_format)
+
+
+    
     # Save the model
     # saveDir - Directory to save the model state to
     # optimizer (optional) - Optimizer object to save the state of
     # epoch (optional) - Current epoch of the model (helps when loading state)
     # step (optional) - Current step of the model (helps when loading state)
-    def saveModel(self, saveDir, optimizer, epoch=None, step=None):
+    # ema (optional) - Moving average of the model weights to save. The
+    #                  moving average is saved as a normal model file
+    #                  that can be loaded in place of the model file.
+    def saveModel(self, saveDir, optimizer, epoch=None, step=None, ema=None):
         # Craft the save string
         saveFile = "model"
         optimFile = "optim"
         saveDefFile = "model_params"
+        emaFile = "model_ema"
         if epoch:
             saveFile += f"_{epoch}e"
             optimFile += f"_{epoch}e"
             saveDefFile += f"_{epoch}e"
+            emaFile += f"_{epoch}e"
         if step:
             saveFile += f"_{step}s"
             optimFile += f"_{step}s"
             saveDefFile += f"_{step}s"
+            emaFile += f"_{step}s"
         saveFile += ".pkl"
         optimFile += ".pkl"
         saveDefFile += ".json"
+        emaFile += ".pkl"
 
         # Change epoch and step state if given
         if epoch:
@@ -561,6 +715,8 @@ class diff_model(nn.Module):
         torch.save(self.state_dict(), saveDir + os.sep + saveFile)
         if optimizer:
             torch.save(optimizer.state_dict(), saveDir + os.sep + optimFile)
+        if ema:
+            torch.save(ema.state_dict(), saveDir + os.sep + emaFile)
 
         # Save the defaults
         with open(saveDir + os.sep + saveDefFile, "w") as f:
@@ -582,8 +738,24 @@ class diff_model(nn.Module):
             if "atn_resolution" not in D.keys():
                 D["atn_resolution"] = 16
 
+            # Old models only have a single attention head
+            if "num_heads" not in D.keys():
+                D["num_heads"] = 1
+                D["head_dim"] = None
+
+            # Old models only have patched attention
+            if "atn_window" not in D.keys():
+                D["atn_window"] = False
+                D["atn_global"] = 0
+
+            # Old models count a step for each batch sent through
+            # the model instead of each model update
+            if "step_unit" not in D.keys():
+                D["step_unit"] = "batch"
+
             # Reinitialize the model with the new defaults
-            self.__init__(D["inCh"], D["embCh"], D["chMult"], D["num_blocks"], D["blk_types"], D["T"], D["beta_sched"], D["t_dim"], self.device, D["c_dim"], D["num_classes"], D["atn_resolution"], 0.0, step_size=self.step_size, DDIM_scale=self.DDIM_scale, start_epoch=D["epoch"], start_step=D["step"])
+            self.__init__(D["inCh"], D["embCh"], D["chMult"], D["num_blocks"], D["blk_types"], D["T"], D["beta_sched"], D["t_dim"], self.device, D["c_dim"], D["num_classes"], D["atn_resolution"], 0.0, step_size=self.step_size, DDIM_scale=self.DDIM_scale, start_epoch=D["epoch"], start_step=D["step"], num_heads=D["num_heads"], head_dim=D["head_dim"], atn_window=D["atn_window"], atn_global=D["atn_global"])
+            self.defaults["step_unit"] = D["step_unit"]
 
             # Load the model state
             self.load_state_dict(torch.load(loadDir + os.sep + loadFile, map_location=self.device))
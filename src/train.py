@@ -34,6 +34,10 @@ def str_to_list(s):
 @click.option("--t_dim", "t_dim", type=int, default=512, help="Dimension of the vector encoding for the time information.", required=False)
 @click.option("--c_dim", "c_dim", type=int, default=512, help="Dimension of the vector encoding for the class information. NOTE: Use -1 for no class information", required=False)
 @click.option("--atn_resolution", "atn_resolution", type=int, default=16, help="Resolution of the attention block. The resolution splits the image into patches of that resolution to act as vectors. Ex: a resolution of 16 creates 16x16 patches and flattens them as feature vectors.", required=False)
+@click.option("--num_heads", "num_heads", type=int, default=1, help="Number of heads in the attention block (atn). The channels are split evenly between the heads.", required=False)
+@click.option("--head_dim", "head_dim", type=int, default=-1, help="Number of channels in each head of the attention block (atn). Since the number of channels changes between U-net layers, this keeps the head size fixed (like 32 or 64) instead of the head count. Overrides num_heads. NOTE: Use -1 to use num_heads instead", required=False)
+@click.option("--atn_window", "atn_window", type=bool, default=False, help="True to split the image into non-overlapping windows of size atn_resolution in the attention block (atn) instead of patches. The attention blocks of the whole U-net alternate between regular windows and windows shifted by half a window, in the order they're applied, so information is mixed between windows. The memory used scales linearly with the image size, so attention can be used on large images.", required=False)
+@click.option("--atn_global", "atn_global", type=int, default=0, help="Size of the grid of global tokens when using windowed attention (atn_window). The image is pooled into atn_global x atn_global tokens which every window can attend to. Use 0 for no global tokens.", required=False)
 
 # Training Parameters
 @click.option("--Lambda", "Lambda", type=float, default=0.001, help="Weighting term between the variance and mean loss in the model.", required=False)
@@ -44,9 +48,19 @@ def str_to_list(s):
 @click.option("--lr", "lr", type=float, default=0.0003, help="Model learning rate.", required=False)
 @click.option("--p_uncond", "p_uncond", type=int, default=0.2, help="Probability of training on a null class for classifier-free guidance. Note that good values are 0.1 or 0.2. (only used if c_dim is not None)", required=False)
 @click.option("--use_importance", "use_importance", type=bool, default=False, help="True to use importance sampling for values of t, False to use uniform sampling.", required=False)
+@click.option("--use_ema", "use_ema", type=bool, default=False, help="True to keep an exponential moving average (EMA) of the model weights. The average is saved as an extra model_ema .pkl file which can be used in place of the model .pkl file when generating images.", required=False)
+@click.option("--ema_decay", "ema_decay", type=float, default=0.9999, help="Decay of the EMA of the model weights for each model update.", required=False)
+@click.option("--ema_update_every", "ema_update_every", type=int, default=10, help="Number of steps between updates of the EMA of the model weights. The decay is scaled so the average covers the same number of steps.", required=False)
+@click.option("--ema_warmup", "ema_warmup", type=int, default=5000, help="Number of steps before the EMA starts averaging. Until then, the EMA is a copy of the model weights.", required=False)
+@click.option("--shard_optim", "shard_optim", type=bool, default=False, help="True to shard the optimizer state across all GPUs (ZeRO) instead of keeping a full copy of it on every GPU. This saves memory on large models. The saved optimizer file is the same as when not sharding, so checkpoints can be loaded with or without sharding.", required=False)
+@click.option("--channels_last", "channels_last", type=bool, default=False, help="True to train the model in the channels last memory format, which is usually faster for the convolutions on modern GPUs and CPUs. The saved model can be loaded with or without channels last.", required=False)
 
 # Saving Parameters
 @click.option("--saveDir", "saveDir", type=str, default="models/", help="Directory to save models checkpoints to. NOTE that three files will be saved: the model .pkl file, the model metadata .json file, and the optimizer .pkl file for training reloading", required=False)
+@click.option("--telemetry", "telemetry", type=bool, default=False, help="True to record the time of each phase of a training step (data wait, host to device copy, noising, forward, loss, backward, allreduce, and optimizer), the images per second, peak memory, and the loss for buckets of t values. The records are saved to saveDir.", required=False)
+@click.option("--telemetry_format", "telemetry_format", type=str, default="jsonl", help="Format of the telemetry file. Can be either \"jsonl\" or \"csv\"", required=False)
+@click.option("--telemetry_every", "telemetry_every", type=int, default=100, help="Number of steps between writes to the telemetry file.", required=False)
+@click.option("--profile_steps", "profile_steps", type=str, default="", help="(Optional) Range of steps to run the torch profiler over in the form \"start,end\". The trace is saved to saveDir. EX: \"100,110\"", required=False)
 @click.option("--numSaveSteps", "numSaveSteps", type=int, default=10000, help="Number of steps until a new model checkpoint is saved. This is not the number of epochs, rather it's the number of time the model has updates. NOTE that three files will be saved: the model .pkl file, the model metadata .json file, and the optimizer .pkl file for training reloading.", required=False)
 
 # Model loading Parameters
@@ -55,6 +69,7 @@ def str_to_list(s):
 @click.option("--loadFile", "loadFile", type=str, default="", help="Model .pkl filename to load in. Will looks something like: model_10e_100s.pkl", required=False)
 @click.option("--optimFile", "optimFile", type=str, default="", help="Optimizer .pkl filename to load in. Will looks something like: optim_10e_100s.pkl", required=False)
 @click.option("--loadDefFile", "loadDefFile", type=str, default="", help="Model metadata .json filename to load in. Will looks something like: model_params_10e_100s.json", required=False)
+@click.option("--emaFile", "emaFile", type=str, default="", help="(Optional) Model EMA .pkl filename to load in when using an EMA. Will looks something like: model_ema_10e_100s.pkl. If not given, the EMA starts from the loaded model weights.", required=False)
 
 # Data loading parameters
 @click.option("--reshapeType", "reshapeType", type=str, default="", help="If the data is unequal in size, use this to reshape images up by a power of 2, down a power of 2, or not at all (\"up\", \"down\", \"\")", required=False)
@@ -74,6 +89,10 @@ def train(
     t_dim: int,
     c_dim: int,
     atn_resolution: int,
+    num_heads: int,
+    head_dim: int,
+    atn_window: bool,
+    atn_global: int,
 
     # Training Params
     Lambda: float,
@@ -84,9 +103,19 @@ def train(
     lr: float,
     p_uncond: float,
     use_importance: bool,
+    use_ema: bool,
+    ema_decay: float,
+    ema_update_every: int,
+    ema_warmup: int,
+    shard_optim: bool,
+    channels_last: bool,
 
     # Saving Params
     saveDir: str,
+    telemetry: bool,
+    telemetry_format: str,
+    telemetry_every: int,
+    profile_steps: str,
     numSaveSteps: int,
 
     # Loading params
@@ -95,6 +124,7 @@ def train(
     loadFile: str,
     optimFile: str,
     loadDefFile: str,
+    emaFile: str,
 
     # Data Params
     reshapeType: str
@@ -105,6 +135,10 @@ def train(
     if c_dim == -1:
         c_dim = None
 
+    # Negative head dimension means the number of heads is used
+    if head_dim == -1:
+        head_dim = None
+
     # I never added dropout to the model :/
     dropoutRate = 0.0
 
@@ -116,6 +150,13 @@ def train(
     
     if reshapeType == "":
         reshapeType = None
+
+    # Convert the profiler step range to a tuple
+    if profile_steps == "":
+        profile_steps = None
+    else:
+        profile_steps = tuple(int(s) for s in str_to_list(profile_steps))
+        assert len(profile_steps) == 2, "profile_steps must be in the form \"start,end\""
     
     
     
@@ -138,14 +179,14 @@ def train(
     
     
     ### Model Creation
-    model = diff_model(inCh, embCh, chMult, num_blocks, blk_types, T, beta_sched, t_dim, device, c_dim, num_classes, atn_resolution, dropoutRate)
+    model = diff_model(inCh, embCh, chMult, num_blocks, blk_types, T, beta_sched, t_dim, device, c_dim, num_classes, atn_resolution, dropoutRate, num_heads=num_heads, head_dim=head_dim, atn_window=atn_window, atn_global=atn_global)
     
     # Optional model loading
     if loadModel == True:
         model.loadModel(loadDir, loadFile, loadDefFile)
     
     # Train the model
-    trainer = model_trainer(model, batchSize, numSteps, epochs, lr, device, Lambda, saveDir, numSaveSteps, use_importance, p_uncond, load_into_mem=load_into_mem, optimFile=None if loadModel==False or optimFile==None else loadDir+os.sep+optimFile)
+    trainer = model_trainer(model, batchSize, numSteps, epochs, lr, device, Lambda, saveDir, numSaveSteps, use_importance, p_uncond, load_into_mem=load_into_mem, optimFile=None if loadModel==False or optimFile==None else loadDir+os.sep+optimFile, shard_optim=shard_optim, use_ema=use_ema, ema_decay=ema_decay, ema_update_every=ema_update_every, ema_warmup=ema_warmup, emaFile=None if loadModel==False or emaFile=="" else loadDir+os.sep+emaFile, telemetry=telemetry, telemetry_format=telemetry_format, telemetry_every=telemetry_every, profile_steps=profile_steps, channels_last=channels_last)
     trainer.train(data_path, num_data, cls_min, reshapeType)
     
     
@@ -0,0 +1,85 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import torch
+from torch import nn
+from src.model_trainer import EMA
+
+
+
+
+
+def test():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(4, 8), nn.GroupNorm(2, 8), nn.Linear(8, 2))
+    decay = 0.9
+    update_every = 2
+    warmup = 2
+    ema = EMA(model, decay, update_every, warmup)
+
+    # Reference moving average computed one parameter at a time
+    ref = {n: p.detach().clone() for n, p in model.named_parameters()}
+
+    for step in range(1, 9):
+        # Fake model update
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(torch.randn_like(p))
+        ema.update(step)
+
+        if step % update_every != 0:
+            continue
+        for n, p in model.named_parameters():
+            if step <= warmup:
+                ref[n] = p.detach().clone()
+            else:
+                ref[n] = decay**update_every*ref[n] + (1-decay**update_every)*p.detach()
+
+    # The moving average should match the reference and
+    # have the same layout as the model state dict
+    state = ema.state_dict()
+    assert state.keys() == model.state_dict().keys()
+    for n in ref:
+        assert torch.allclose(state[n], ref[n], atol=1e-6)
+
+    # The moving average should load into the model
+    model.load_state_dict(state)
+
+
+
+# On a GPU, the moving average is updated on a side stream. The
+# update must see the weights written by the model update on the
+# main stream, so it should match an update run synchronously.
+def test_cuda():
+    if not torch.cuda.is_available():
+        return
+    device = torch.device("cuda")
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(2048, 2048), nn.Linear(2048, 2048)).to(device)
+    decay = 0.9
+    ema = EMA(model, decay)
+    ref = [p.detach().clone() for p in model.parameters()]
+
+    for step in range(1, 6):
+        # Slow model update on the main stream, immediately
+        # followed by the moving average update
+        with torch.no_grad():
+            for p in model.parameters():
+                for _ in range(20):
+                    p.mul_(1.01).add_(0.01)
+        ema.update(step)
+        ema.wait()
+
+        torch.cuda.synchronize()
+        for r, p in zip(ref, model.parameters()):
+            r.mul_(decay).add_(p.detach(), alpha=1-decay)
+        for s, r in zip(ema.shadow, ref):
+            assert torch.allclose(s, r, rtol=1e-5, atol=1e-5)
+
+
+
+
+if __name__ == "__main__":
+    test()
+    test_cuda()
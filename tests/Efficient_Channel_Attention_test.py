@@ -0,0 +1,96 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import time
+import torch
+from src.blocks.Efficient_Channel_Attention import Efficient_Channel_Attention
+
+
+
+
+
+# The original implementation with pooling, permutes,
+# and a (1, k) conv
+def reference(eca, X):
+    att = torch.nn.functional.adaptive_avg_pool2d(X, 1)
+    att = att.permute(0, 2, 3, 1)
+    att = eca.conv(att)
+    att = torch.sigmoid(att)
+    att = att.permute(0, 3, 1, 2)
+    return X * att.expand_as(X)
+
+
+
+def test():
+    torch.manual_seed(0)
+    for C in [16, 64, 257]:
+        eca = Efficient_Channel_Attention(C).double()
+        with torch.no_grad():
+            eca.conv.weight.normal_()
+        X = torch.randn(3, C, 5, 7, dtype=torch.double, requires_grad=True)
+
+        # Same output and gradients as the original implementation
+        out = eca(X)
+        ref = reference(eca, X)
+        assert torch.allclose(out, ref)
+        g = torch.randn_like(out)
+        grads = torch.autograd.grad(out, (X, eca.conv.weight), g)
+        grads_ref = torch.autograd.grad(ref, (X, eca.conv.weight), g)
+        for a, b in zip(grads, grads_ref):
+            assert torch.allclose(a, b)
+        assert torch.autograd.gradcheck(eca, (X[:1, :, :2, :2].detach().requires_grad_(),))
+
+        # Channels last inputs stay channels last
+        X_cl = X.detach().to(memory_format=torch.channels_last)
+        out_cl = eca(X_cl)
+        assert out_cl.is_contiguous(memory_format=torch.channels_last)
+        assert torch.allclose(out_cl, ref)
+
+    # The parameters didn't change so old checkpoints load
+    assert list(eca.state_dict().keys()) == ["conv.weight"]
+
+
+
+
+
+# Benchmark the fused and original implementations at small batch sizes.
+# The two are timed in turns and the fastest of the repeats is kept,
+# so noise from other processes doesn't favor either one.
+def benchmark():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    num_iters = 200
+    repeats = 5
+
+    def run(fn, X):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            fn(X)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return (time.perf_counter()-start)/num_iters*1e6
+
+    print(f"Device: {device}")
+    print(f"{'batch':>6} {'channels':>9} {'size':>5} {'orig us':>9} {'fused us':>9} {'speedup':>8}")
+    for N in [1, 2, 4, 8]:
+        for C, L in [(128, 64), (256, 32), (512, 16), (512, 4)]:
+            eca = Efficient_Channel_Attention(C).to(device)
+            X = torch.randn(N, C, L, L, device=device)
+            t_ref, t_fused = float("inf"), float("inf")
+            with torch.no_grad():
+                for _ in range(10):
+                    reference(eca, X), eca(X)
+                for _ in range(repeats):
+                    t_ref = min(t_ref, run(lambda X: reference(eca, X), X))
+                    t_fused = min(t_fused, run(eca, X))
+            print(f"{N:6d} {C:9d} {L:5d} {t_ref:9.1f} {t_fused:9.1f} {t_ref/t_fused:7.2f}x")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
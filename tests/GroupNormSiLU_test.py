@@ -0,0 +1,120 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import time
+import torch
+from src.blocks.wideResNet import Block, GroupNormSiLU
+
+
+
+
+
+def test():
+    torch.manual_seed(0)
+    N = 2
+    C = 16
+
+    # The fused function should have the correct gradients
+    # with embeddings for each sample or one embedding for all samples
+    for t_N, c_N in [(None, None), (N, None), (N, N), (1, 1), (N, 1)]:
+        x = torch.randn(N, C, 5, 5, dtype=torch.float64, requires_grad=True)
+        weight = torch.randn(C, dtype=torch.float64, requires_grad=True)
+        bias = torch.randn(C, dtype=torch.float64, requires_grad=True)
+        t = torch.randn(t_N, C, 1, 1, dtype=torch.float64, requires_grad=True) if t_N else None
+        c = torch.randn(c_N, C, 1, 1, dtype=torch.float64, requires_grad=True) if c_N else None
+        assert torch.autograd.gradcheck(lambda *a: GroupNormSiLU.apply(*a, 4, 1e-5), (x, weight, bias, t, c))
+
+    # The fused block should be the same as the unfused block
+    blk = Block(8, C, groups=4)
+    with torch.no_grad():
+        blk.norm.weight.normal_()
+        blk.norm.bias.normal_()
+    x = torch.randn(N, 8, 8, 8, requires_grad=True)
+    t = torch.randn(N, C, 1, 1, requires_grad=True)
+    c = torch.randn(N, C, 1, 1, requires_grad=True)
+    inputs = [x, t, c] + list(blk.parameters())
+
+    out = blk(x, t, c)
+    grads = torch.autograd.grad(out.square().sum(), inputs)
+    blk.fused = False
+    ref = blk(x, t, c)
+    ref_grads = torch.autograd.grad(ref.square().sum(), inputs)
+
+    assert torch.allclose(out, ref, atol=1e-5)
+    for g, g_ref in zip(grads, ref_grads):
+        assert torch.allclose(g, g_ref, atol=1e-4)
+
+    # The statistics stay exact for inputs with a large mean compared
+    # to their spread. The reference is computed in float64.
+    weight, bias = torch.randn(C), torch.randn(C)
+    for offset in [0, 10, 100, 1000]:
+        for memory_format in [torch.contiguous_format, torch.channels_last]:
+            h = (torch.randn(N, C, 8, 8) + offset).contiguous(memory_format=memory_format)
+            out = GroupNormSiLU.apply(h, weight, bias, None, None, 4, 1e-5)
+            ref = torch.nn.functional.silu(torch.nn.functional.group_norm(h.double(), 4, weight.double(), bias.double(), 1e-5))
+            assert torch.allclose(out.double(), ref, atol=1e-3)
+
+    # A single (1, C) class embedding is broadcast over the batch,
+    # like the class of a guided sampling run
+    c = torch.randn(1, C, 1, 1)
+    with torch.no_grad():
+        blk.fused = True
+        out = blk(x, t, c)
+        blk.fused = False
+        assert torch.allclose(out, blk(x, t, c.expand(N, -1, -1, -1)), atol=1e-5)
+
+
+
+
+
+# Benchmark the memory and latency of the fused and unfused
+# blocks over different channel and image sizes
+def benchmark():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    N = 32
+    num_iters = 10
+
+    print(f"Device: {device}, batch size: {N}")
+    print(f"{'channels':>8} {'size':>5} {'impl':>7} {'fwd+bwd ms':>11} {'saved MB':>9} {'peak MB':>9}")
+    for C, L in [(128, 64), (256, 32), (512, 16)]:
+        blk = Block(C, C, groups=8).to(device)
+        x = torch.randn(N, C, L, L, device=device, requires_grad=True)
+        t = torch.randn(N, C, 1, 1, device=device, requires_grad=True)
+        c = torch.randn(N, C, 1, 1, device=device, requires_grad=True)
+        for fused in [False, True]:
+            blk.fused = fused
+
+            # Warmup and size of the tensors saved for the backward pass
+            saved = []
+            def pack(tensor):
+                saved.append(tensor.numel()*tensor.element_size())
+                return tensor
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                out = blk(x, t, c)
+            out.sum().backward()
+            saved_mem = sum(saved)/2**20
+
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                base_mem = torch.cuda.memory_allocated()
+            start = time.perf_counter()
+            for _ in range(num_iters):
+                blk(x, t, c).sum().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                peak_mem = f"{(torch.cuda.max_memory_allocated()-base_mem)/2**20:9.1f}"
+            else:
+                peak_mem = f"{'n/a':>9}"
+            ms = (time.perf_counter()-start)/num_iters*1000
+
+            print(f"{C:>8} {L:>5} {'fused' if fused else 'unfused':>7} {ms:11.2f} {saved_mem:9.1f} {peak_mem}")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
@@ -0,0 +1,210 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import time
+import torch
+from src.blocks.Multihead_Attn import Multihead_Attn
+
+
+
+
+
+def test():
+    torch.manual_seed(0)
+    N = 2
+    C = 16
+
+    # Patched attention (16x16 patches of a 32x32 image)
+    # and full attention over the whole 16x16 image
+    for L, res, num_heads in [(32, 16, 1), (16, 16, 1), (8, 16, 1), (32, 16, 4), (16, 16, 4)]:
+        atn = Multihead_Attn(C, num_heads=num_heads, resolution=res, spatial=True)
+        if not atn.use_sdpa:
+            break
+
+        X = torch.randn(N, C, L, L, requires_grad=True)
+
+        # Fused attention
+        out_sdpa = atn(X)
+        out_sdpa.square().sum().backward()
+        grad_sdpa = X.grad.clone()
+        X.grad = None
+
+        # Einsum attention
+        atn.use_sdpa = False
+        out_einsum = atn(X)
+        out_einsum.square().sum().backward()
+        grad_einsum = X.grad.clone()
+
+        # The output shape should be the same as the input shape
+        assert out_sdpa.shape == X.shape
+
+        # Both implementations should be the same
+        assert torch.allclose(out_sdpa, out_einsum, atol=1e-5)
+        assert torch.allclose(grad_sdpa, grad_einsum, atol=1e-4)
+
+    # Each head should attend over its own channels
+    L = 8
+    atn = Multihead_Attn(C, resolution=L, spatial=True, head_dim=4)
+    assert atn.num_heads == 4
+    X = torch.randn(N, C, L, L)
+    with torch.no_grad():
+        K, Q, V = atn.KQV_weight(atn.LN(X)).flatten(2).chunk(3, dim=1)
+        Out = []
+        for h in range(atn.num_heads):
+            c = slice(h*4, (h+1)*4)
+            A = torch.softmax(Q[:, c].transpose(1, 2) @ K[:, c] * atn.norm_factor, -1)
+            Out.append(V[:, c] @ A.transpose(1, 2))
+        ref = atn.O_conv(torch.cat(Out, 1).unflatten(-1, (L, L))) + X
+        for use_sdpa in [False, atn.use_sdpa]:
+            atn.use_sdpa = use_sdpa
+            assert torch.allclose(atn(X), ref, atol=1e-5)
+
+    # Windowed attention should be the same as full attention
+    # where tokens can only see tokens in the same (shifted)
+    # window and the global tokens
+    for L, res, num_heads, shift, num_global in [(16, 8, 1, False, 0), (16, 8, 2, True, 0), (16, 4, 2, True, 2), (8, 16, 2, True, 2)]:
+        atn = Multihead_Attn(C, num_heads=num_heads, resolution=res, spatial=True, window=True, shift=shift, num_global=num_global)
+        X = torch.randn(N, C, L, L, requires_grad=True)
+        ref = window_reference(atn, X)
+        for use_sdpa in [False, atn.use_sdpa]:
+            atn.use_sdpa = use_sdpa
+            out = atn(X)
+            assert torch.allclose(out, ref, atol=1e-5)
+            grad = torch.autograd.grad(out.square().sum(), X)[0]
+            assert torch.allclose(grad, torch.autograd.grad(ref.square().sum(), X, retain_graph=True)[0], atol=1e-4)
+
+
+
+
+
+# Windowed attention computed with full attention and an (LW, LW) mask
+def window_reference(atn, X):
+    N, C, L, W = X.shape
+    r = min(atn.resolution, L)
+    d = C//atn.num_heads
+    g = atn.num_global
+    shift = atn.resolution//2 if atn.shift and r < L else 0
+
+    X_norm = atn.LN(X)
+    K, Q, V = atn.KQV_weight(torch.roll(X_norm, (-shift, -shift), (2, 3))).flatten(2).chunk(3, dim=1)
+
+    # Window and region of each token in the shifted image
+    i = torch.arange(L)
+    win = ((i[:, None]//r)*(W//r) + i[None, :]//r).flatten()
+    region = (i >= L-r).long() + (i >= L-shift).long() if shift > 0 else torch.zeros(L).long()
+    region = (region[:, None]*3 + region[None, :]).flatten()
+    allowed = (win[:, None] == win[None, :]) & (region[:, None] == region[None, :])
+
+    if g > 0:
+        G_K, _, G_V = atn.KQV_weight(torch.nn.functional.adaptive_avg_pool2d(X_norm, g)).flatten(2).chunk(3, dim=1)
+        K = torch.cat((K, G_K), -1)
+        V = torch.cat((V, G_V), -1)
+        allowed = torch.cat((allowed, torch.ones(L*W, g*g, dtype=torch.bool)), -1)
+
+    Out = []
+    for h in range(atn.num_heads):
+        c = slice(h*d, (h+1)*d)
+        A = (Q[:, c].transpose(1, 2) @ K[:, c] * atn.norm_factor).masked_fill(~allowed, float("-inf"))
+        Out.append(V[:, c] @ torch.softmax(A, -1).transpose(1, 2))
+    Out = torch.roll(torch.cat(Out, 1).unflatten(-1, (L, W)), (shift, shift), (2, 3))
+    return atn.O_conv(Out) + X
+
+
+
+
+
+# Benchmark the memory and latency of the fused and einsum
+# attention over different image sizes
+def benchmark():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    N = 32
+    C = 256
+    num_iters = 10
+
+    print(f"Device: {device}, batch size: {N}, channels: {C}")
+    print(f"{'size':>6} {'atn res':>8} {'impl':>7} {'fwd+bwd ms':>11} {'peak MB':>9}")
+    for L in [8, 16, 32]:
+        for res in sorted({16, L}):
+            for use_sdpa in [False, True]:
+                atn = Multihead_Attn(C, resolution=res, spatial=True, use_sdpa=use_sdpa).to(device)
+                X = torch.randn(N, C, L, L, device=device, requires_grad=True)
+
+                # Warmup
+                atn(X).sum().backward()
+
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                    base_mem = torch.cuda.memory_allocated()
+                start = time.perf_counter()
+                for _ in range(num_iters):
+                    atn(X).sum().backward()
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                    peak_mem = f"{(torch.cuda.max_memory_allocated()-base_mem)/2**20:9.1f}"
+                else:
+                    peak_mem = f"{'n/a':>9}"
+                ms = (time.perf_counter()-start)/num_iters*1000
+
+                print(f"{L:>6} {res:>8} {'sdpa' if use_sdpa else 'einsum':>7} {ms:11.2f} {peak_mem}")
+
+
+
+
+
+# Benchmark the memory and latency of full attention, the patches,
+# and the (shifted) windows over different image sizes
+def benchmark_windows():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    N = 2
+    C = 128
+    res = 16
+    num_iters = 5
+    modes = {
+        "full": lambda L: dict(resolution=L),
+        "patch": lambda L: dict(resolution=res),
+        "window": lambda L: dict(resolution=res, window=True),
+        "shift": lambda L: dict(resolution=res, window=True, shift=True),
+        "shift+global": lambda L: dict(resolution=res, window=True, shift=True, num_global=4),
+    }
+
+    print(f"Device: {device}, batch size: {N}, channels: {C}, window: {res}")
+    print(f"{'size':>6} {'mode':>13} {'fwd+bwd ms':>11} {'peak MB':>9}")
+    for L in [16, 32, 64]:
+        for mode, kwargs in modes.items():
+            atn = Multihead_Attn(C, num_heads=4, spatial=True, **kwargs(L)).to(device)
+            X = torch.randn(N, C, L, L, device=device, requires_grad=True)
+
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                base_mem = torch.cuda.memory_allocated()
+
+            # Warmup. Full attention may not fit in memory.
+            try:
+                atn(X).sum().backward()
+            except RuntimeError:
+                print(f"{L:>6} {mode:>13} {'OOM':>11}")
+                continue
+
+            start = time.perf_counter()
+            for _ in range(num_iters):
+                atn(X).sum().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                peak_mem = f"{(torch.cuda.max_memory_allocated()-base_mem)/2**20:9.1f}"
+            else:
+                peak_mem = f"{'n/a':>9}"
+            ms = (time.perf_counter()-start)/num_iters*1000
+
+            print(f"{L:>6} {mode:>13} {ms:11.2f} {peak_mem}")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
+    benchmark_windows()
@@ -0,0 +1,62 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import io
+import contextlib
+import torch
+from src.blocks.PositionalEncoding import PositionalEncoding
+from src.models.diff_model import diff_model
+
+
+
+
+
+def test():
+    torch.manual_seed(0)
+    T = 100
+
+    # The table should have the same embeddings as computing them
+    enc = PositionalEncoding(32, T)
+    t = torch.randint(0, T+1, (16,))
+    assert enc.table.shape == (T+1, 32)
+    assert torch.equal(enc(t), enc.make_embeddings(t))
+    assert torch.equal(enc(t.float()), enc.make_embeddings(t.float()))
+
+    # The table shouldn't be saved with the model
+    assert "table" not in enc.state_dict() and "denom" not in enc.state_dict()
+
+    # The warning should only be printed once
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        PositionalEncoding(32, T)
+    assert out.getvalue() == ""
+
+    # The cached embeddings after the time MLP should give
+    # the same output as the model in training mode
+    model = diff_model(3, 8, 1, 1, ["res"], T, "cosine", 32, "cpu", 32, 10, 8, 0.0)
+    X = torch.randn(2, 3, 8, 8)
+    t = torch.tensor([1, T])
+    c = torch.tensor([0, 1])
+    ref = model(X, t, c)
+    model.eval()
+    with torch.no_grad():
+        out = model(X, t, c)
+        assert model.t_proj is not None
+        for o, o_ref in zip(out, ref):
+            assert torch.allclose(o, o_ref, atol=1e-6)
+
+        # Changing the MLP weights remakes the cache
+        model.unet.t_emb[0].weight.add_(1)
+        out = model(X, t, c)
+    model.train()
+    ref = model(X, t, c)
+    for o, o_ref in zip(out, ref):
+        assert torch.allclose(o, o_ref, atol=1e-6)
+
+
+
+
+
+if __name__ == "__main__":
+    test()
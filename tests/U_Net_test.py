@@ -45,6 +45,30 @@ def test():
     
     
     
+
+
+
+def test_shifted_windows():
+    # With one attention block in each unetBlock, the windowed
+    # attention blocks still alternate between regular and
+    # shifted windows in the order they are applied
+    net = U_Net(3, 3, 8, 1, 16, 2, ["res", "atn"], atn_resolution=4, atn_window=True)
+    shifts = [m.shift for m in net.modules() if type(m).__name__ == "Multihead_Attn"]
+    assert len(shifts) == 8
+    assert shifts == [i % 2 == 1 for i in range(len(shifts))]
+
+    # Two attention blocks in each unetBlock also alternate
+    net = U_Net(3, 3, 8, 1, 16, 1, ["res", "atn", "res", "atn"], atn_resolution=4, atn_window=True)
+    shifts = [m.shift for m in net.modules() if type(m).__name__ == "Multihead_Attn"]
+    assert shifts == [i % 2 == 1 for i in range(len(shifts))]
+
+    X = torch.rand(2, 3, 16, 16)
+    assert net(X, torch.rand(2, 16)).shape == X.shape
+    
+    
+    
+    
     
 if __name__ == "__main__":
-    test()
\ No newline at end of file
+    test()
+    test_shifted_windows()
\ No newline at end of file
@@ -0,0 +1,65 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import torch
+from src.blocks.wideResNet import WeightStandardizedConv2d, ResnetBlock
+
+
+
+
+
+def test():
+    torch.manual_seed(0)
+    conv = WeightStandardizedConv2d(8, 16, 3, padding=1)
+    X = torch.randn(2, 8, 8, 8)
+    ref = conv(X)
+
+    # In eval mode without gradients, the weights are cached
+    conv.eval()
+    with torch.no_grad():
+        assert torch.allclose(conv(X), ref, atol=1e-6)
+        cached = conv.cached_weight
+        conv(X)
+        assert conv.cached_weight is cached
+
+    # Changing the weights clears the cache
+    optim = torch.optim.SGD(conv.parameters(), lr=0.1)
+    conv.train()
+    conv(X).sum().backward()
+    optim.step()
+    ref = conv.train()(X)
+    conv.eval()
+    with torch.no_grad():
+        assert torch.allclose(conv(X), ref, atol=1e-6)
+
+    # Loading weights clears the cache
+    conv2 = WeightStandardizedConv2d(8, 16, 3, padding=1)
+    conv.load_state_dict(conv2.state_dict())
+    with torch.no_grad():
+        assert torch.allclose(conv(X), conv2(X), atol=1e-6)
+
+    # Gradients still go to the weights in eval mode
+    conv.weight.grad = None
+    conv(X).sum().backward()
+    assert conv.weight.grad is not None
+
+    # A frozen block always uses the cache until train() is called
+    blk = ResnetBlock(8, 16, 4)
+    t = torch.randn(2, 4)
+    ref = blk(X, t)
+    for m in blk.modules():
+        if hasattr(m, "freeze"):
+            m.freeze()
+    blk.eval()
+    assert torch.allclose(blk(X, t), ref, atol=1e-6)
+    assert blk.block1.proj.cached_weight is not None
+    blk.train()
+    assert not blk.block1.proj.frozen and blk.block1.proj.cached_weight is None
+
+
+
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,123 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import copy
+import time
+import torch
+from src.models.diff_model import diff_model
+from src.blocks.wideResNet import GroupNormSiLU
+
+
+
+
+
+def test():
+    torch.manual_seed(0)
+    N = 2
+    blk_types = ["res", "conv", "clsAtn", "chnAtn", "atn", "atn"]
+    for atn_window in [False, True]:
+        model = diff_model(3, 16, 1, 2, blk_types, 100, "cosine", 32, "cpu", 32, 10, 8, 0.0, atn_window=atn_window, atn_global=2)
+        model_cl = copy.deepcopy(model).use_channels_last()
+
+        # Every block should keep the channels last format
+        not_cl = []
+        def hook(mod, inp, out):
+            if torch.is_tensor(out) and out.dim() == 4 and out.shape[1] > 1 and not out.is_contiguous(memory_format=torch.channels_last):
+                not_cl.append(type(mod).__name__)
+        for mod in model_cl.unet.modules():
+            mod.register_forward_hook(hook)
+
+        X = torch.randn(N, 3, 16, 16)
+        t = torch.randint(1, 100, (N,))
+        c = torch.randint(0, 10, (N,))
+        nullCls = torch.tensor([0, 1])
+
+        out = model(X, t, c, nullCls)
+        out_cl = model_cl(X, t, c, nullCls)
+        assert not_cl == [], f"Blocks not in channels last: {set(not_cl)}"
+
+        # The outputs and gradients should be the same in both formats
+        sum(o.square().sum() for o in out).backward()
+        sum(o.square().sum() for o in out_cl).backward()
+        for o, o_cl in zip(out, out_cl):
+            assert torch.allclose(o, o_cl, atol=1e-4)
+        params_cl = dict(model_cl.named_parameters())
+        for name, p in model.named_parameters():
+            if not p.requires_grad:
+                continue
+            assert torch.allclose(p.grad, params_cl[name].grad, atol=1e-3), name
+
+        # The channels last weights should load into a normal model
+        model.load_state_dict(model_cl.state_dict())
+
+    # Channels last statistics and gradients of the fused block
+    x = torch.randn(N, 16, 8, 8, dtype=torch.float64).to(memory_format=torch.channels_last).requires_grad_()
+    weight = torch.randn(16, dtype=torch.float64, requires_grad=True)
+    bias = torch.randn(16, dtype=torch.float64, requires_grad=True)
+    t = torch.randn(N, 16, 1, 1, dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(lambda *a: GroupNormSiLU.apply(*a, None, 4, 1e-5), (x, weight, bias, t))
+    assert GroupNormSiLU.apply(x, weight, bias, t, None, 4, 1e-5).is_contiguous(memory_format=torch.channels_last)
+
+
+
+
+
+# Benchmark the training and sampling throughput of
+# the model in the channels first and last formats
+def benchmark():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    N = 16
+    L = 64
+    num_iters = 5
+
+    print(f"Device: {device}, batch size: {N}, image size: {L}")
+    print(f"{'format':>14} {'train imgs/s':>13} {'sample imgs/s':>14}")
+    for channels_last in [False, True]:
+        torch.manual_seed(0)
+        model = diff_model(3, 64, 1, 3, ["res", "clsAtn", "chnAtn"], 1000, "cosine", 128, device, 128, 1000, 16, 0.0, step_size=100)
+        model.use_channels_last(channels_last)
+        optim = torch.optim.AdamW(model.parameters())
+        X = torch.randn(N, 3, L, L, device=device)
+        t = torch.randint(1, 1000, (N,), device=device)
+        c = torch.randint(0, 1000, (N,), device=device)
+
+        # Training steps
+        model.train()
+        def train_step():
+            optim.zero_grad()
+            sum(o.square().mean() for o in model(X, t, c)).backward()
+            optim.step()
+        train_step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            train_step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        train_ips = N*num_iters/(time.perf_counter()-start)
+
+        # Sampling steps
+        model.freeze()
+        x_t = torch.randn(N, 3, L, L, device=device).to(memory_format=model.memory_format)
+        with torch.no_grad():
+            model.unnoise_batch(x_t, 10, 901, 0, 4.0)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(num_iters):
+                model.unnoise_batch(x_t, 10, 901, 0, 4.0)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+        sample_ips = N*num_iters/(time.perf_counter()-start)
+
+        print(f"{'channels last' if channels_last else 'channels first':>14} {train_ips:13.2f} {sample_ips:14.2f}")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
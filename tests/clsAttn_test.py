@@ -0,0 +1,109 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import time
+import torch
+from src.blocks.clsAttn import clsAttn, clsAttn_Linear
+
+
+
+
+
+# Original clsAttn forward pass which builds the (N, inCh, inCh)
+# attention matrix
+def clsAttn_reference(atn, X, cls):
+    res = X.clone()
+    X = atn.LN(X)
+    K, Q = atn.Q_emb(cls).unsqueeze(-1), atn.K_emb(cls).unsqueeze(-1)
+    KQ = atn.softmax((K@Q.permute(0, 2, 1))/torch.sqrt(atn.inCh))
+    X = torch.einsum("nclw, ncd -> nclw", X, KQ)
+    return atn.out_emb(X) + res
+
+
+
+
+
+def test():
+    torch.manual_seed(0)
+    N = 4
+    cls_dim = 32
+
+    for C in [8, 64]:
+        atn = clsAttn(cls_dim, C)
+        X = torch.randn(N, C, 8, 8, requires_grad=True)
+        cls = torch.randn(N, cls_dim)
+
+        # The keys and queries have no effect on the output, so they're frozen
+        # and every trained parameter gets a gradient. DDP can then be used
+        # without find_unused_parameters.
+        frozen = [n for n, p in atn.named_parameters() if not p.requires_grad]
+        assert sorted(frozen) == ["K_emb.bias", "K_emb.weight", "Q_emb.bias", "Q_emb.weight"]
+        params = [p for p in atn.parameters() if p.requires_grad]
+
+        out = atn(X, cls)
+        grads = torch.autograd.grad(out.square().sum(), [X] + params)
+
+        ref = clsAttn_reference(atn, X, cls)
+        ref_grads = torch.autograd.grad(ref.square().sum(), [X] + params)
+
+        # The output and gradients should be the same as the full attention matrix
+        assert torch.allclose(out, ref, atol=1e-5)
+        for g, g_ref in zip(grads, ref_grads):
+            assert g is not None
+            assert torch.allclose(g, g_ref, atol=1e-4)
+
+        # The keys and queries are still saved, so old models load
+        atn.load_state_dict(clsAttn(cls_dim, C).state_dict())
+        assert not atn.Q_emb.weight.requires_grad
+
+    # The linear attention should return the output
+    atn = clsAttn_Linear(cls_dim, 16)
+    assert atn(torch.randn(N, 16, 8, 8), torch.randn(N, cls_dim)).shape == (N, 16, 8, 8)
+
+
+
+
+
+# Benchmark the memory and latency of the original attention
+# matrix and the new implementation over different channel sizes
+def benchmark():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    N = 32
+    L = 16
+    cls_dim = 512
+    num_iters = 10
+
+    print(f"Device: {device}, batch size: {N}, image size: {L}")
+    print(f"{'channels':>8} {'impl':>9} {'fwd+bwd ms':>11} {'peak MB':>9}")
+    for C in [128, 256, 512, 1024]:
+        atn = clsAttn(cls_dim, C).to(device)
+        X = torch.randn(N, C, L, L, device=device, requires_grad=True)
+        cls = torch.randn(N, cls_dim, device=device)
+        for impl, fn in [("reference", lambda: clsAttn_reference(atn, X, cls)), ("gate", lambda: atn(X, cls))]:
+            # Warmup
+            fn().sum().backward()
+
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                base_mem = torch.cuda.memory_allocated()
+            start = time.perf_counter()
+            for _ in range(num_iters):
+                fn().sum().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                peak_mem = f"{(torch.cuda.max_memory_allocated()-base_mem)/2**20:9.1f}"
+            else:
+                peak_mem = f"{'n/a':>9}"
+            ms = (time.perf_counter()-start)/num_iters*1000
+
+            print(f"{C:>8} {impl:>9} {ms:11.2f} {peak_mem}")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
@@ -0,0 +1,95 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import time
+import tempfile
+import numpy as np
+from scipy.linalg import sqrtm
+from eval.compute_FID import FID_Reference, sqrt_psd, compute_FID_multiple
+
+
+
+
+
+# Original FID with scipy's sqrtm of the covariance product
+def FID_reference(mean1, var1, mean2, var2):
+    covmean = sqrtm(var1.dot(var2))
+    if np.iscomplexobj(covmean):
+        covmean = covmean.real
+    return np.sum((mean1 - mean2)**2.0) + np.trace(var1 + var2 - 2.0 * covmean)
+
+
+
+# Random mean and covariance from N features
+def random_stats(rng, D, N):
+    feats = rng.standard_normal((N, D)) @ rng.standard_normal((D, D))
+    return feats.mean(0), np.cov(feats, rowvar=False)
+
+
+
+def test():
+    rng = np.random.default_rng(0)
+    D = 64
+
+    # Full rank and rank deficient (fewer features than dims) covariances
+    mean1, var1 = random_stats(rng, D, 1000)
+    stats = [random_stats(rng, D, 1000), random_stats(rng, D, 40), (mean1, var1)]
+
+    S = sqrt_psd(var1)
+    assert np.allclose(S @ S, var1)
+
+    ref = FID_Reference(mean1, var1)
+    for mean2, var2 in stats:
+        assert np.isclose(ref.score(mean2, var2), FID_reference(mean1, var1, mean2, var2), rtol=1e-6, atol=1e-6)
+
+    # The FID of the reference with itself is 0
+    assert abs(ref.score(mean1, var1)) < 1e-6
+
+    # Scoring files against a reference file
+    with tempfile.TemporaryDirectory() as tmp:
+        np.save(tmp + os.sep + "real_mean.npy", mean1)
+        np.save(tmp + os.sep + "real_var.npy", var1)
+        files = []
+        for i, (mean2, var2) in enumerate(stats):
+            files.append((tmp + os.sep + f"mean_{i}.npy", tmp + os.sep + f"var_{i}.npy"))
+            np.save(files[-1][0], mean2)
+            np.save(files[-1][1], var2)
+        fids = compute_FID_multiple(files, tmp + os.sep + "real_mean.npy", tmp + os.sep + "real_var.npy")
+        assert np.allclose(fids, [ref.score(m, v) for m, v in stats])
+
+
+
+
+
+# Benchmark scoring checkpoints against the same reference
+def benchmark():
+    rng = np.random.default_rng(0)
+    D = 2048
+    num_ckpts = 5
+    mean1, var1 = random_stats(rng, D, 4096)
+    stats = [random_stats(rng, D, 4096) for _ in range(num_ckpts)]
+
+    start = time.perf_counter()
+    fids_ref = [FID_reference(mean1, var1, m, v) for m, v in stats]
+    t_ref = time.perf_counter()-start
+
+    start = time.perf_counter()
+    ref = FID_Reference(mean1, var1)
+    t_setup = time.perf_counter()-start
+    start = time.perf_counter()
+    fids = [ref.score(m, v) for m, v in stats]
+    t_score = time.perf_counter()-start
+
+    print(f"{num_ckpts} checkpoints, D={D}")
+    print(f"sqrtm: {t_ref/num_ckpts:.2f}s per checkpoint")
+    print(f"eigh: {t_setup:.2f}s reference setup, {t_score/num_ckpts:.2f}s per checkpoint")
+    print(f"max abs difference: {np.max(np.abs(np.array(fids)-np.array(fids_ref))):.2e}")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
@@ -0,0 +1,75 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import pickle
+import zipfile
+import tempfile
+import numpy as np
+import torch
+from eval.compute_imagenet_stats import compute_imagenet_stats
+from eval.compute_model_stats import normalize
+from tests.stand_ins import load_extractor
+
+
+
+
+
+# Fails if the statistics aren't loaded from the cache
+def no_extractor(device):
+    assert False, "The statistics should be cached"
+
+
+
+def test():
+    rng = np.random.default_rng(0)
+    imgs = rng.integers(0, 256, (50, 3*64*64), dtype=np.uint8)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Archive of two pickle files like the ImageNet zips
+        archive_file = tmp + os.sep + "train.zip"
+        with zipfile.ZipFile(archive_file, "w") as archive:
+            archive.writestr("batch_1", pickle.dumps({"data": imgs[:30], "labels": [0]*30}))
+            archive.writestr("batch_2", pickle.dumps({"data": imgs[30:], "labels": [0]*20}))
+
+        # The same images as a memmap
+        npy_file = tmp + os.sep + "train.npy"
+        np.save(npy_file, imgs.reshape(-1, 3, 64, 64))
+
+        def run(data_files, seed, load, antialias=False):
+            return compute_imagenet_stats(data_files, 7, 20, seed, "cpu", antialias=antialias, cache_dir=tmp + os.sep + "cache",
+                mean_file=tmp + os.sep + "mean.npy", var_file=tmp + os.sep + "var.npy", load_extractor=load)
+
+        # The statistics are the ones of a random subset of the images
+        stats = run([archive_file], 0, load_extractor)
+        idxs = np.sort(np.random.default_rng(0).choice(50, 20, replace=False))
+        with torch.no_grad():
+            feats = load_extractor("cpu")(normalize(torch.tensor(imgs[idxs]).reshape(-1, 3, 64, 64))).numpy()
+        assert stats.count == 20
+        assert np.allclose(stats.mean, feats.mean(0), atol=1e-5)
+        assert np.allclose(stats.cov(), np.cov(feats, rowvar=False), atol=1e-5)
+        assert np.allclose(np.load(tmp + os.sep + "mean.npy"), stats.mean)
+
+        # Running again loads the cached statistics
+        cached = run([archive_file], 0, no_extractor)
+        assert np.array_equal(cached.mean, stats.mean) and np.array_equal(cached.M2, stats.M2)
+
+        # A different subset isn't cached
+        other = run([archive_file], 1, load_extractor)
+        assert not np.allclose(other.mean, stats.mean)
+
+        # The memmap gives the same subset
+        from_npy = run([npy_file], 0, load_extractor)
+        assert np.allclose(from_npy.mean, stats.mean) and np.allclose(from_npy.cov(), stats.cov())
+
+        # Antialiasing changes the features, so it isn't cached with the default
+        antialiased = run([archive_file], 0, load_extractor, True)
+        assert not np.array_equal(antialiased.mean, stats.mean)
+        assert len([f for f in os.listdir(tmp + os.sep + "cache") if f.endswith(".npz")]) == 4
+
+
+
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,76 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import tempfile
+import numpy as np
+import torch
+from torch import nn
+from eval.compute_metrics import inception_score, KID, precision_recall, compute_metrics
+from eval.compute_FID import FID_Reference
+from eval.feature_stats import FeatureCache
+
+
+
+
+
+def test():
+    rng = np.random.default_rng(0)
+
+    # Confident and evenly spread predictions give the number of
+    # classes and uniform predictions give 1
+    logits = np.tile(np.eye(10)*100, (5, 1))
+    assert np.isclose(inception_score(logits, splits=5)[0], 10)
+    assert np.isclose(inception_score(np.zeros((50, 10)), splits=5)[0], 1)
+
+    # The KID is about 0 for the same distribution and grows with the shift
+    real = rng.standard_normal((500, 8))
+    same = rng.standard_normal((500, 8))
+    kid_same = KID(real, same, 10, 200)[0]
+    kid_shift = KID(real, same + 1, 10, 200)[0]
+    assert abs(kid_same) < 0.05 and kid_shift > 10*abs(kid_same)
+
+    # Same sets have full precision and recall,
+    # far apart sets have none
+    assert precision_recall(real, real, chunk_size=64) == (1.0, 1.0)
+    assert precision_recall(real, real + 100, chunk_size=64) == (0.0, 0.0)
+
+    # When half of the fake features are far from the real ones,
+    # the precision halves and the recall stays about the same
+    fake = np.concatenate((same[:250], same[250:] + 100))
+    precision, recall = precision_recall(real, fake, chunk_size=64)
+    precision_same, recall_same = precision_recall(real, same, chunk_size=64)
+    assert abs(precision - precision_same/2) < 0.05 and abs(recall - recall_same) < 0.1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The features are only readable when all of them are written
+        fake_file = tmp + os.sep + "fake.npy"
+        cache = FeatureCache(fake_file, 500, 8)
+        cache.update(torch.tensor(fake[:200]))
+        assert not os.path.exists(fake_file)
+        cache.update(fake[200:])
+        assert np.allclose(FeatureCache.load(fake_file), fake)
+
+        real_file = tmp + os.sep + "real.npy"
+        FeatureCache(real_file, 500, 8).update(real)
+        np.save(tmp + os.sep + "mean.npy", real.mean(0))
+        np.save(tmp + os.sep + "var.npy", np.cov(real, rowvar=False))
+
+        # All metrics from the cached features
+        torch.manual_seed(0)
+        classifier = nn.Linear(8, 10)
+        metrics = compute_metrics(fake_file, real_file, tmp + os.sep + "mean.npy", tmp + os.sep + "var.npy",
+            kid_subsets=10, kid_subset_size=200, classifier=classifier, chunk_size=64)
+        ref = FID_Reference(real.mean(0), np.cov(real, rowvar=False))
+        assert np.isclose(metrics["FID"], ref.score(fake.mean(0), np.cov(fake, rowvar=False)))
+        with torch.no_grad():
+            assert np.isclose(metrics["IS"], inception_score(classifier(torch.tensor(fake, dtype=torch.float32)).numpy())[0])
+        assert np.isclose(metrics["KID"], KID(real, fake, 10, 200)[0])
+        assert (metrics["precision"], metrics["recall"]) == (precision, recall)
+
+
+
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,71 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import csv
+import shutil
+import tempfile
+import numpy as np
+from eval.compute_model_stats_multiple import compute_model_stats_multiple, checkpoint_info
+from eval.compute_FID import FID_Reference
+from tests.stand_ins import load_extractor, save_small_model, feature_dim
+
+
+
+
+
+def test():
+    assert checkpoint_info("model_40e_50000s.pkl") == ("model_params_40e_50000s.json", 50000)
+    assert checkpoint_info("model_ema_40e_50000s.pkl") == ("model_params_40e_50000s.json", 50000)
+    assert checkpoint_info("model.pkl") == ("model_params.json", None)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Save a few small checkpoints to evaluate
+        for epoch, step in [(1, 200), (2, 400), (3, 600)]:
+            save_small_model(tmp, epoch, step, seed=step)
+
+            # EMA weights of the checkpoint, saved like the trainer does
+            shutil.copy(tmp + os.sep + f"model_{epoch}e_{step}s.pkl", tmp + os.sep + f"model_ema_{epoch}e_{step}s.pkl")
+
+        # Reference statistics
+        rng = np.random.default_rng(0)
+        feats = rng.standard_normal((100, feature_dim))
+        np.save(tmp + os.sep + "real_mean.npy", feats.mean(0))
+        np.save(tmp + os.sep + "real_var.npy", np.cov(feats, rowvar=False))
+
+        # The default glob only matches the model weights, not the EMA weights
+        results = compute_model_stats_multiple(tmp, device="cpu", num_cpu_workers=2,
+            step_size=5, num_fake_imgs=4, batchSize=2, file_path=tmp + os.sep + "stats",
+            real_mean_file=tmp + os.sep + "real_mean.npy", real_var_file=tmp + os.sep + "real_var.npy",
+            results_file=tmp + os.sep + "results.csv", load_extractor=load_extractor, feature_dim=feature_dim)
+
+        # One row per checkpoint, sorted by step
+        assert [r[:2] for r in results] == [("model_1e_200s.pkl", 200), ("model_2e_400s.pkl", 400), ("model_3e_600s.pkl", 600)]
+        with open(tmp + os.sep + "results.csv", "r") as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == ["checkpoint", "step", "FID", "wall_time"]
+        assert [r[0] for r in rows[1:]] == [r[0] for r in results]
+
+        # The FID is the one of the saved statistics
+        ref = FID_Reference(np.load(tmp + os.sep + "real_mean.npy"), np.load(tmp + os.sep + "real_var.npy"))
+        for r in results:
+            name = r[0][len("model"):-len(".pkl")]
+            mean = np.load(tmp + os.sep + "stats" + os.sep + f"fake_mean{name}.npy")
+            var = np.load(tmp + os.sep + "stats" + os.sep + f"fake_var{name}.npy")
+            assert np.isclose(r[2], ref.score(mean, var))
+            assert r[3] > 0
+
+        # The EMA weights are evaluated with their own glob
+        results = compute_model_stats_multiple(tmp, "model_ema_*.pkl", device="cpu", num_cpu_workers=1,
+            step_size=5, num_fake_imgs=4, batchSize=2, file_path=tmp + os.sep + "stats",
+            real_mean_file=tmp + os.sep + "real_mean.npy", real_var_file=tmp + os.sep + "real_var.npy",
+            results_file=tmp + os.sep + "results_ema.csv", load_extractor=load_extractor, feature_dim=feature_dim)
+        assert [r[:2] for r in results] == [("model_ema_1e_200s.pkl", 200), ("model_ema_2e_400s.pkl", 400), ("model_ema_3e_600s.pkl", 600)]
+        assert os.path.exists(tmp + os.sep + "stats" + os.sep + "fake_mean_ema_1e_200s.npy")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
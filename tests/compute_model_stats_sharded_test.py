@@ -0,0 +1,63 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import tempfile
+import numpy as np
+from eval.compute_model_stats_sharded import compute_model_stats_sharded
+from tests.stand_ins import load_extractor, save_small_model, feature_dim
+
+
+
+
+
+def test():
+    with tempfile.TemporaryDirectory() as tmp:
+        # Save a small model to sample from
+        save_small_model(tmp)
+
+        def run(num_cpu_workers, shard_dir, shard_size=3, batchSize=2):
+            missing = compute_model_stats_sharded(tmp, "model_1e_1s.pkl", "model_params_1e_1s.json",
+                device="cpu", num_cpu_workers=num_cpu_workers, num_fake_imgs=10, shard_size=shard_size, batchSize=batchSize,
+                step_size=5, DDIM_scale=1, file_path=tmp, mean_filename="mean.npy", var_filename="var.npy",
+                shard_dir=shard_dir, load_extractor=load_extractor, feature_dim=feature_dim)
+            return missing, np.load(tmp + os.sep + "mean.npy"), np.load(tmp + os.sep + "var.npy")
+
+        # All shards are generated on the first run
+        shard_dir = tmp + os.sep + "shards"
+        missing, mean, var = run(2, shard_dir)
+        assert missing == [0, 1, 2, 3]
+        assert sorted(os.listdir(shard_dir)) == ["config.json"] + [f"shard_{i:05d}.npz" for i in range(4)]
+
+        # Only missing shards are generated when resuming,
+        # and the seeded shards give the same statistics
+        os.remove(shard_dir + os.sep + "shard_00002.npz")
+        missing, mean2, var2 = run(1, shard_dir)
+        assert missing == [2]
+        assert np.allclose(mean, mean2) and np.allclose(var, var2)
+
+        # The statistics don't depend on the number of workers
+        missing, mean3, var3 = run(1, tmp + os.sep + "shards2")
+        assert missing == [0, 1, 2, 3]
+        assert np.allclose(mean, mean3) and np.allclose(var, var3)
+
+        # Each image is seeded by its index, so the statistics
+        # don't depend on the shard size or batch size either
+        missing, mean4, var4 = run(1, tmp + os.sep + "shards3", shard_size=4, batchSize=3)
+        assert missing == [0, 1, 2]
+        assert np.allclose(mean, mean4, atol=1e-5) and np.allclose(var, var4, atol=1e-5)
+
+        # Shards of a different job can't be mixed
+        try:
+            compute_model_stats_sharded(tmp, "model_1e_1s.pkl", "model_params_1e_1s.json", device="cpu",
+                num_fake_imgs=10, shard_size=3, seed=1, shard_dir=shard_dir, load_extractor=load_extractor, feature_dim=feature_dim)
+            assert False
+        except AssertionError as e:
+            assert "different job" in str(e)
+
+
+
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,97 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import time
+import numpy as np
+import torch
+from torch import nn
+from torchvision import transforms
+from src.models.diff_model import diff_model
+from eval.compute_model_stats import normalize, add_model_stats
+from eval.feature_stats import FeatureStats
+from tests.stand_ins import load_extractor, small_model, feature_dim
+
+
+
+
+
+# Original normalization with the torchvision transforms. The pinned
+# torchvision doesn't antialias tensors, newer ones do by default.
+def normalize_reference(imgs, antialias=False):
+    imgs = transforms.Resize((299,299), antialias=antialias)(imgs)
+    imgs = imgs/255.0
+    return transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])(imgs)
+
+
+
+def test():
+    torch.manual_seed(0)
+    imgs = torch.randint(0, 256, (4, 3, 64, 64), dtype=torch.uint8)
+    assert torch.allclose(normalize(imgs), normalize_reference(imgs), atol=1e-5)
+    assert torch.allclose(normalize(imgs, antialias=True), normalize_reference(imgs, True), atol=1e-5)
+    assert not torch.allclose(normalize(imgs, "bicubic"), normalize(imgs, "bicubic", True), atol=1e-5)
+
+    # The pipeline gives the same statistics as generating and
+    # computing the features one batch after the other
+    model = small_model()
+    extractor = load_extractor("cpu")
+    stats = []
+    for pipeline in [False, True]:
+        torch.manual_seed(1)
+        stats.append(add_model_stats(model, extractor, FeatureStats(feature_dim), 7, 3, True, verbose=False, pipeline=pipeline, queue_size=1))
+    assert stats[1].count == 7
+    assert np.allclose(stats[0].mean, stats[1].mean) and np.allclose(stats[0].M2, stats[1].M2)
+
+    # Errors in the generation thread are raised
+    class Broken(nn.Module):
+        device = "cpu"
+        def sample_imgs(self, *args, **kwargs):
+            raise RuntimeError("broken")
+    try:
+        add_model_stats(Broken(), extractor, FeatureStats(feature_dim), 7, 3, True, verbose=False)
+        assert False
+    except RuntimeError as e:
+        assert str(e) == "broken"
+
+
+
+
+
+# Benchmark the images/sec of the two stages in sequence and pipelined
+def benchmark():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    num_imgs = 64
+    batchSize = 16
+    torch.manual_seed(0)
+    model = diff_model(3, 32, 1, 2, ["res", "res"], 1000, "cosine", 128, device, 128, 1000, 16, 0.0, step_size=250).freeze()
+    import torchvision
+    extractor = torchvision.models.inception_v3(weights=None, aux_logits=False, init_weights=False).eval().to(device)
+    extractor.fc = nn.Identity()
+
+    def run(fn):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return num_imgs/(time.perf_counter()-start)
+
+    with torch.no_grad():
+        imgs = model.sample_imgs(batchSize, unreduce=True).to(torch.uint8)
+        gen = run(lambda: [model.sample_imgs(batchSize, unreduce=True) for _ in range(num_imgs//batchSize)])
+        feat = run(lambda: [extractor(normalize(imgs)) for _ in range(num_imgs//batchSize)])
+    seq = run(lambda: add_model_stats(model, extractor, FeatureStats(2048), num_imgs, batchSize, True, verbose=False, pipeline=False))
+    pipe = run(lambda: add_model_stats(model, extractor, FeatureStats(2048), num_imgs, batchSize, True, verbose=False, pipeline=True))
+    print(f"Device: {device}")
+    print(f"generation: {gen:.1f} img/s, features: {feat:.1f} img/s")
+    print(f"sequential: {seq:.1f} img/s, pipelined: {pipe:.1f} img/s")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
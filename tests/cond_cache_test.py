@@ -0,0 +1,98 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import time
+import torch
+from src.models.diff_model import diff_model
+
+
+
+
+
+def test():
+    torch.manual_seed(0)
+    T = 100
+    model = diff_model(3, 16, 1, 2, ["res", "conv", "clsAtn"], T, "cosine", 32, "cpu", 32, 10, 8, 0.0, step_size=20)
+    model.eval()
+
+    # Sampling with and without the cache should give the same images
+    imgs = []
+    for cache_cond in [False, True]:
+        torch.manual_seed(1)
+        imgs.append(model.sample_imgs(2, 3, 4.0, cache_cond=cache_cond))
+    assert torch.allclose(imgs[0], imgs[1], atol=1e-5)
+
+    # The class projections are made once per run and
+    # the time projections once per step
+    num_steps = T//20
+    x_t = torch.randn(2, 3, 16, 16)
+    with torch.no_grad(), model.cond_cache.enable() as cache:
+        for t in range(num_steps, 0, -1):
+            model.unnoise_batch(x_t, t, t*20, 3, 4.0)
+        num_t = sum(k[1] == "t" for k in cache.store)
+        num_c = sum(k[1] == "c" for k in cache.store)
+    assert num_t > 0 and num_c == 2*num_t
+    assert cache.misses == num_steps*num_t + num_c
+    assert cache.hits == num_steps*num_t + (num_steps-1)*num_c
+
+    # The cache is cleared after the run and never used with gradients
+    assert cache.store == {} and not cache.enabled
+    with cache.enable():
+        model(x_t, torch.tensor([5, 5]), torch.tensor([1, 2]))[0].sum().backward()
+        assert cache.store == {}
+
+
+
+
+
+# Benchmark the FLOPs and latency of sampling with and without the
+# conditioning cache. The latencies are timed in turns and the fastest
+# of the repeats is kept, so noise doesn't favor either one.
+def benchmark(repeats=2, steps=[50, 100, 1000]):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    N = 4
+    torch.manual_seed(0)
+    model = diff_model(3, 32, 1, 2, ["res", "clsAtn", "chnAtn"], 1000, "cosine", 512, device, 512, 1000, 16, 0.0).freeze()
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        FlopCounterMode = None
+
+    print(f"Device: {device}, batch size: {N}, guidance: w=4")
+    print(f"{'steps':>6} {'GFLOPs':>9} {'cached':>9} {'saved':>7} {'s':>8} {'cached s':>9} {'saved':>7}")
+    for num_steps in steps:
+        model.step_size = 1000//num_steps
+        model.scheduler = type(model.scheduler)("cosine", 1000, model.step_size, device)
+
+        # Warmup, which also makes the one-time tables of the model
+        # (like the projected timestep embeddings) before counting
+        model.sample_imgs(1, 3, 4.0)
+
+        flops = []
+        times = [float("inf"), float("inf")]
+        for cache_cond in [False, True]:
+            if FlopCounterMode is not None:
+                with FlopCounterMode(display=False) as counter:
+                    model.sample_imgs(N, 3, 4.0, cache_cond=cache_cond)
+                flops.append(counter.get_total_flops()/1e9)
+            else:
+                flops.append(float("nan"))
+        for _ in range(repeats):
+            for i, cache_cond in enumerate([False, True]):
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                model.sample_imgs(N, 3, 4.0, cache_cond=cache_cond)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                times[i] = min(times[i], time.perf_counter()-start)
+        print(f"{num_steps:6d} {flops[0]:9.2f} {flops[1]:9.2f} {100*(1-flops[1]/flops[0]):6.2f}% {times[0]:8.2f} {times[1]:9.2f} {100*(1-times[1]/times[0]):6.2f}%")
+
+
+
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
@@ -0,0 +1,66 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import tempfile
+import torch
+import torchvision
+from torch import nn
+from eval.feature_extractor import register_extractor, load_feature_extractor
+from tests.stand_ins import build_extractor, feature_dim
+
+
+
+
+
+register_extractor("stand_in", build_extractor)
+
+
+
+def test():
+    X = torch.randn(2, 3, 64, 64)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The stand-in is frozen
+        net = load_feature_extractor("stand_in", script=False, cache_dir=tmp, input_size=64)
+        assert not net.training
+        assert all(not p.requires_grad for p in net.parameters())
+        out = net(X)
+        assert out.shape == (2, feature_dim)
+
+        # It's exported on the first load and the export
+        # is loaded the next time
+        scripted = load_feature_extractor("stand_in", cache_dir=tmp, input_size=64)
+        assert os.path.exists(tmp + os.sep + "stand_in_features.pt")
+        assert torch.allclose(scripted(X), out)
+        assert torch.allclose(load_feature_extractor("stand_in", cache_dir=tmp)(X), out)
+
+        # Inception is loaded from the cached weights without the network
+        torch.manual_seed(0)
+        state_dict = torchvision.models.inception_v3(weights=None, aux_logits=True, init_weights=False).state_dict()
+        torch.save(state_dict, tmp + os.sep + "inception_v3.pth")
+        inception = load_feature_extractor("inception", script=False, cache_dir=tmp)
+        X = torch.randn(2, 3, 299, 299)
+        out = inception(X)
+        assert out.shape == (2, 2048)
+        assert torch.equal(inception.Conv2d_1a_3x3.conv.weight, state_dict["Conv2d_1a_3x3.conv.weight"])
+
+        # Same features as the full network with the fully connected layer removed
+        full = torchvision.models.inception_v3(weights=None, aux_logits=True, transform_input=True, init_weights=False)
+        full.load_state_dict(state_dict)
+        full.fc = nn.Identity()
+        full.eval()
+        with torch.no_grad():
+            assert torch.allclose(out, full(X), atol=1e-5)
+
+            # The exported network gives the same features
+            load_feature_extractor("inception", cache_dir=tmp)
+            scripted = load_feature_extractor("inception", cache_dir=tmp)
+            assert torch.allclose(scripted(X), out, atol=1e-4)
+
+
+
+
+
+if __name__ == "__main__":
+    test()
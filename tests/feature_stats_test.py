@@ -0,0 +1,56 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import tempfile
+import numpy as np
+import torch
+from eval.feature_stats import FeatureStats
+
+
+
+
+
+def test():
+    rng = np.random.default_rng(0)
+    dim = 16
+
+    # Features with a large offset, where the naive sum of
+    # squares would lose precision
+    feats = rng.standard_normal((1000, dim)) + 1e4
+
+    # Batches of uneven sizes, some as tensors
+    stats = FeatureStats(dim)
+    for i, j in [(0, 1), (1, 200), (200, 200), (200, 537), (537, 1000)]:
+        batch = feats[i:j]
+        stats.update(torch.tensor(batch) if i % 2 else batch)
+    assert stats.count == 1000
+    assert np.allclose(stats.mean, feats.mean(0))
+    assert np.allclose(stats.cov(), np.cov(feats, rowvar=False))
+
+    # Merging workers gives the same statistics as one pass
+    a = FeatureStats(dim).update(feats[:300])
+    b = FeatureStats(dim).update(feats[300:])
+    merged = FeatureStats(dim).merge(a).merge(FeatureStats(dim)).merge(b)
+    assert merged.count == 1000
+    assert np.allclose(merged.mean, stats.mean)
+    assert np.allclose(merged.cov(), stats.cov())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The saved state can be loaded and merged in another process
+        stats.save(tmp + os.sep + "shard.npz")
+        loaded = FeatureStats.load(tmp + os.sep + "shard.npz")
+        assert loaded.count == stats.count
+        assert np.array_equal(loaded.M2, stats.M2)
+
+        # The mean and covariance files are the ones compute_FID reads
+        stats.save_stats(tmp + os.sep + "mean.npy", tmp + os.sep + "var.npy")
+        assert np.array_equal(np.load(tmp + os.sep + "mean.npy"), stats.mean)
+        assert np.array_equal(np.load(tmp + os.sep + "var.npy"), stats.cov())
+
+
+
+
+
+if __name__ == "__main__":
+    test()
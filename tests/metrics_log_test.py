@@ -0,0 +1,64 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import tempfile
+import numpy as np
+from src.helpers.metrics_log import MetricsLog
+
+
+
+
+
+def test():
+    num_rows = 1000
+    rows = np.stack((np.arange(1, num_rows+1), np.random.rand(num_rows), np.random.rand(num_rows)), -1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = tmp + os.sep + "losses.bin"
+        log = MetricsLog(filename, ["step", "a", "b"], chunk_size=64, window=10, max_points=16)
+        for row in rows:
+            log.append(*row)
+
+        # Only full chunks are on disk until flushed
+        assert log.read().shape[0] == (num_rows//64)*64
+        log.flush()
+        assert np.array_equal(log.read(), rows)
+
+        # The window only keeps the latest rows
+        assert np.array_equal(log.recent("a", 5), rows[-5:, 1])
+        assert np.array_equal(log.recent("a", 100), rows[-10:, 1])
+
+        # The downsampled rows are bounded and keep the mean
+        assert len(log.downsampled("a")) <= 17
+        assert np.isclose(log.downsampled("step")[0], rows[:log.stride, 0].mean())
+
+        # Truncating keeps the rows up to the step
+        log2 = MetricsLog(filename, ["step", "a", "b"], window=10, max_points=16)
+        log2.truncate(500)
+        assert np.array_equal(log2.read(), rows[:500])
+        assert np.array_equal(log2.recent("b", 3), rows[497:500, 2])
+        assert log2.num_rows == 500
+
+        # Resuming from a checkpoint truncates, but a new run
+        # moves the rows of an old run to a new file
+        log3 = MetricsLog(filename, ["step", "a", "b"], window=10, max_points=16)
+        log3.resume(400)
+        assert np.array_equal(log3.read(), rows[:400])
+        log4 = MetricsLog(filename, ["step", "a", "b"])
+        assert log4.resume(0) == tmp + os.sep + "losses_1.bin"
+        assert log4.read().shape[0] == 0 and log4.num_rows == 0
+        assert np.array_equal(MetricsLog(tmp + os.sep + "losses_1.bin", ["step", "a", "b"]).read(), rows[:400])
+
+        # Another new run doesn't overwrite the moved rows
+        log4.append(1, 2, 3)
+        log4.flush()
+        assert MetricsLog(filename, ["step", "a", "b"]).resume(0) == tmp + os.sep + "losses_2.bin"
+        assert np.array_equal(MetricsLog(tmp + os.sep + "losses_1.bin", ["step", "a", "b"]).read(), rows[:400])
+        assert MetricsLog(tmp + os.sep + "new.bin", ["step", "a", "b"]).resume(0) is None
+
+
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,53 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import torch
+from src.helpers.seeded_noise import SampleNoise
+from tests.stand_ins import small_model
+
+
+
+
+
+def test():
+    # The noise of a sample only depends on the seed and its index
+    noise = SampleNoise(0, [0, 1, 2], "cpu")
+    a = noise.randn((2, 3))
+    b = noise.randn((2, 3))
+    assert a.shape == (3, 2, 3)
+    assert not torch.equal(a, b) and not torch.equal(a[0], a[1])
+    single = SampleNoise(0, [1], "cpu")
+    assert torch.equal(single.randn((2, 3))[0], a[1])
+    assert torch.equal(single.randn((2, 3))[0], b[1])
+    assert not torch.equal(SampleNoise(1, [0], "cpu").randn((2, 3))[0], a[0])
+
+    model = small_model()
+
+    # A seeded image is the same no matter which batch it's generated in
+    imgs = model.sample_imgs(3, corrected=True, seed=5)
+    for i in range(3):
+        img = model.sample_imgs(1, corrected=True, seed=5, sample_idxs=[i])
+        assert torch.allclose(imgs[i], img[0], atol=1e-5)
+    imgs2 = model.sample_imgs(2, corrected=True, seed=5, sample_idxs=[2, 0])
+    assert torch.allclose(imgs[[2, 0]], imgs2, atol=1e-5)
+
+    # Seeding doesn't use the global generator
+    torch.manual_seed(1)
+    state = torch.get_rng_state()
+    model.sample_imgs(2, corrected=True, seed=5)
+    assert torch.equal(state, torch.get_rng_state())
+
+    # Without a seed, the images come from the global generator
+    torch.manual_seed(1)
+    unseeded = model.sample_imgs(2, corrected=True)
+    torch.manual_seed(1)
+    assert torch.allclose(unseeded, model.sample_imgs(2, corrected=True))
+    assert not torch.allclose(model.sample_imgs(2, corrected=True, seed=6), imgs[:2])
+
+
+
+
+
+if __name__ == "__main__":
+    test()
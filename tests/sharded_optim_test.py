@@ -0,0 +1,92 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import tempfile
+import torch
+from torch import nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from src.helpers.multi_gpu_helpers import create_optimizer, gather_optim_state
+
+
+
+
+
+# Small model to optimize. The seed is fixed so
+# every process starts with the same weights
+def make_model():
+    torch.manual_seed(0)
+    return nn.Sequential(
+        nn.Linear(8, 16),
+        nn.SiLU(),
+        nn.Linear(16, 16),
+        nn.SiLU(),
+        nn.Linear(16, 4),
+    )
+
+
+# Take a few optimizer steps on the same data on every process
+def take_steps(model, optim, num_steps=3):
+    torch.manual_seed(1)
+    for _ in range(num_steps):
+        X = torch.rand(4, 8)
+        model(X).square().mean().backward()
+        optim.step()
+        optim.zero_grad()
+
+
+def worker(rank, world_size, port, optim_file):
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", world_size=world_size, rank=rank)
+
+    # Sharded optimizer over the same steps as a full optimizer
+    model = make_model()
+    optim = create_optimizer(model.parameters(), 1e-3, shard_optim=True)
+    take_steps(model, optim)
+
+    # Gather the state on the main process and save it
+    gather_optim_state(optim)
+    if rank == 0:
+        torch.save(optim.state_dict(), optim_file)
+    dist.barrier()
+
+    # The saved state should load into a new sharded optimizer
+    model2 = make_model()
+    optim2 = create_optimizer(model2.parameters(), 1e-3, shard_optim=True)
+    optim2.load_state_dict(torch.load(optim_file))
+    for param in optim2.optim.param_groups[0]["params"]:
+        assert param in optim2.optim.state
+
+    dist.destroy_process_group()
+
+
+
+
+
+def test():
+    world_size = 2
+    port = 29500 + os.getpid() % 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        optim_file = tmp + os.sep + "optim.pkl"
+        mp.spawn(worker, args=(world_size, port, optim_file), nprocs=world_size, join=True)
+
+        # The gathered file should have the same layout as the
+        # file of a full optimizer and load into one
+        model = make_model()
+        optim = create_optimizer(model.parameters(), 1e-3)
+        take_steps(model, optim)
+        full_state = optim.state_dict()
+
+        sharded_state = torch.load(optim_file)
+        optim.load_state_dict(sharded_state)
+
+        assert full_state["state"].keys() == sharded_state["state"].keys()
+        for idx in full_state["state"]:
+            for name in ("exp_avg", "exp_avg_sq"):
+                assert torch.allclose(full_state["state"][idx][name], sharded_state["state"][idx][name])
+
+
+
+if __name__ == "__main__":
+    test()
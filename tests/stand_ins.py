@@ -0,0 +1,46 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import torch
+from torch import nn
+from src.models.diff_model import diff_model
+
+
+
+
+
+# Small stand-ins for the networks used by the eval scripts, shared
+# by the tests. The stand-ins are seeded so every worker process
+# makes the same network.
+
+# Number of features the stand-in extractor outputs
+feature_dim = 8
+
+
+
+# Build the stand-in for the inception network. The signature
+# matches the builders of the feature extractor registry.
+def build_extractor(cache_dir=None):
+    torch.manual_seed(0)
+    return nn.Sequential(nn.AdaptiveAvgPool2d(4), nn.Flatten(), nn.Linear(48, feature_dim))
+
+
+
+# Load the stand-in for the inception network on a device
+def load_extractor(device):
+    return build_extractor().to(device)
+
+
+
+# Make a small diffusion model which samples in a few steps
+def small_model(seed=0):
+    torch.manual_seed(seed)
+    return diff_model(3, 8, 1, 1, ["res"], 10, "cosine", 16, "cpu", 16, 10, step_size=5)
+
+
+
+# Save a small diffusion model to a directory as
+# model_{epoch}e_{step}s.pkl and model_params_{epoch}e_{step}s.json
+def save_small_model(dirname, epoch=1, step=1, seed=0):
+    small_model(seed).saveModel(dirname, None, epoch, step)
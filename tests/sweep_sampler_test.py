@@ -0,0 +1,62 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import csv
+import tempfile
+import numpy as np
+from eval.sweep_sampler import sweep_sampler, dominated
+from eval.feature_stats import FeatureCache
+from tests.stand_ins import load_extractor, save_small_model, feature_dim
+
+
+
+
+
+def test():
+    # A result is dominated by a faster one with a better FID
+    results = [dict(FID=10, sec_per_img=1), dict(FID=12, sec_per_img=2), dict(FID=8, sec_per_img=3)]
+    assert [dominated(r, results) for r in results] == [False, True, False]
+    assert not dominated(results[1], results, margin=0.5)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        save_small_model(tmp)
+
+        # Reference statistics and features
+        rng = np.random.default_rng(0)
+        feats = rng.standard_normal((50, feature_dim))
+        np.save(tmp + os.sep + "real_mean.npy", feats.mean(0))
+        np.save(tmp + os.sep + "real_var.npy", np.cov(feats, rowvar=False))
+        FeatureCache(tmp + os.sep + "real_features.npy", 50, feature_dim).update(feats)
+
+        results = sweep_sampler(tmp, "model_1e_1s.pkl", "model_params_1e_1s.json", "cpu",
+            step_sizes=[2, 5], DDIM_scales=[0, 1], correcteds=[True], ws=[0.0, 1.0],
+            budgets=[4, 8], prune_margin=0.0, batchSize=4,
+            real_mean_file=tmp + os.sep + "real_mean.npy", real_var_file=tmp + os.sep + "real_var.npy",
+            real_features_file=tmp + os.sep + "real_features.npy",
+            results_file=tmp + os.sep + "sweep.csv", load_extractor=load_extractor)
+        assert len(results) == 8
+
+        # One network evaluation per step, two with guidance
+        for r in results:
+            assert r["nfe_per_img"] == len(range(1, 11, r["step_size"]))*(2 if r["w"] > 0 else 1)
+            assert r["num_imgs"] in [4, 8] and r["sec_per_img"] > 0 and np.isfinite(r["KID"])
+
+        # Only the settings which weren't dominated at the first budget
+        # got the full budget, and the Pareto frontier is among them
+        final = [r for r in results if r["num_imgs"] == 8]
+        assert len(final) > 0 and any(r["pareto"] for r in final)
+        for r in results:
+            assert r["pareto"] == (r["num_imgs"] == 8 and not dominated(r, final))
+
+        with open(tmp + os.sep + "sweep.csv", "r") as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == ["step_size", "DDIM_scale", "corrected", "w", "num_imgs", "nfe_per_img", "sec_per_img", "FID", "KID", "pareto"]
+        assert len(rows) == 9
+
+
+
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,112 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import csv
+import json
+import tempfile
+import time
+import torch
+from torch import nn
+from src.helpers.telemetry import StepTelemetry, PHASES
+
+
+
+
+
+# Take a fake training step, sleeping in each phase
+# for the given number of ms
+def fake_step(telemetry, step, t, loss, sleep_ms):
+    time.sleep(sleep_ms["data_wait"]/1000)
+    telemetry.data_ready()
+    for phase in ["h2d", "noise", "forward", "loss", "backward", "optimizer"]:
+        time.sleep(sleep_ms.get(phase, 0)/1000)
+        telemetry.mark(phase)
+    telemetry.add_t_losses(t, loss)
+    telemetry.end_step(step, 8)
+
+
+
+def test():
+    device = torch.device("cpu")
+    sleep_ms = {"data_wait": 5, "forward": 20, "backward": 10}
+
+    # Buckets of t=1..100 are 1-25, 26-50, 51-75, and 76-100.
+    # No t is in the third bucket.
+    t = torch.tensor([1, 25, 26, 100, 100])
+    loss = torch.tensor([1.0, 3.0, 5.0, 6.0, 8.0])
+    t_loss = [2.0, 5.0, None, 7.0]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The profiler runs from the start of step 2 to the end of step 3
+        telemetry = StepTelemetry(True, tmp, device, 100, "jsonl", log_every=2, num_t_buckets=4, profile_steps=(2, 3))
+        for step in range(1, 5):
+            telemetry.begin_step(step)
+            assert (telemetry.profiler is not None) == (step in [2, 3])
+            fake_step(telemetry, step, t, loss, sleep_ms)
+            assert (telemetry.profiler is not None) == (step == 2)
+        assert os.listdir(tmp).count("trace_2s_3s.json") == 1
+        telemetry.flush()
+
+        # One record for each step with every column
+        with open(tmp + os.sep + "telemetry.jsonl") as f:
+            rows = [json.loads(line) for line in f]
+        assert [row["step"] for row in rows] == [1, 2, 3, 4]
+        for row in rows:
+            assert list(row.keys()) == telemetry.columns
+            for phase, ms in sleep_ms.items():
+                assert row[phase] >= ms
+            assert row["step_time"] >= sum(row[phase] for phase in PHASES)
+            assert abs(row["imgs_per_sec"] - 8/(row["step_time"]/1000)) < 1e-6
+            assert [row[f"loss_t{i}"] for i in range(4)] == t_loss
+            # There's no per step peak memory on a CPU
+            assert row["peak_mem_MB"] is None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The CSV file has a single header and a row for each step
+        telemetry = StepTelemetry(True, tmp, device, 100, "csv", log_every=2, num_t_buckets=4)
+        for step in range(1, 4):
+            fake_step(telemetry, step, t, loss, sleep_ms)
+        telemetry.flush()
+        with open(tmp + os.sep + "telemetry.csv", newline="") as f:
+            reader = csv.DictReader(f)
+            rows = list(reader)
+        assert reader.fieldnames == telemetry.columns
+        assert [int(row["step"]) for row in rows] == [1, 2, 3]
+        for row in rows:
+            assert float(row["forward"]) >= sleep_ms["forward"]
+            assert row["peak_mem_MB"] == ""
+            assert [float(row[f"loss_t{i}"]) if row[f"loss_t{i}"] != "" else None for i in range(4)] == t_loss
+
+        # A disabled recorder doesn't write anything
+        telemetry = StepTelemetry(False, tmp + os.sep + "off", device, 100)
+        fake_step(telemetry, 1, t, loss, sleep_ms)
+        telemetry.flush()
+        assert not os.path.exists(tmp + os.sep + "off")
+
+    # The communication hook reduces the gradients like
+    # the default hook and records the allreduce time
+    with tempfile.TemporaryDirectory() as tmp:
+        torch.distributed.init_process_group("gloo", init_method=f"file://{tmp}{os.sep}pg", rank=0, world_size=1)
+        try:
+            telemetry = StepTelemetry(True, tmp, device, 100)
+            model = nn.Linear(4, 4)
+            ddp = nn.parallel.DistributedDataParallel(model)
+            ddp.register_comm_hook(None, telemetry.allreduce_hook)
+            x = torch.randn(3, 4)
+            ddp(x).square().sum().backward()
+            grads = [p.grad.clone() for p in model.parameters()]
+            model.zero_grad()
+            model(x).square().sum().backward()
+            for g, p in zip(grads, model.parameters()):
+                assert torch.allclose(g, p.grad)
+            assert telemetry.cur_host["allreduce"] > 0
+        finally:
+            torch.distributed.destroy_process_group()
+
+
+
+
+
+if __name__ == "__main__":
+    test()
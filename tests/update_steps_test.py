@@ -0,0 +1,45 @@
+# Path hack for relative paths
+import sys, os
+sys.path.insert(0, os.path.abspath('./src'))
+
+import json
+import tempfile
+from src.model_trainer import update_steps
+from tests.stand_ins import small_model, save_small_model
+
+
+
+
+
+def test():
+    with tempfile.TemporaryDirectory() as tmp:
+        # New models count model updates
+        save_small_model(tmp, 2, 40)
+        model = small_model()
+        model.loadModel(tmp, "model_2e_40s.pkl", "model_params_2e_40s.json")
+        assert model.defaults["step_unit"] == "update"
+        assert update_steps(model.defaults, 4) == 40
+
+        # Old models count batches, so their step is converted
+        with open(tmp + os.sep + "model_params_2e_40s.json") as f:
+            defaults = json.load(f)
+        del defaults["step_unit"]
+        with open(tmp + os.sep + "model_params_2e_40s.json", "w") as f:
+            json.dump(defaults, f)
+        model = small_model()
+        model.loadModel(tmp, "model_2e_40s.pkl", "model_params_2e_40s.json")
+        assert model.defaults["step_unit"] == "batch"
+        assert update_steps(model.defaults, 4) == 10
+        assert model.defaults["step"] == 10 and model.defaults["step_unit"] == "update"
+
+        # The converted step is saved with the model
+        model.saveModel(tmp, None, 2, model.defaults["step"])
+        with open(tmp + os.sep + "model_params_2e_10s.json") as f:
+            assert json.load(f)["step_unit"] == "update"
+
+
+
+
+
+if __name__ == "__main__":
+    test()